@@ -54,11 +54,14 @@ import argparse
 import os, sys
 import time
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional, Tuple
 
 import joblib
+import numpy as np
 import matplotlib
 matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba
 
 import osmnx as ox
 
@@ -88,13 +91,26 @@ for p in paths2add:
         print(f"\n{str(p)} added to the path.")
 
 # Import helper functions
-from tilemani.utils import parse_maptile_fp
-from tilemani.utils import mkdir, write_record
+from tilemani.utils.geo import parse_maptile_fp
+from tilemani.utils.misc import mkdir, write_record, append_records
+from tilemani.utils.instrument import Instrument, MemoryBudget, get_instrument, set_instrument, timer, count
+from tilemani.utils.ordering import CURVES, chunk_tiles, order_tiles, shard_tiles, parse_shard
+from tilemani.utils.failures import (FailureLog, FailureRecord, set_failure_log, capture,
+                                     read_failures, latest_failures, retry_failures)
 
 from tilemani.retrieve.retriever import get_road_graph_and_bbox, get_geoms
+from tilemani.retrieve.overpass import OverpassClient, tile_bbox, tiles_bbox
+from tilemani.retrieve.region_graph import RegionGraph
+from tilemani.retrieve.planner import plan_quadtree, osm_count_probe
+from tilemani.retrieve.preprocess import preprocess_for_render
+from tilemani.utils.tiles import tiles_in_polygon, load_location_geometries, get_tile_bbox
 
 from tilemani.rasterize.rasterizer import rasterize_road_and_bldg
 from tilemani.rasterize.rasterizer import single_rasterize_road_and_bldg
+from tilemani.rasterize.renderer import batch_rasterize_road_and_bldg, figure_ground_px, FOOTPRINT_FILLS
+from tilemani.rasterize.writer import TileWriter, CODECS, CODEC_SUFFIX
+from tilemani.rasterize.metatile import group_by_metatile, retrieve_metatile, rasterize_metatile, metatile_bbox
+from tilemani.rasterize.pyramid import build_pyramid
 
 from tilemani.compute.features import compute_road_network_stats
 
@@ -128,10 +144,10 @@ from tilemani.compute.features import compute_road_network_stats
 # verbose = False #True
 
 
-def retrieve_and_rasterize_locs_in_a_folder(
+def retrieve_and_rasterize_tile(
+        tileXYZ: Tuple[int, int, int],
         city: str,
         style: str,
-        zoom: str,
         network_type='drive_service',
         bgcolors=['k', 'r', 'g', 'b', 'y'],
         edge_colors=['cyan'],
@@ -144,39 +160,67 @@ def retrieve_and_rasterize_locs_in_a_folder(
         show_only_once=False,
         verbose=False,  # True,
         out_dir_root=Path('./temp/images'),
-        records_dir_root=Path('./temp/records'),
-) -> List[Dict]:
-    mkdir(out_dir_root)
-    mkdir(records_dir_root)
-
-    img_dir = DATA_ROOT / city / style / zoom
-    if not img_dir.exists():
-        raise ValueError(f"{img_dir} doesn't exist. Check the spelling and upper/lower case of city, style, zoom")
+        batch_render=False,
+        writer: Optional[TileWriter] = None,
+        footprint_fill='agg',
+        simplify_px: Optional[float] = None,
+        metric_widths: bool = False,
+        retrieved: Optional[Tuple] = None,
+) -> Dict:
+    """Retrieve the road graph and bldg geoms of a single maptile, rasterize them in all styles,
+    save the graph/geoms and compute the road network stats.
+    Failures of each stage are recorded in the failure log (`tilemani.utils.failures`).
+    If `batch_render`, the styles are rendered with `batch_rasterize_road_and_bldg`, which
+    reuses one figure and canvas per worker (same style names and outputs; `show` is ignored),
+    and saved by the `writer` if one is given. `footprint_fill` ('agg' or 'scanline') selects how
+    the batch renderer fills the bldg footprints (see `tilemani.rasterize.renderer`).
+    If `simplify_px` is given, the road graph and bldg geoms are clipped to the tile and simplified
+    to that many pixels before rendering (see `tilemani.retrieve.preprocess`); the saved graph/geoms
+    and the stats use the retrieved ones.
+    If `metric_widths` (with `batch_render`), the roads are drawn at their width on the ground, from
+    their lanes tag or road class (see `BatchRenderer.set_metric_widths`).
+    If `retrieved` (G_r, bbox, gdf_b) is given, e.g. by `OverpassClient.retrieve_tiles`, the tile
+    is not retrieved again.
+
+    Returns
+    -------
+    - record of the maptile (location, retrieval status and road network stats) as a dict
+    """
     if verbose:
-        print(f"Image_dir: ", img_dir)
-    #     breakpoint() #debug
+        print("=" * 10)
+        print(f"Processing {city} -- {tileXYZ}")
 
-    # list of each record of location (which is a dict)
-    records = []
-    for i, img_fp in enumerate(img_dir.iterdir()):
-        if not img_fp.is_file(): continue
-        record = parse_maptile_fp(img_fp)
-        record['city'] = city
-        record['style'] = style
-
-        tileXYZ = (record['x'], record['y'], record['z'])
-        if verbose:
-            print("=" * 10)
-            print(f"Processing {city} -- {tileXYZ}")
-
-        # Retrieve road graph and bldg geoms
+    # Retrieve road graph and bldg geoms
+    if retrieved is not None:
+        G_r, bbox, gdf_b = retrieved
+    else:
         G_r, bbox = get_road_graph_and_bbox(tileXYZ, network_type)
         gdf_b = get_geoms(tileXYZ, tag={'building': True})
-
-        # Rasterize road graph with *my* plot_figure_ground (not ox.plot_figure_ground)
+    G_render, gdf_render = G_r, gdf_b
+    if simplify_px is not None:
+        with capture(tileXYZ, 'preprocess'), timer('preprocess'):
+            G_render, gdf_render = preprocess_for_render(G_r, gdf_b, bbox, figure_ground_px(figsize, dpi),
+                                                         tolerance_px=simplify_px)
+
+    if batch_render:
+        with capture(tileXYZ, 'render'):
+            batch_rasterize_road_and_bldg(G_render, gdf_render, tileXYZ, bbox, bgcolors, edge_colors, bldg_colors,
+                                          lw_factors, save=save, out_dir_root=out_dir_root / city,
+                                          verbose=verbose, figsize=figsize, dpi=dpi, writer=writer,
+                                          footprint_fill=footprint_fill, metric_widths=metric_widths)
+            # Raster in grayscale, as `single_rasterize_road_and_bldg`
+            batch_rasterize_road_and_bldg(G_render, gdf_render, tileXYZ, bbox, ['w'], ['k'], ['silver'],
+                                          lw_factors[:1], save=save, out_dir_root=out_dir_root / city,
+                                          verbose=verbose, figsize=figsize, dpi=dpi, writer=writer,
+                                          footprint_fill=footprint_fill, metric_widths=metric_widths)
+        return save_and_record_tile(tileXYZ, G_r, gdf_b, city, style,
+                                    save=save, verbose=verbose, out_dir_root=out_dir_root)
+
+    # Rasterize road graph with *my* plot_figure_ground (not ox.plot_figure_ground)
+    with capture(tileXYZ, 'render'):
         rasterize_road_and_bldg(
-            G_r,
-            gdf_b,
+            G_render,
+            gdf_render,
             tileXYZ,
             bbox,
             bgcolors,
@@ -192,8 +236,8 @@ def retrieve_and_rasterize_locs_in_a_folder(
             dpi=dpi)
         # Raster in grayscale (bgcolor='w','edge_color='k', bldg_color='silver')
         single_rasterize_road_and_bldg(
-            G_r,
-            gdf_b,
+            G_render,
+            gdf_render,
             tileXYZ,
             bbox=bbox,
             lw_factor=lw_factors[0],
@@ -204,66 +248,501 @@ def retrieve_and_rasterize_locs_in_a_folder(
             figsize=figsize,
             dpi=dpi
         )
-        # Save retrieval results
-        record['retrieved_road'] = G_r is not None
-        record['retrieved_bldg'] = gdf_b is not None
-
-        filename = f"{record['x']}_{record['y']}_{record['z']}"
-        if save:
-            # Save the graph (of roads) as Graphml file
-            filename = f"{record['x']}_{record['y']}_{record['z']}"
-            fp = out_dir_root / city / 'RoadGraph' / f'{tileXYZ[-1]}' / f'{filename}.graphml'
-            if G_r is not None:
+    return save_and_record_tile(tileXYZ, G_r, gdf_b, city, style,
+                                save=save, verbose=verbose, out_dir_root=out_dir_root)
+
+
+def save_and_record_tile(
+        tileXYZ: Tuple[int, int, int],
+        G_r,
+        gdf_b,
+        city: str,
+        style: str,
+        save=True,
+        verbose=False,
+        out_dir_root=Path('./temp/images'),
+) -> Dict:
+    """Save the road graph and bldg geoms of the maptile (if save), and compute its record:
+    location, retrieval status and road network stats.
+
+    Returns
+    -------
+    - record of the maptile as a dict
+    """
+    x, y, z = tileXYZ
+    record = parse_maptile_fp(Path(f'{x}_{y}_{z}.png'))
+    record['city'] = city
+    record['style'] = style
+
+    # Save retrieval results
+    record['retrieved_road'] = G_r is not None
+    record['retrieved_bldg'] = gdf_b is not None
+
+    filename = f"{record['x']}_{record['y']}_{record['z']}"
+    if G_r is None and (gdf_b is None or gdf_b.empty):
+        count('empty_tiles')
+
+    if save:
+        # Save the graph (of roads) as Graphml file
+        fp = out_dir_root / city / 'RoadGraph' / f'{z}' / f'{filename}.graphml'
+        if G_r is not None:
+            with capture(tileXYZ, 'save_graphml'), timer('save_graphml'):
                 ox.save_graphml(G_r,
                                 filepath=fp)
                 if verbose:
                     print('\tSaved road graph as graphml: ', fp)
 
-            # Save the GeoDataFrame (for bldg data) as Geojson
-            fp = out_dir_root / city / 'BldgGeom' / f'{tileXYZ[-1]}' / f'{filename}.geojson'
-            if not fp.parent.exists():
-                fp.mkdir(parents=True)
-                print(f'Created {fp.parent}')
-
-            if gdf_b is not None and not gdf_b.empty:
-                try:
-                    _gdf = gdf_b.apply(lambda c: c.astype(str) if c.name != "geometry" else c, axis=0)
-                    _gdf.to_file(fp, driver='GeoJSON')
-                    if verbose:
-                        print('\tSaved BLDG Geopandas as geopackage: ', fp)
-                except:
-                    print(f"\tFailed to save BLDG Geopandas as gpkg: ", sys.exc_info()[0])
-
-        # Compute states from G_r, gdf_b and save to record dict
-        if G_r is not None:
+        # Save the GeoDataFrame (for bldg data) as Geojson
+        fp = out_dir_root / city / 'BldgGeom' / f'{z}' / f'{filename}.geojson'
+        if not fp.parent.exists():
+            fp.parent.mkdir(parents=True)
+            print(f'Created {fp.parent}')
+
+        if gdf_b is not None and not gdf_b.empty:
+            with capture(tileXYZ, 'save_geojson'), timer('save_geojson'):
+                _gdf = gdf_b.apply(lambda c: c.astype(str) if c.name != "geometry" else c, axis=0)
+                _gdf.to_file(fp, driver='GeoJSON')
+                if verbose:
+                    print('\tSaved BLDG Geopandas as geojson: ', fp)
+
+    # Compute states from G_r, gdf_b and save to record dict
+    if G_r is not None:
+        with capture(tileXYZ, 'stats'):
             road_stats = compute_road_network_stats(G_r)
             record.update(road_stats)
 
-        # Write this location's record to a json file
-        # todo: test this part -- see if each record is written as individual csv file
-        if save:
-            record_dir = out_dir_root / city / 'RoadStat'
-            mkdir(record_dir)
+    # Write this location's record to a json file
+    # todo: test this part -- see if each record is written as individual csv file
+    if save:
+        record_dir = out_dir_root / city / 'RoadStat'
+        mkdir(record_dir)
+        with capture(tileXYZ, 'save_record'), timer('save_record'):
             write_record(record, record_dir / f'{filename}.csv', verbose=verbose)
 
-        # Append the record to records
-        records.append(record)
-        print(len(records), end="...")
+    count('tiles')
+    return record
 
-    # Write the final `records` to a file
+
+def retrieve_and_rasterize_metatile(
+        metatileXYZ: Tuple[int, int, int],
+        tiles: Iterable[Tuple[int, int, int]],
+        city: str,
+        style: str,
+        metatile_size: int = 8,
+        buffer_px: int = 16,
+        network_type='drive_service',
+        bgcolors=['k', 'r', 'g', 'b', 'y'],
+        edge_colors=['cyan'],
+        bldg_colors=['silver'],
+        lw_factors=[0.5],
+        save=True,
+        dpi=50,
+        figsize=(7, 7),
+        verbose=False,  # True,
+        out_dir_root=Path('./temp/images'),
+        writer: Optional[TileWriter] = None,
+        footprint_fill='agg',
+        simplify_px: Optional[float] = None,
+        metric_widths: bool = False,
+) -> List[Dict]:
+    """Metatile mode of `retrieve_and_rasterize_tile`: retrieve the road graph and bldg geoms of
+    the metatile (a block of `metatile_size` x `metatile_size` maptiles) with one query each,
+    rasterize the whole block once per style and slice it into the maptiles in `tiles`, saved in the
+    OSMnxM* style folders (the metatile tiles cover the exact maptile bounds, unlike those of
+    `retrieve_and_rasterize_tile`, see `tilemani.rasterize.metatile`).
+    The graph and geoms of each maptile (for the graphml/geojson files and the stats) are cut
+    out of the metatile's. If a `writer` is given, the tiles are saved by it.
+    `footprint_fill` and `metric_widths` are those of `tilemani.rasterize.metatile.rasterize_metatile`,
+    and `simplify_px` that of `retrieve_and_rasterize_tile` (applied to the whole metatile).
+
+    Returns
+    -------
+    - records of the maptiles in `tiles`
+    """
+    tiles = list(tiles)
+    if verbose:
+        print("=" * 10)
+        print(f"Processing {city} -- metatile {metatileXYZ} ({len(tiles)} tiles)")
+
+    tile_px = int(round(figsize[0] * dpi))
+    G_m, gdf_m = retrieve_metatile(metatileXYZ, metatile_size, tile_px, buffer_px, network_type)
+    G_render, gdf_render = G_m, gdf_m
+    if simplify_px is not None:
+        with capture(metatileXYZ, 'preprocess'), timer('preprocess'):
+            G_render, gdf_render = preprocess_for_render(
+                G_m, gdf_m, metatile_bbox(metatileXYZ, metatile_size, tile_px, buffer_px),
+                metatile_size * tile_px + 2 * buffer_px, tolerance_px=simplify_px)
+
+    with capture(metatileXYZ, 'render'):
+        render_kwargs = dict(save=save, tiles=tiles, dpi=dpi, figsize=figsize, buffer_px=buffer_px,
+                             verbose=verbose, out_dir_root=out_dir_root / city, writer=writer,
+                             footprint_fill=footprint_fill, metric_widths=metric_widths)
+        rasterize_metatile(G_render, gdf_render, metatileXYZ, metatile_size,
+                           bgcolors, edge_colors, bldg_colors, lw_factors, **render_kwargs)
+        # Raster in grayscale (bgcolor='w','edge_color='k', bldg_color='silver')
+        rasterize_metatile(G_render, gdf_render, metatileXYZ, metatile_size,
+                           ['w'], ['k'], ['silver'], lw_factors[:1], **render_kwargs)
+
+    records = []
+    for tileXYZ in tiles:
+        north, south, east, west = get_tile_bbox(tileXYZ)
+        G_r = None
+        if G_m is not None:
+            with capture(tileXYZ, 'truncate_road'):
+                G_r = ox.truncate.truncate_graph_bbox(G_m, north, south, east, west, truncate_by_edge=True)
+                G_r = G_r if len(G_r) else None
+        gdf_b = None if gdf_m is None else gdf_m.cx[west:east, south:north]
+        records.append(save_and_record_tile(tileXYZ, G_r, gdf_b, city, style,
+                                            save=save, verbose=verbose, out_dir_root=out_dir_root))
+    return records
+
+
+def stream_and_rasterize_tiles(
+        tiles: Iterable[Tuple[int, int, int]],
+        city: str,
+        style: str,
+        records_fp: Path,
+        memory_budget_mb: float,
+        chunk_size: int = 64,
+        curve: Optional[str] = 'hilbert',
+        overpass_slots: int = 2,
+        **tile_kwargs,
+) -> int:
+    """Streaming mode of `retrieve_and_rasterize_tiles`, within a memory budget: the tiles are
+    processed by chunks of consecutive tiles along the `curve` (compact areas, see
+    `tilemani.utils.ordering`; None: in the given order). For each chunk, the road graph and bldgs of its whole area are
+    retrieved with one Overpass request (`OverpassClient.retrieve_region`), the graph and bldgs
+    of each tile are cut out of them, and then everything of the chunk is released: its data,
+    the figures left open and its records, which are appended to `records_fp` (see
+    `tilemani.utils.misc.read_records`) instead of being kept.
+    The rss is sampled after each chunk; the chunks are halved while it's over
+    `memory_budget_mb`, and doubled while it's under half of it (see `MemoryBudget`).
+
+    Returns
+    -------
+    - number of records written
+    """
+    network_type = tile_kwargs.get('network_type', 'drive_service')
+    client = OverpassClient(max_slots=overpass_slots)
+    budget = MemoryBudget(memory_budget_mb, chunk_size)
+    instrument = get_instrument()
+    n_records = 0
+    for chunk in chunk_tiles(tiles, budget.chunk_size, curve):
+        region, gdf = client.retrieve_region(tiles_bbox(chunk), chunk, network_type)
+        records = []
+        for tileXYZ in chunk:
+            G_r, bbox = region.tile_subgraph(tileXYZ) if region is not None else (None, tile_bbox(tileXYZ))
+            north, south, east, west = bbox
+            gdf_b = None if gdf is None else gdf.cx[west:east, south:north]
+            records.append(retrieve_and_rasterize_tile(tileXYZ, city, style, retrieved=(G_r, bbox, gdf_b),
+                                                       **tile_kwargs))
+        append_records(records, records_fp)
+        n_records += len(records)
+
+        # release the chunk before loading the next one
+        del region, gdf, records
+        plt.close('all')
+        rss = budget.release()
+        print(f'{n_records} ({len(chunk)} in chunk, next {budget.chunk_size()}, rss={rss / 2**20:.0f}MB)...')
+        print('\n', instrument.format_summary())
+    return n_records
+
+
+def retrieve_and_rasterize_tiles(
+        city: str,
+        style: str,
+        zoom: str,
+        tiles: Iterable[Tuple[int, int, int]],
+        records_dir_root=Path('./temp/records'),
+        progress_every: int = 50,
+        metatile_size: Optional[int] = None,
+        buffer_px: int = 16,
+        codec: Optional[str] = None,
+        compress_level: int = 6,
+        write_workers: int = 4,
+        overpass_slots: Optional[int] = None,
+        prefetch: int = 50,
+        region: Optional[RegionGraph] = None,
+        memory_budget_mb: Optional[float] = None,
+        chunk_size: int = 64,
+        curve: Optional[str] = 'hilbert',
+        pyramid_min_zoom: Optional[int] = None,
+        **tile_kwargs,
+) -> List[Dict]:
+    """Retrieve, rasterize and compute road network stats for each of the maptiles in `tiles`,
+    with `retrieve_and_rasterize_tile`, and save the records of all tiles to a pickle file
+    in `records_dir_root`.
+    If `metatile_size` is given, the tiles are processed by blocks of
+    `metatile_size` x `metatile_size` with `retrieve_and_rasterize_metatile` instead.
+
+    The tiles (or the metatiles) are processed in the order of the `curve` ('hilbert' or 'morton',
+    see `tilemani.utils.ordering`; None keeps the given order), so that consecutive tiles are
+    neighbors and share the cached Overpass responses and ways of their area.
+
+    Per-stage timings (retrieval, each render, each save, stats) and counters
+    (tiles, overpass queries, failures, ...) are collected for this run and written to
+    `records_dir_root`/f'{city}-{style}-{zoom}-metrics.jsonl' (json lines, appended per run)
+    and `records_dir_root`/f'{city}-{style}-{zoom}.prom' (Prometheus textfile).
+    A summary of them is printed every `progress_every` tiles.
+
+    Failures (stage, exception type, retryability, timing) of each tile are appended to the
+    failures table `records_dir_root`/f'{city}-{style}-{zoom}-failures.csv',
+    which `retry_failed_tiles` consumes.
+
+    If `codec` is given (see `tilemani.rasterize.writer`), the tiles rendered as arrays (metatiles,
+    or with batch_render=True) are encoded with it by a `TileWriter` of `write_workers` threads,
+    off the render loop.
+
+    If `overpass_slots` is given (without `metatile_size`), the road graph and bldg geoms of the
+    tiles are retrieved ahead of the render loop by an `OverpassClient` with that many slots:
+    one request per tile for both, `prefetch` tiles at a time.
+    If a `region` graph is given (without `metatile_size` or `memory_budget_mb`), the road graph of
+    each tile is cut out of it (see `tilemani.retrieve.region_graph`) instead of being retrieved;
+    only the bldgs are.
+
+    If `memory_budget_mb` is given (without `metatile_size`), the tiles are streamed by chunks of
+    `chunk_size` tiles along the `curve`, within that rss budget, with `stream_and_rasterize_tiles`:
+    the records are appended to `records_dir_root`/f'{city}-{style}-{zoom}-ver{i}.stream.pkl' chunk by
+    chunk, and not returned.
+
+    If `pyramid_min_zoom` is given, the tiles of the zoom levels below are then built from the
+    rasterized tiles with `build_city_pyramids`, before the failures and metrics are written
+    (so that those of the pyramids are in them).
+
+    Args
+    ----
+    - tile_kwargs: passed to `retrieve_and_rasterize_tile` (e.g. network_type, out_dir_root)
+    """
+    if region is not None and memory_budget_mb is not None and metatile_size is None:
+        raise ValueError("A region graph can't be used in the streaming mode (memory_budget_mb), "
+                         "which retrieves the roads of each chunk from Overpass")
+    mkdir(records_dir_root)
+    instrument = Instrument(run_id=f'{city}-{style}-{zoom}-{time.strftime("%Y%m%d-%H%M%S")}')
+    set_instrument(instrument)
+    failure_log = FailureLog()
+    set_failure_log(failure_log)
+    writer = None
+    if codec is not None:
+        writer = tile_kwargs['writer'] = TileWriter(codec, compress_level, max_workers=write_workers)
+
+    # filename to store the records
     vidx = 0
-    # filename to store
-    records_fn = f'{city}-{style}-{tileXYZ[-1]}-ver{vidx}.pkl'
-    while (records_dir_root / records_fn).exists():
+    records_fn = f'{city}-{style}-{zoom}-ver{vidx}.pkl'
+    while (records_dir_root / records_fn).exists() or (records_dir_root / f'{records_fn[:-4]}.stream.pkl').exists():
         vidx += 1
-        records_fn = f'{city}-{style}-{tileXYZ[-1]}-ver{vidx}.pkl'
+        records_fn = f'{city}-{style}-{zoom}-ver{vidx}.pkl'
         print(f'records file already exists --> Increased the version idx to {vidx}...')
-    joblib.dump(records, records_dir_root / records_fn)
+
+    tiles = list(tiles)
+    if curve is not None:
+        # the aligned blocks of tiles (metatiles) are contiguous along the curve, so their groups follow it too
+        tiles = order_tiles(tiles, curve)
+
+    # list of each record of location (which is a dict)
+    records = []
+    if memory_budget_mb is not None and metatile_size is None:
+        records_fn = f'{records_fn[:-4]}.stream.pkl'
+        stream_and_rasterize_tiles(tiles, city, style, records_dir_root / records_fn, memory_budget_mb,
+                                   chunk_size, curve, overpass_slots or 2, **tile_kwargs)
+    elif metatile_size is None:
+        client = None if overpass_slots is None else OverpassClient(max_slots=overpass_slots)
+        retrieved = {}
+        for i, tileXYZ in enumerate(tiles):
+            if client is not None and i % prefetch == 0:
+                retrieved = client.retrieve_tiles(tiles[i:i + prefetch],
+                                                  tile_kwargs.get('network_type', 'drive_service'))
+            tile_retrieved = retrieved.get(tileXYZ)
+            if region is not None:
+                G_r, bbox = region.tile_subgraph(tileXYZ)
+                gdf_b = tile_retrieved[2] if tile_retrieved is not None else get_geoms(tileXYZ, tag={'building': True})
+                tile_retrieved = (G_r, bbox, gdf_b)
+            record = retrieve_and_rasterize_tile(tileXYZ, city, style, retrieved=tile_retrieved, **tile_kwargs)
+
+            # Append the record to records
+            records.append(record)
+            print(len(records), end="...")
+            if len(records) % progress_every == 0:
+                print('\n', instrument.format_summary())
+    else:
+        metatile_kwargs = {k: v for k, v in tile_kwargs.items() if k not in ('show', 'show_only_once', 'batch_render')}
+        for metatileXYZ, metatile_tiles in group_by_metatile(tiles, metatile_size).items():
+            records.extend(retrieve_and_rasterize_metatile(metatileXYZ, metatile_tiles, city, style,
+                                                           metatile_size, buffer_px, **metatile_kwargs))
+            print(len(records), end="...")
+            print('\n', instrument.format_summary())
+    if writer is not None:
+        # wait for the queued tiles, so that their failures are in the log below
+        writer.close()
+
+    # Write the final `records` to a file
+    if memory_budget_mb is None or metatile_size is not None:
+        joblib.dump(records, records_dir_root / records_fn)
     print(f'\tSaved the final records for {city} to: {records_dir_root / records_fn}')
 
+    if pyramid_min_zoom is not None:
+        build_city_pyramids(city, int(zoom), pyramid_min_zoom, tiles,
+                            tile_kwargs.get('out_dir_root', Path('./temp/images')),
+                            suffix=CODEC_SUFFIX[codec or 'png'])
+
+    # Write the failures, timings and counters of this run
+    failure_log.to_csv(records_dir_root / f'{city}-{style}-{zoom}-failures.csv', verbose=True)
+    print(instrument.format_summary())
+    instrument.to_jsonl(records_dir_root / f'{city}-{style}-{zoom}-metrics.jsonl', verbose=True)
+    instrument.to_prometheus(records_dir_root / f'{city}-{style}-{zoom}.prom', verbose=True)
+
     return records
 
 
+def retrieve_and_rasterize_locs_in_a_folder(
+        city: str,
+        style: str,
+        zoom: str,
+        network_type='drive_service',
+        bgcolors=['k', 'r', 'g', 'b', 'y'],
+        edge_colors=['cyan'],
+        bldg_colors=['silver'],
+        lw_factors=[0.5],
+        save=True,
+        dpi=50,
+        figsize=(7, 7),
+        show=False,  # True,
+        show_only_once=False,
+        verbose=False,  # True,
+        out_dir_root=Path('./temp/images'),
+        records_dir_root=Path('./temp/records'),
+        progress_every: int = 50,
+) -> List[Dict]:
+    """Retrieve, rasterize and compute road network stats for every maptile in
+    DATA_ROOT/city/style/zoom. See `retrieve_and_rasterize_tiles`.
+    """
+    mkdir(out_dir_root)
+
+    img_dir = DATA_ROOT / city / style / zoom
+    if not img_dir.exists():
+        raise ValueError(f"{img_dir} doesn't exist. Check the spelling and upper/lower case of city, style, zoom")
+    if verbose:
+        print(f"Image_dir: ", img_dir)
+    #     breakpoint() #debug
+
+    tiles = []
+    for img_fp in img_dir.iterdir():
+        if not img_fp.is_file(): continue
+        record = parse_maptile_fp(img_fp)
+        tiles.append((record['x'], record['y'], record['z']))
+
+    return retrieve_and_rasterize_tiles(
+        city,
+        style,
+        zoom,
+        tiles,
+        records_dir_root=records_dir_root,
+        progress_every=progress_every,
+        network_type=network_type,
+        bgcolors=bgcolors,
+        edge_colors=edge_colors,
+        bldg_colors=bldg_colors,
+        lw_factors=lw_factors,
+        save=save,
+        dpi=dpi,
+        figsize=figsize,
+        show=show,
+        show_only_once=show_only_once,
+        verbose=verbose,
+        out_dir_root=out_dir_root,
+    )
+
+
+def plan_city_tiles(
+        locations_fn: Path,
+        city: str,
+        zoom: int,
+        network_type='drive_service',
+        probe_zoom: Optional[int] = None,
+) -> List[Tuple[int, int, int]]:
+    """Tiles at `zoom` in the area of the city in the locations json file (e.g. locations/locations.json):
+    its bbox, or its boundary polygon if the entry has a "geometry"/"geojson" (see
+    `tilemani.utils.tiles.location_to_geometry`).
+    If `probe_zoom` is given, the tiles are planned with a quadtree: coarse tiles from `probe_zoom`
+    are probed with an Overpass count of roads and bldgs, and the empty ones are skipped.
+    """
+    area = load_location_geometries(locations_fn, cities=[city])[city]
+    tiles = list(map(tuple, tiles_in_polygon(area, zoom).tolist()))
+    if probe_zoom is None:
+        return tiles
+
+    xmin, ymin, xmax, ymax = area.bounds
+    planned = plan_quadtree((xmin, xmax, ymin, ymax), zoom, osm_count_probe(network_type),
+                            probe_zoom=probe_zoom, area=area)
+    print(f'Planned {len(planned)} of {len(tiles)} tiles in the area of {city}')
+    return planned
+
+
+def build_city_pyramids(
+        city: str,
+        zoom: int,
+        min_zoom: int,
+        tiles: Optional[Iterable[Tuple[int, int, int]]] = None,
+        out_dir_root=Path('./temp/images'),
+        verbose=False,
+        suffix: str = '.png',
+) -> None:
+    """Build the tiles of zoom levels zoom-1 ... min_zoom of every OSMnx* style of the city
+    from its rasterized tiles at `zoom` (see `tilemani.rasterize.pyramid.build_pyramid`).
+    The missing children of a parent are filled with the background color of the style.
+    """
+    for style_dir in sorted((out_dir_root / city).glob('OSMnx*')):
+        bgcolor = style_dir.name.split('-')[1]
+        fill = np.rint(np.array(to_rgba(bgcolor)) * 255)
+        n_built = build_pyramid(style_dir, zoom, min_zoom, suffix, mode='mean', fill=fill, tiles=tiles,
+                                verbose=verbose)
+        print(f'\tPyramid of {style_dir.name}: {n_built}')
+
+
+def retry_failed_tiles(
+        city: str,
+        style: str,
+        zoom: str,
+        max_attempts: int = 5,
+        base_delay: float = 2.,
+        max_delay: float = 120.,
+        records_dir_root=Path('./temp/records'),
+        **tile_kwargs,
+) -> List[FailureRecord]:
+    """Retry-queue mode: re-process only the tiles with retryable failures in the failures table
+    `records_dir_root`/f'{city}-{style}-{zoom}-failures.csv', with exponential backoff.
+    The failures of the new attempts are appended to the same table.
+
+    Args
+    ----
+    - tile_kwargs: passed to `retrieve_and_rasterize_tile` (e.g. network_type, out_dir_root)
+
+    Returns
+    -------
+    - failures of the tiles that still fail
+    """
+    failures_fp = records_dir_root / f'{city}-{style}-{zoom}-failures.csv'
+    instrument = Instrument(run_id=f'{city}-{style}-{zoom}-retry-{time.strftime("%Y%m%d-%H%M%S")}')
+    set_instrument(instrument)
+
+    failures = latest_failures(read_failures(failures_fp))
+    n_tiles = len({r.tileXYZ for r in failures if r.retryable})
+    print(f'{len(failures)} failures in {failures_fp}; retrying {n_tiles} tiles with retryable failures')
+
+    remaining = retry_failures(
+        failures,
+        lambda tileXYZ: retrieve_and_rasterize_tile(tileXYZ, city, style, **tile_kwargs),
+        max_attempts=max_attempts,
+        base_delay=base_delay,
+        max_delay=max_delay,
+        failures_fp=failures_fp,
+    )
+    print(f'{len({r.tileXYZ for r in remaining})} tiles still fail')
+
+    print(instrument.format_summary())
+    instrument.to_jsonl(records_dir_root / f'{city}-{style}-{zoom}-metrics.jsonl', verbose=True)
+    return remaining
+
+
 if __name__ == "__main__":
     # Argument parser
     parser = argparse.ArgumentParser()
@@ -279,27 +758,140 @@ if __name__ == "__main__":
                         help="<Optional> Name of the output folder root. Default: ./temp/images")
     parser.add_argument("--records_dir_root", type=str, default='./temp/records',
                         help="<Optional> Name of the root folder to store 'records'. Default: ./temp/records")
+    parser.add_argument("--locations_fn", type=str, default=None,
+                        help="<Optional> Path to a json file with cityname:bbox (e.g. locations/locations.json). "
+                             "If given, process the tiles in the city's bbox instead of the maptiles in the style folder")
+    parser.add_argument("--probe_zoom", type=int, default=None,
+                        help="<Optional> With --locations_fn, plan the tiles with a quadtree, probing tiles from "
+                             "this zoom level with Overpass counts and skipping the empty ones")
+    parser.add_argument("--metatile_size", type=int, default=None,
+                        help="<Optional> With --locations_fn, retrieve and rasterize the tiles by blocks of "
+                             "metatile_size x metatile_size tiles (a power of 2, e.g. 8), saved as the OSMnxM* styles "
+                             "(exact maptile bounds, at figsize * dpi pixels)")
+    parser.add_argument("--batch_render", action='store_true',
+                        help="<Optional> With --locations_fn, render the styles of each tile with a reused "
+                             "figure/canvas per worker (see tilemani.rasterize.renderer)")
+    parser.add_argument("--codec", type=str, default=None, choices=CODECS,
+                        help="<Optional> With --metatile_size or --batch_render, encode the tiles with this codec "
+                             "in a pool of writer threads (png-palette: indexed png with the colors of each style)")
+    parser.add_argument("--compress_level", type=int, default=6,
+                        help="<Optional> zlib compression level (0-9) of the png codecs. Default: 6")
+    parser.add_argument("--write_workers", type=int, default=4,
+                        help="<Optional> Number of writer threads of --codec. Default: 4")
+    parser.add_argument("--footprint_fill", type=str, default='agg', choices=FOOTPRINT_FILLS,
+                        help="<Optional> With --metatile_size or --batch_render, draw the bldg footprints with "
+                             "matplotlib (agg) or fill them with the vectorized scanline fill (scanline)")
+    parser.add_argument("--simplify_px", type=float, default=None,
+                        help="<Optional> With --locations_fn, clip the roads and bldgs to each tile and simplify "
+                             "them to this many pixels (e.g. 0.5) before rendering")
+    parser.add_argument("--metric_widths", action='store_true',
+                        help="<Optional> With --metatile_size or --batch_render, draw the roads at their width on "
+                             "the ground (from their lanes tag, or their road class) instead of per-type widths in "
+                             "points; lw_factors then scale the true widths")
+    parser.add_argument("--overpass_slots", type=int, default=None,
+                        help="<Optional> With --locations_fn (and no --metatile_size), retrieve the roads and bldgs "
+                             "of each tile with one combined Overpass request, this many requests at once")
+    parser.add_argument("--prefetch", type=int, default=50,
+                        help="<Optional> With --overpass_slots, number of tiles retrieved ahead of the render loop "
+                             "at a time. Default: 50")
+    parser.add_argument("--osm_extract", type=str, default=None,
+                        help="<Optional> With --locations_fn (and no --metatile_size or --memory_budget_mb), path "
+                             "to an .osm extract of the city: its road graph is built once, and the roads of each "
+                             "tile are cut out of it")
+    parser.add_argument("--memory_budget_mb", type=float, default=None,
+                        help="<Optional> With --locations_fn (and no --metatile_size), stream the tiles by spatially "
+                             "coherent chunks, retrieving the area of each chunk at once, within this rss budget")
+    parser.add_argument("--chunk_size", type=int, default=64,
+                        help="<Optional> Size of the first chunk of --memory_budget_mb. Default: 64")
+    parser.add_argument("--curve", type=str, default='hilbert', choices=CURVES + ('none',),
+                        help="<Optional> Space-filling curve along which the tiles are processed, chunked "
+                             "(--memory_budget_mb) and sharded (--shard); none keeps the planned order (the "
+                             "shards are then taken along the hilbert curve). Default: hilbert")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="<Optional> i/n: with --locations_fn, process only the shard i (0-based) of n of the "
+                             "tiles, a contiguous range along --curve (a compact part of the city), and keep its "
+                             "records in records_dir_root/shard-i-of-n (also with --retry_failures)")
+    parser.add_argument("--pyramid_min_zoom", type=int, default=None,
+                        help="<Optional> With --locations_fn, derive the tiles of the zoom levels below --zoom, "
+                             "down to this one, from the rasterized tiles (instead of retrieving and rendering them)")
+    parser.add_argument("--retry_failures", action='store_true',
+                        help="<Optional> Re-process only the tiles with retryable failures in the failures "
+                             "table of this city/style/zoom, with exponential backoff")
+    parser.add_argument("--max_attempts", type=int, default=5,
+                        help="<Optional> Max number of attempts per tile in --retry_failures mode. Default: 5")
 
     args = parser.parse_args()
+    if args.codec == 'png-palette' and args.pyramid_min_zoom is not None:
+        # palette tiles are read back as their indices, which can't be averaged
+        parser.error("--pyramid_min_zoom is not supported with --codec png-palette")
+    if args.osm_extract is not None and args.memory_budget_mb is not None and args.metatile_size is None:
+        # the streaming mode retrieves the roads of each chunk from Overpass
+        parser.error("--osm_extract is not supported with --memory_budget_mb")
     city = args.city
     style = args.style
     zoom = args.zoom
     network_type = args.network_type
+    curve = None if args.curve == 'none' else args.curve
 
     out_dir_root = Path(args.out_dir_root)
     records_dir_root = Path(args.records_dir_root)
+    if args.shard is not None:
+        # the records, failures and metrics of the shards don't collide
+        records_dir_root = records_dir_root / f'shard-{args.shard[0]}-of-{args.shard[1]}'
 
     print("Args: ", args)
     start = time.time()
-    retrieve_and_rasterize_locs_in_a_folder(
-        city,
-        style,
-        zoom,
-        network_type,
-        save=True,
-        verbose=False,
-        out_dir_root=out_dir_root,
-        records_dir_root=records_dir_root)
+    if args.retry_failures:
+        retry_failed_tiles(
+            city,
+            style,
+            zoom,
+            max_attempts=args.max_attempts,
+            records_dir_root=records_dir_root,
+            network_type=network_type,
+            save=True,
+            verbose=False,
+            out_dir_root=out_dir_root)
+    elif args.locations_fn is not None:
+        tiles = plan_city_tiles(Path(args.locations_fn), city, int(zoom), network_type, args.probe_zoom)
+        if args.shard is not None:
+            tiles = shard_tiles(tiles, *args.shard, curve=curve or 'hilbert')
+            print(f'{len(tiles)} tiles in the shard {args.shard[0]}/{args.shard[1]}')
+        retrieve_and_rasterize_tiles(
+            city,
+            style,
+            zoom,
+            tiles,
+            records_dir_root=records_dir_root,
+            metatile_size=args.metatile_size,
+            network_type=network_type,
+            batch_render=args.batch_render,
+            codec=args.codec,
+            compress_level=args.compress_level,
+            write_workers=args.write_workers,
+            overpass_slots=args.overpass_slots,
+            prefetch=args.prefetch,
+            memory_budget_mb=args.memory_budget_mb,
+            chunk_size=args.chunk_size,
+            curve=curve,
+            pyramid_min_zoom=args.pyramid_min_zoom,
+            region=None if args.osm_extract is None else RegionGraph.from_xml(args.osm_extract, network_type),
+            footprint_fill=args.footprint_fill,
+            simplify_px=args.simplify_px,
+            metric_widths=args.metric_widths,
+            save=True,
+            verbose=False,
+            out_dir_root=out_dir_root)
+    else:
+        retrieve_and_rasterize_locs_in_a_folder(
+            city,
+            style,
+            zoom,
+            network_type,
+            save=True,
+            verbose=False,
+            out_dir_root=out_dir_root,
+            records_dir_root=records_dir_root)
 
     print(f"Done: {city}, {style}, {zoom}. Took: {time.time() - start}")
 
@@ -0,0 +1,133 @@
+"""Synthetic OSM fixtures for the tile pipeline benchmarks.
+
+Nothing here touches the network: the road network is built by osmnx from a
+synthetic .osm extract (a regular street grid around the tile), and the building
+footprints are a GeoDataFrame of rectangles (some with courtyards) inside the blocks.
+
+The benchmarks are only collected with `--benchmark-only` (timed), or `--benchmark-disable`
+(each run once, as a smoke test), so that a plain `pytest` run doesn't time them.
+"""
+from pathlib import Path
+from typing import Tuple
+
+import matplotlib
+matplotlib.use('Agg')
+
+import pytest
+import geopandas as gpd
+from shapely.geometry import Polygon, box
+import osmnx as ox
+
+from tilemani.retrieve.retriever import get_road_graph_and_bbox_from_xml
+from tilemani.utils.geo import getGeoFromTile, getTileExtent
+from tilemani.utils.instrument import peak_rss_bytes
+
+ox.config(log_console=False, use_cache=False)
+
+# Paris, the same tile as in tests/test_retriever.py
+TILE_XYZ = (8301, 5639, 14)
+N_STREETS = 24  # per direction
+HIGHWAYS = ['residential', 'primary', 'residential', 'secondary',
+            'service', 'tertiary', 'residential', 'motorway']
+
+
+def _grid_coords(tileXYZ: Tuple[int, int, int], n: int):
+    """Lat/lng of `n` evenly spaced streets in each direction, covering the tile with a margin"""
+    x, y, z = tileXYZ
+    lat0, lng0 = getGeoFromTile(x, y, z)
+    extent, _ = getTileExtent(x, y, z)
+    (north, south, east, west) = ox.utils_geo.bbox_from_point((lat0, lng0), dist=extent * 0.6)
+    lats = [south + (north - south) * i / (n - 1) for i in range(n)]
+    lngs = [west + (east - west) * j / (n - 1) for j in range(n)]
+    return lats, lngs
+
+
+def write_synthetic_osm(fp: Path, tileXYZ: Tuple[int, int, int], n: int = N_STREETS) -> Path:
+    """Write a `n` x `n` street grid around the tile as an .osm xml extract"""
+    lats, lngs = _grid_coords(tileXYZ, n)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<osm version="0.6" generator="tilemani-bench">']
+    node_id = lambda i, j: 1 + i * n + j
+    for i, lat in enumerate(lats):
+        for j, lng in enumerate(lngs):
+            lines.append(f'  <node id="{node_id(i, j)}" lat="{lat:.7f}" lon="{lng:.7f}" version="1"/>')
+
+    way_id = 1
+    for i in range(n):
+        for nds, k in [([node_id(i, j) for j in range(n)], i),
+                       ([node_id(j, i) for j in range(n)], i + 3)]:
+            lines.append(f'  <way id="{way_id}" version="1">')
+            lines.extend(f'    <nd ref="{nd}"/>' for nd in nds)
+            lines.append(f'    <tag k="highway" v="{HIGHWAYS[k % len(HIGHWAYS)]}"/>')
+            lines.append(f'    <tag k="lanes" v="{1 + k % 3}"/>')
+            lines.append('  </way>')
+            way_id += 1
+    lines.append('</osm>')
+
+    fp.write_text('\n'.join(lines))
+    return fp
+
+
+def make_synthetic_bldgs(tileXYZ: Tuple[int, int, int], n: int = N_STREETS,
+                         per_block: int = 2) -> gpd.GeoDataFrame:
+    """`per_block` x `per_block` rectangular footprints inside each block of the street grid.
+    Every third footprint has a courtyard (interior ring)."""
+    lats, lngs = _grid_coords(tileXYZ, n)
+    geoms = []
+    for i in range(n - 1):
+        for j in range(n - 1):
+            s, w = lats[i], lngs[j]
+            dlat = (lats[i + 1] - s) / per_block
+            dlng = (lngs[j + 1] - w) / per_block
+            for a in range(per_block):
+                for b in range(per_block):
+                    b_s, b_w = s + (a + 0.15) * dlat, w + (b + 0.15) * dlng
+                    b_n, b_e = b_s + 0.7 * dlat, b_w + 0.7 * dlng
+                    if len(geoms) % 3 == 0:
+                        hole = box(b_w + 0.25 * dlng, b_s + 0.25 * dlat,
+                                   b_e - 0.25 * dlng, b_n - 0.25 * dlat)
+                        geoms.append(Polygon(box(b_w, b_s, b_e, b_n).exterior.coords,
+                                             [hole.exterior.coords]))
+                    else:
+                        geoms.append(box(b_w, b_s, b_e, b_n))
+    return gpd.GeoDataFrame({'building': ['yes'] * len(geoms)}, geometry=geoms, crs='epsg:4326')
+
+
+def pytest_ignore_collect(collection_path, config):
+    selected = config.getoption('benchmark_only', False) or config.getoption('benchmark_disable', False)
+    if collection_path.name.startswith('test_bench') and not selected:
+        return True
+    return None
+
+
+def report(benchmark, n_tiles: int = 1) -> None:
+    """Attach tiles/sec and peak RSS to the benchmark's json/extra_info report
+    (nothing if the benchmark didn't run, e.g. with --benchmark-disable)"""
+    if benchmark.stats is None:
+        return
+    mean = benchmark.stats.stats.mean
+    benchmark.extra_info['n_tiles'] = n_tiles
+    benchmark.extra_info['tiles_per_sec'] = n_tiles / mean if mean > 0 else float('inf')
+    benchmark.extra_info['peak_rss_mb'] = peak_rss_bytes() / 2**20
+
+
+@pytest.fixture(scope='session')
+def tileXYZ():
+    return TILE_XYZ
+
+
+@pytest.fixture(scope='session')
+def osm_extract(tmp_path_factory):
+    return write_synthetic_osm(tmp_path_factory.mktemp('osm') / 'grid.osm', TILE_XYZ)
+
+
+@pytest.fixture(scope='session')
+def road_graph_and_bbox(osm_extract):
+    G_r, bbox = get_road_graph_and_bbox_from_xml(TILE_XYZ, osm_extract)
+    assert G_r is not None and len(G_r) > 0
+    return G_r, bbox
+
+
+@pytest.fixture(scope='session')
+def gdf_b():
+    return make_synthetic_bldgs(TILE_XYZ)
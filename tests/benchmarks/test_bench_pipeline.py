@@ -0,0 +1,124 @@
+"""Per-stage benchmarks of the tile pipeline on synthetic fixtures (no network).
+
+Run with:
+    pytest tests/benchmarks --benchmark-only --benchmark-json=bench.json
+(or with --benchmark-disable to run each once, untimed; they're not collected otherwise)
+
+Each benchmark reports `tiles_per_sec` and `peak_rss_mb` in its `extra_info`.
+"""
+import json
+from pathlib import Path
+
+import pytest
+import matplotlib.pyplot as plt
+import osmnx as ox
+
+pytest.importorskip("pytest_benchmark")
+
+from tilemani.utils.geo import getTileFromGeo, getGeoFromTile, getTileExtent, parse_maptile_fp
+from tilemani.utils.misc import write_record
+from tilemani.retrieve.retriever import get_road_graph_and_bbox_from_xml
+from tilemani.retrieve.region_graph import RegionGraph
+from tilemani.rasterize.rasterizer import plot_figure_ground, rasterize_road_and_bldg, PreparedGraph
+from tilemani.compute.features import compute_road_network_stats
+
+from .conftest import report
+
+LOCATIONS_FN = Path(__file__).parents[2] / 'locations' / 'paris.json'
+
+
+def test_bench_tile_math(benchmark):
+    geo = json.loads(LOCATIONS_FN.read_text())['paris']
+    z = 14
+
+    def enumerate_tiles():
+        x0, y0, _ = getTileFromGeo(geo['ymin'], geo['xmin'], z)
+        x1, y1, _ = getTileFromGeo(geo['ymax'], geo['xmax'], z)
+        records = []
+        for x in range(min(x0, x1), max(x0, x1) + 1):
+            for y in range(min(y0, y1), max(y0, y1) + 1):
+                getGeoFromTile(x, y, z)
+                getTileExtent(x, y, z)
+                records.append(parse_maptile_fp(Path(f'{x}_{y}_{z}.png')))
+        return records
+
+    records = benchmark(enumerate_tiles)
+    report(benchmark, n_tiles=len(records))
+
+
+def test_bench_retrieve_from_extract(benchmark, tileXYZ, osm_extract):
+    G_r, bbox = benchmark(get_road_graph_and_bbox_from_xml, tileXYZ, osm_extract)
+    assert G_r is not None
+    report(benchmark)
+
+
+def test_bench_tile_subgraph_of_region(benchmark, tileXYZ, osm_extract):
+    # the region graph is built once; only the tile subgraph is per tile
+    region = RegionGraph.from_xml(osm_extract)
+    G_r, bbox = benchmark(region.tile_subgraph, tileXYZ)
+    assert G_r is not None
+    report(benchmark)
+
+
+def test_bench_plot_figure_ground(benchmark, road_graph_and_bbox):
+    G_r, bbox = road_graph_and_bbox
+
+    def plot():
+        f, ax = plot_figure_ground(G_r, bbox=bbox, figsize=(7, 7), bgcolor='k',
+                                   edge_color='w', show=False, close=False, save=False)
+        f.canvas.draw()
+        plt.close(f)
+
+    benchmark(plot)
+    report(benchmark)
+
+
+def test_bench_prepared_graph_styles(benchmark, road_graph_and_bbox):
+    """Preparation of the graph and the per-edge/node widths of 5 lw_factors"""
+    G_r, _ = road_graph_and_bbox
+
+    def prepare():
+        pg = PreparedGraph(G_r)
+        for lw_factor in (0.5, 1., 1.5, 2., 3.):
+            pg.edge_linewidths({'motorway': 6}, 4, lw_factor)
+            pg.node_sizes({'motorway': 6}, 4, lw_factor)
+
+    benchmark(prepare)
+    report(benchmark)
+
+
+def test_bench_rasterize_road_and_bldg(benchmark, tmp_path, tileXYZ, road_graph_and_bbox, gdf_b):
+    G_r, bbox = road_graph_and_bbox
+
+    def rasterize():
+        rasterize_road_and_bldg(G_r, gdf_b, tileXYZ, bbox,
+                                bgcolors=['k'], edge_colors=['cyan'], bldg_colors=['silver'],
+                                lw_factors=[0.5], save=True, out_dir_root=tmp_path,
+                                show=False, show_only_once=False, dpi=50)
+
+    benchmark(rasterize)
+    report(benchmark)
+    assert any(tmp_path.rglob('*.png'))
+
+
+def test_bench_compute_road_network_stats(benchmark, road_graph_and_bbox):
+    G_r, _ = road_graph_and_bbox
+    stats = benchmark(compute_road_network_stats, G_r)
+    assert stats['n_nodes'] == len(G_r)
+    report(benchmark)
+
+
+def test_bench_output_writers(benchmark, tmp_path, tileXYZ, road_graph_and_bbox, gdf_b):
+    G_r, _ = road_graph_and_bbox
+    x, y, z = tileXYZ
+    filename = f'{x}_{y}_{z}'
+    record = parse_maptile_fp(Path(f'{filename}.png'))
+
+    def write_outputs():
+        ox.save_graphml(G_r, filepath=tmp_path / 'RoadGraph' / f'{filename}.graphml')
+        _gdf = gdf_b.apply(lambda c: c.astype(str) if c.name != "geometry" else c, axis=0)
+        _gdf.to_file(tmp_path / f'{filename}.geojson', driver='GeoJSON')
+        write_record(record, tmp_path / f'{filename}.csv')
+
+    benchmark(write_outputs)
+    report(benchmark)
@@ -0,0 +1,136 @@
+import io
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tilemani.retrieve.downloader import RateLimiter, TileDownloader
+from tilemani.retrieve.tile_sources import (TILE_PROVIDERS, TileProvider, add_blank_tiles, get_provider,
+                                            get_tile_source, image_signature, is_blank_image, register_provider)
+from tilemani.utils.failures import FailureLog, set_failure_log
+from tilemani.utils.ordering import order_tiles
+
+
+def _png(blank: bool) -> bytes:
+    arr = np.zeros((8, 8, 3), dtype=np.uint8)
+    if not blank:
+        arr[2:4, 2:6] = 255
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class FakeServer:
+    """Serves tiles by url, recording the max number of concurrent requests and the hosts"""
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.active = self.max_active = 0
+        self.hosts = Counter()
+        self._lock = threading.Lock()
+
+    def fetch(self, url: str) -> bytes:
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.hosts[url.split('/')[2]] += 1
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+        z, x, y = map(int, url.rsplit('.', 1)[0].split('/')[-3:])
+        if x == 0:
+            raise ConnectionError('refused')
+        return _png(blank=y == 0)
+
+
+def test_registry():
+    carto = get_provider('CARTO')
+    assert carto.url('light_no_labels', 1, 2, 3) == 'https://d.basemaps.cartocdn.com/light_nolabels/3/1/2.png'
+    assert get_tile_source('StamenTonerBackground') == (get_provider('stamen'), 'toner_background')
+    with pytest.raises(ValueError):
+        get_provider('nowhere')
+    with pytest.raises(ValueError):
+        carto.url('watercolor', 1, 2, 3)
+    assert is_blank_image(_png(True)) and not is_blank_image(_png(False))
+    provider = TileProvider('Local', {'default': 'x'}, blank_signatures=frozenset([image_signature(_png(False))]))
+    assert provider.is_blank(_png(False))
+
+
+def test_add_blank_tiles(tmp_path):
+    placeholder = tmp_path / 'placeholder.png'
+    placeholder.write_bytes(_png(False))
+    register_provider(TileProvider('Local', {'default': 'x'}))
+    assert not get_provider('local').is_blank(_png(False))
+    provider = add_blank_tiles('local', [placeholder])
+    assert get_provider('local') is provider and provider.is_blank(_png(False))
+    TILE_PROVIDERS.pop('local')
+
+
+def test_download_within_provider_limits(tmp_path):
+    provider = TileProvider('Local', {'default': 'http://{s}.local/{Z}/{X}/{Y}.png'},
+                            subdomains=('a', 'b'), max_concurrency=3, requests_per_sec=0)
+    server = FakeServer()
+    tiles = [(x, y, 5) for x in range(5) for y in range(4)]
+    log = FailureLog(verbose=False)
+    previous = set_failure_log(log)
+    try:
+        stats = TileDownloader(max_workers=8, fetch=server.fetch).download(provider, 'default', tiles, tmp_path)
+    finally:
+        set_failure_log(previous)
+
+    assert stats == Counter(downloaded=12, blank=4, failed=4)
+    assert server.max_active == 3
+    assert server.hosts == Counter({'a.local': 10, 'b.local': 10})
+    assert len(log) == 4 and all(r.stage == 'download' and r.x == 0 for r in log.records)
+    assert (tmp_path / '1_1_5.png').read_bytes() == _png(False)
+    assert not (tmp_path / '1_0_5.png').exists()
+    assert len((tmp_path / 'lnglat' / '1_1_5.txt').read_text().splitlines()) == 4
+
+
+def test_download_in_hilbert_order(tmp_path):
+    provider = TileProvider('Local', {'default': 'http://local/{Z}/{X}/{Y}.png'}, requests_per_sec=0)
+    requested = []
+
+    def fetch(url):
+        z, x, y = map(int, url.rsplit('.', 1)[0].split('/')[-3:])
+        requested.append((x, y, z))
+        return _png(blank=False)
+
+    tiles = [(x, y, 2) for x in range(4) for y in range(4)]
+    TileDownloader(max_workers=1, fetch=fetch).download(provider, 'default', tiles, tmp_path)
+    assert requested == order_tiles(tiles) and requested != tiles
+    # consecutive requests are for neighboring tiles
+    assert all(abs(x0 - x1) + abs(y0 - y1) == 1 for (x0, y0, _), (x1, y1, _) in zip(requested, requested[1:]))
+
+def test_rate_limiter_paces_calls_across_threads():
+    limiter = RateLimiter(50)
+    start = time.monotonic()
+    threads = [threading.Thread(target=limiter.wait) for _ in range(11)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 11 calls at 50/s: the last one is 10 intervals after the first
+    assert time.monotonic() - start >= 10 / 50 - 0.01
+
+
+def test_co_fetch_prunes_blank_tiles_of_pruners(tmp_path):
+    imagery = TileProvider('Sat', {'imagery': 'http://sat.local/{Z}/{X}/{Y}.png'}, max_concurrency=2,
+                           requests_per_sec=0)
+    roads = TileProvider('Map', {'light': 'http://map.local/{Z}/{X}/{Y}.png',
+                                 'dark': 'http://map.local/{Z}/{X}/{Y}.png'}, max_concurrency=2,
+                         requests_per_sec=0)
+    server = FakeServer(delay=0)
+    sources = [(roads, 'light', tmp_path / 'light'), (roads, 'dark', tmp_path / 'dark'),
+               (imagery, 'imagery', tmp_path / 'imagery')]
+    tiles = [(x, y, 5) for x in range(1, 4) for y in range(3)]
+    stats = TileDownloader(fetch=server.fetch).co_fetch(sources, tiles, pruners=['satimagery'])
+
+    # the y == 0 tiles are blank in the imagery: they are not requested in the other styles
+    assert stats['SatImagery'] == Counter(downloaded=6, blank=3)
+    assert stats['MapLight'] == stats['MapDark'] == Counter(downloaded=6, pruned=3)
+    assert sum(server.hosts.values()) == 9 + 2 * 6
+    assert (tmp_path / 'dark' / '1_1_5.png').exists() and not (tmp_path / 'dark' / '1_0_5.png').exists()
@@ -0,0 +1,44 @@
+import socket
+
+from tilemani.utils.failures import (FailureLog, set_failure_log, capture, read_failures,
+                                     retry_failures, is_retryable)
+
+
+def test_capture_records_typed_failures_and_skips_empty_areas(tmp_path):
+    log = FailureLog(verbose=False)
+    previous = set_failure_log(log)
+    try:
+        with capture((1, 2, 3), 'retrieve_road'):
+            raise socket.timeout('timed out')
+        with capture((1, 2, 3), 'save_geojson'):
+            raise KeyError('geometry')
+        with capture((4, 5, 6), 'retrieve_road'):
+            raise ValueError('There are no data elements in the response JSON')
+    finally:
+        set_failure_log(previous)
+
+    assert [(r.tileXYZ, r.stage, r.retryable) for r in log.records] == [
+        ((1, 2, 3), 'retrieve_road', True),
+        ((1, 2, 3), 'save_geojson', False),
+    ]
+    log.to_csv(tmp_path / 'failures.csv')
+    assert read_failures(tmp_path / 'failures.csv') == log.records
+
+
+def test_retry_failures_only_retries_retryable_tiles_with_backoff():
+    log = FailureLog(verbose=False)
+    log.add_exception((1, 1, 1), 'retrieve_road', ConnectionError())
+    log.add_exception((2, 2, 2), 'save_geojson', KeyError('geometry'))
+    assert not is_retryable(KeyError('geometry'))
+
+    calls = []
+
+    def process_tile(tileXYZ):
+        calls.append(tileXYZ)
+        if len(calls) < 3:  # fails twice, then succeeds
+            with capture(tileXYZ, 'retrieve_road'):
+                raise ConnectionError()
+
+    remaining = retry_failures(log.records, process_tile, base_delay=0.001, verbose=False)
+    assert calls == [(1, 1, 1)] * 3
+    assert remaining == []
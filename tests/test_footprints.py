@@ -0,0 +1,50 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from tilemani.rasterize.footprints import rasterize_footprints, composite, solid
+from tilemani.rasterize.renderer import BatchRenderer, footprint_layer
+from tilemani.utils.tiles import lnglat_to_mercator
+
+# lng/lat extent of a 40 x 40 px image
+WEST, SOUTH, EAST, NORTH = 2.30, 48.80, 2.32, 48.82
+(XMIN, XMAX), (YMIN, YMAX) = lnglat_to_mercator([WEST, EAST], [SOUTH, NORTH])
+EXTENT = (XMIN, YMIN, XMAX, YMAX)
+
+
+def _footprints():
+    """A courtyard bldg (rings of the same orientation), an overlapping one, a multipolygon and
+    a triangle"""
+    outer, inner = box(2.302, 48.802, 2.310, 48.810), box(2.305, 48.805, 2.307, 48.807)
+    courtyard = Polygon(outer.exterior.coords, [inner.exterior.coords])
+    overlapping = box(2.308, 48.803, 2.312, 48.806)
+    multi = MultiPolygon([box(2.314, 48.814, 2.316, 48.816), box(2.317, 48.814, 2.319, 48.818)])
+    triangle = Polygon([(2.302, 48.814), (2.308, 48.814), (2.302, 48.818)])
+    return gpd.GeoDataFrame(geometry=[courtyard, overlapping, multi, triangle], crs='epsg:4326')
+
+
+def test_scanline_fill_matches_agg():
+    gdf_b = _footprints()
+    coverage = rasterize_footprints(gdf_b, EXTENT, 40, 40)
+    assert coverage[27, 11] == 0 and coverage[27, 5] == 1  # courtyard
+    assert coverage[31, 17] == 1 and coverage[31, 21] == 1  # overlap of two bldgs stays filled
+    assert coverage[:, :4].sum() == 0 and coverage[:, 38:].sum() == 0
+
+    renderer = BatchRenderer(40, 40, dpi=50)
+    renderer.set_extent(*EXTENT)
+    renderer.set_footprints(*footprint_layer(gdf_b))
+    agg = renderer.render('k', None, 'w')[..., 0] > 127
+    assert (agg != (coverage > 0)).sum() <= 4  # only at edges through pixel centers
+
+    renderer.fill_footprints(gdf_b)
+    assert np.array_equal(renderer.render('k', None, 'w'), composite(solid(40, 40, 'k'), coverage, 'w'))
+
+
+def test_supersampled_coverage():
+    coverage = rasterize_footprints(_footprints(), EXTENT, 40, 40, supersample=4)
+    assert coverage.shape == (40, 40) and coverage.dtype == np.float32
+    partial = (coverage > 0) & (coverage < 1)
+    assert partial.any() and np.array_equal(partial, partial & (np.arange(40) < 16))  # triangle only
@@ -0,0 +1,64 @@
+import gc
+import threading
+
+import networkx as nx
+
+from tilemani.utils.graph import UndirectedCache, touch_graph, get_undirected
+
+
+def _graph():
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_node(0, x=0, y=0)
+    G.add_node(1, x=1, y=0)
+    G.add_edge(0, 1, osmid=1, highway='residential')
+    G.add_edge(1, 0, osmid=1, highway='residential')
+    return G
+
+
+def test_undirected_cache_hits_and_invalidation():
+    cache = UndirectedCache(maxsize=2)
+    G = _graph()
+    Gu = cache.get(G)
+    assert Gu.number_of_edges() == 1 and not Gu.is_directed()
+    assert cache.get(G) is Gu
+
+    touch_graph(G)
+    assert cache.get(G) is not Gu
+    Gu = cache.get(G)
+    G.add_edge(0, 1, key=5, osmid=2, highway='primary')  # modified without touch_graph
+    assert cache.get(G) is not Gu
+
+    Gu = cache.get(G)
+    cache.invalidate(G)
+    assert cache.get(G) is not Gu
+
+
+def test_undirected_cache_is_bounded_and_drops_collected_graphs():
+    cache = UndirectedCache(maxsize=2)
+    graphs = [_graph() for _ in range(3)]
+    for G in graphs:
+        cache.get(G)
+    assert len(cache) == 2
+
+    del graphs[:], G
+    gc.collect()
+    assert len(cache) == 0
+
+    Gu = get_undirected(_graph())
+    assert get_undirected(Gu) is Gu
+
+
+def test_graph_collected_while_the_lock_is_held():
+    cache = UndirectedCache()
+    G = _graph()
+    G.cycle = G  # a reference cycle: only the cyclic gc collects it
+    cache.get(G)
+    del G
+    result = []
+    # the weakref callback runs on this thread while the lock is held: it must not take it
+    worker = threading.Thread(target=lambda: (cache._lock.acquire(), gc.collect(), cache._lock.release(),
+                                              result.append(True)), daemon=True)
+    worker.start()
+    worker.join(timeout=10)
+    assert result, 'deadlock in the weakref callback'
+    assert len(cache) == 0
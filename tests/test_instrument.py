@@ -0,0 +1,82 @@
+import json
+import sys
+import threading
+
+from tilemani.utils.instrument import Instrument, MemoryBudget, set_instrument, timer, timed, count
+
+
+def test_timer_and_counters_exports(tmp_path):
+    instrument = Instrument(run_id='test', keep_events=True)
+    previous = set_instrument(instrument)
+    try:
+        @timed('stats')
+        def f():
+            return 1
+
+        with timer('retrieve_road', tile='1_2_3'):
+            count('overpass_queries')
+        f()
+        f()
+        count('blank_tiles', 2)
+    finally:
+        set_instrument(previous)
+
+    summary = instrument.summary()
+    assert summary['stages']['stats']['calls'] == 2
+    assert summary['stages']['retrieve_road']['calls'] == 1
+    assert summary['counters'] == {'overpass_queries': 1, 'blank_tiles': 2}
+
+    instrument.to_jsonl(tmp_path / 'metrics.jsonl')
+    lines = [json.loads(l) for l in (tmp_path / 'metrics.jsonl').read_text().splitlines()]
+    assert {l['kind'] for l in lines} == {'stage', 'counters', 'event'}
+    assert [l['tile'] for l in lines if l['kind'] == 'event' and l['stage'] == 'retrieve_road'] == ['1_2_3']
+
+    instrument.to_prometheus(tmp_path / 'metrics.prom')
+    prom = (tmp_path / 'metrics.prom').read_text()
+    assert 'tilemani_stage_calls_total{run_id="test",stage="stats"} 2' in prom
+    assert 'tilemani_events_total{run_id="test",event="blank_tiles"} 2' in prom
+
+
+def test_memory_budget_adapts_chunk_size():
+    instrument = Instrument(run_id='test')
+    previous = set_instrument(instrument)
+    try:
+        tight = MemoryBudget(budget_mb=1, chunk_size=8, min_size=2)  # any process is over 1MB
+        sizes = []
+        for _ in range(4):
+            tight.release()
+            sizes.append(tight.chunk_size())
+        loose = MemoryBudget(budget_mb=2**30, chunk_size=8, max_size=20)
+        loose.release()
+        loose.release()
+    finally:
+        set_instrument(previous)
+
+    assert sizes == [4, 2, 2, 2] and tight.exceeded
+    assert loose.chunk_size() == 20 and not loose.exceeded
+    assert instrument.counters == {'chunks': 6, 'memory_budget_exceeded': 4}
+    assert instrument.max_rss > 0
+
+
+def test_concurrent_updates_are_not_lost():
+    instrument = Instrument(run_id='test')
+    n_threads, n = 8, 5000
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    try:
+        def work():
+            for _ in range(n):
+                instrument.count('tiles')
+                instrument.add_timing('download', 0.001)
+
+        threads = [threading.Thread(target=work) for _ in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    summary = instrument.summary()
+    assert summary['counters']['tiles'] == n_threads * n
+    assert summary['stages']['download']['calls'] == n_threads * n
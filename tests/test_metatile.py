@@ -0,0 +1,71 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import networkx as nx
+import numpy as np
+import osmnx as ox
+from PIL import Image
+
+from tilemani.rasterize.metatile import (get_metatile, metatile_tiles, group_by_metatile, metatile_bbox,
+                                         render_metatile, slice_metatile, rasterize_metatile)
+from tilemani.rasterize.rasterizer import rasterize_road_and_bldg
+from tilemani.utils.geo import get_latlng_and_radius
+from tilemani.utils.tiles import get_tile_bbox
+
+
+def _road_across(bbox, highway='primary'):
+    """A road graph with one street crossing the bbox from west to east, at its middle latitude"""
+    north, south, east, west = bbox
+    lat = (north + south) / 2
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_node(1, x=west - 0.01, y=lat)
+    G.add_node(2, x=east + 0.01, y=lat)
+    G.add_edge(1, 2, highway=highway)
+    G.add_edge(2, 1, highway=highway)
+    return G
+
+
+def test_metatile_tiles_and_grouping():
+    tile = (8301, 5639, 14)
+    metatile = get_metatile(tile, n=8)
+    assert metatile == (8301 >> 3, 5639 >> 3, 11)
+    assert tile in metatile_tiles(metatile, 8) and len(metatile_tiles(metatile, 8)) == 64
+    assert np.allclose(metatile_bbox(metatile, 8), get_tile_bbox(metatile))
+
+    groups = group_by_metatile([tile, (8300, 5639, 14), (8400, 5639, 14)], n=8)
+    assert groups[metatile] == [tile, (8300, 5639, 14)]
+
+
+def test_render_metatile_is_seamless_across_tiles():
+    metatile = (4150, 2819, 13)
+    G = _road_across(metatile_bbox(metatile, n=2))
+    img = render_metatile(G, None, metatile, n=2, tile_px=64, buffer_px=8, dpi=50,
+                          bgcolor='k', edge_color='w')
+    assert img.shape == (128, 128, 4)
+
+    tiles = slice_metatile(img, metatile, n=2)
+    assert sorted(tiles) == sorted(metatile_tiles(metatile, 2))
+    # the street runs along the border between the top and bottom rows of tiles
+    top, bottom = tiles[(8300, 5638, 14)], tiles[(8300, 5639, 14)]
+    assert top[-1, :, 0].min() > 0 and bottom[0, :, 0].min() > 0
+    # and continues without a cut from the left to the right column of tiles
+    assert np.array_equal(top[-1, -1], tiles[(8301, 5638, 14)][-1, 0])
+
+
+def test_metatile_and_per_tile_modes_write_distinct_styles(tmp_path):
+    tile = (8301, 5639, 14)
+    G = _road_across(get_tile_bbox(tile))
+    lat, lng, radius = get_latlng_and_radius(tile)
+    rasterize_road_and_bldg(G, None, tile, ox.utils_geo.bbox_from_point((lat, lng), dist=radius),
+                            ['k'], ['w'], ['silver'], [0.5], True, tmp_path, show=False)
+    n_saved = rasterize_metatile(G, None, tile, 1, ['k'], ['w'], ['silver'], [0.5], True, tmp_path)
+    assert n_saved == {'OSMnxMR-k-w-0.5': 1}
+
+    per_tile = np.asarray(Image.open(tmp_path / 'OSMnxR-k-w-0.5' / '14' / '8301_5639_14.png'))
+    metatile = np.asarray(Image.open(tmp_path / 'OSMnxMR-k-w-0.5' / '14' / '8301_5639_14.png'))
+    # the per-tile image is the retriever's bbox cropped to the axes, the metatile one the exact
+    # tile bounds at figsize * dpi: they differ in size and extent
+    assert metatile.shape[:2] == (350, 350) and per_tile.shape[:2] != metatile.shape[:2]
+    # the street crosses the middle of the tile, i.e. the bottom edge of the per-tile bbox
+    mid = metatile.shape[0] // 2
+    assert metatile[mid, :, 0].min() > 0 and per_tile[per_tile.shape[0] // 2, :, 0].max() == 0
@@ -0,0 +1,39 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+from matplotlib.figure import Figure
+from PIL import Image
+
+from tilemani.utils.np import fig_to_np, figs_to_np, fig_shape, plt_figure_to_np
+
+
+def _fig(color, size=(1, 0.5), dpi=40):
+    fig = Figure(figsize=size, dpi=dpi, facecolor=color)
+    fig.add_axes([0.25, 0.25, 0.5, 0.5]).set_axis_off()
+    return fig
+
+
+def test_fig_to_np_channels_and_out():
+    fig = _fig('tab:orange')
+    rgba = fig_to_np(fig)
+    assert rgba.shape == fig_shape(fig) == (20, 40, 4)
+    assert np.shares_memory(rgba, np.asarray(fig.canvas.buffer_rgba()))
+
+    rgb = fig_to_np(fig, 'rgb', draw=False)
+    assert rgb.shape == (20, 40, 3) and np.array_equal(rgb, rgba[..., :3])
+
+    out = np.zeros(fig_shape(fig, 'gray'), dtype=np.uint8)
+    gray = fig_to_np(fig, 'gray', out=out)
+    assert gray is out
+    assert np.array_equal(gray, np.asarray(Image.fromarray(np.ascontiguousarray(rgb)).convert('L')))
+
+
+def test_figs_to_np_and_legacy():
+    figs = [_fig(c) for c in ('k', 'w', 'r')]
+    stack = figs_to_np(figs, 'rgb')
+    assert stack.shape == (3, 20, 40, 3)
+    assert stack[0].max() == 0 and stack[1].min() == 255 and tuple(stack[2, 0, 0]) == (255, 0, 0)
+
+    img = plt_figure_to_np(figs[2], dpi=80)
+    assert img.shape == (40, 80, 4) and figs[2].dpi == 40
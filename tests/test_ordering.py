@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from tilemani.utils.ordering import (chunk_tiles, curve_codes, hilbert_codes, morton_codes, order_tiles,
+                                     parse_shard, shard_tiles)
+
+
+def test_morton_codes_interleave_bits():
+    assert morton_codes(np.array([0, 1, 0, 1, 3, 2**20]), np.array([0, 0, 1, 1, 3, 0])).tolist() == \
+        [0, 1, 2, 3, 15, 2**40]
+
+
+def test_hilbert_codes_walk_neighbors():
+    order = 4
+    xs, ys = (a.ravel() for a in np.meshgrid(np.arange(2**order), np.arange(2**order), indexing='ij'))
+    codes = hilbert_codes(xs, ys, order)
+    assert sorted(codes.tolist()) == list(range(4**order))
+    walk = np.argsort(codes)
+    steps = np.abs(np.diff(xs[walk])) + np.abs(np.diff(ys[walk]))
+    assert (steps == 1).all()
+    assert hilbert_codes(np.array([0, 0, 1, 1]), np.array([0, 1, 1, 0]), 1).tolist() == [0, 1, 2, 3]
+
+
+def test_order_and_chunk_tiles():
+    tiles = [(x, y, 3) for x in range(8) for y in range(8)] + [(0, 0, 2)]
+    ordered = order_tiles(tiles[::-1], curve='hilbert')
+    assert ordered[0] == (0, 0, 2) and sorted(ordered) == sorted(tiles)
+    assert (curve_codes(ordered[1:]) == np.arange(64)).all()
+
+    # chunks of a hilbert order are compact: 16 tiles in a 4x4 quadrant
+    chunks = list(chunk_tiles(tiles[:-1], 16))
+    assert [len(c) for c in chunks] == [16] * 4
+    for chunk in chunks:
+        xs, ys, _ = np.array(chunk).T
+        assert np.ptp(xs) == 3 and np.ptp(ys) == 3
+
+    sizes = iter([1, 2, 100])
+    assert [len(c) for c in chunk_tiles(tiles, lambda: next(sizes), curve='morton')] == [1, 2, 62]
+    with pytest.raises(ValueError):
+        curve_codes(tiles, curve='peano')
+
+
+def test_shards_are_compact_ranges_of_the_order():
+    tiles = [(x, y, 3) for x in range(8) for y in range(8)]
+    shards = [shard_tiles(tiles[::-1], i, 4) for i in range(4)]
+    assert sum(shards, []) == order_tiles(tiles)
+    for shard in shards:
+        xs, ys, _ = np.array(shard).T
+        assert np.ptp(xs) == 3 and np.ptp(ys) == 3
+    assert [len(shard_tiles(tiles[:10], i, 4)) for i in range(4)] == [2, 3, 3, 2]
+
+    assert parse_shard('2/8') == (2, 8)
+    for spec in ['8/8', '2', 'a/b']:
+        with pytest.raises(ValueError):
+            parse_shard(spec)
+
+
+def test_chunks_in_the_given_order():
+    tiles = [(x, y, 3) for x in range(8) for y in range(8)][::-1]
+    assert sum(chunk_tiles(tiles, 10, curve=None), []) == tiles
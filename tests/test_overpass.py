@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from tilemani.retrieve.overpass import OverpassClient, SPLIT_MARKER, split_response, tile_bbox, tiles_bbox
+from tilemani.utils.failures import FailureLog, set_failure_log
+
+TILES = [(66400, 45100, 17), (66401, 45100, 17), (66402, 45100, 17)]
+
+
+def _area_elements(bbox):
+    """A road (3 nodes) across the bbox and a square bldg in it, ids offset by the bbox"""
+    north, south, east, west = bbox
+    lat, lng = (north + south) / 2, (east + west) / 2
+    dlat, dlng = (north - south) / 4, (east - west) / 4
+    base = int(abs(lng) * 1e6) * 100
+    nodes = [(base + i, lat + a * dlat, lng + b * dlng)
+             for i, (a, b) in enumerate([(0, -1.5), (0, 0), (0, 1.5), (1, 1), (1, 1.5), (1.5, 1.5), (1.5, 1)])]
+    elem = [{'type': 'node', 'id': i, 'lat': la, 'lon': lo} for i, la, lo in nodes]
+    road = {'type': 'way', 'id': base, 'nodes': [base, base + 1, base + 2], 'tags': {'highway': 'residential'}}
+    bldg = {'type': 'way', 'id': base + 1, 'nodes': [base + 3, base + 4, base + 5, base + 6, base + 3],
+            'tags': {'building': 'yes'}}
+    return elem[:3] + [road, {'type': SPLIT_MARKER, 'id': 1, 'tags': {}}] + elem[3:] + [bldg]
+
+
+class FakeOverpass:
+    """Local Overpass server: answers the combined queries of the tiles in TILES (or of any other
+    area, with the elements of all of them) after a delay, and rejects the first `n_reject`
+    requests with a 429"""
+
+    def __init__(self, delay=0.2, n_reject=0):
+        self.delay, self.n_reject = delay, n_reject
+        self.queries, self.active, self.max_active = [], 0, 0
+        self.lock = threading.Lock()
+        areas = {tile_bbox(t): _area_elements(tile_bbox(t)) for t in TILES}
+        split = [e['type'] == SPLIT_MARKER for e in _area_elements(tile_bbox(TILES[0]))].index(True)
+        everything = ([e for els in areas.values() for e in els[:split]] + [{'type': SPLIT_MARKER, 'id': 1}]
+                      + [e for els in areas.values() for e in els[split + 1:]])
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                query = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())['data'][0]
+                with fake.lock:
+                    fake.queries.append(query)
+                    reject = len(fake.queries) <= fake.n_reject
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                time.sleep(fake.delay)
+                with fake.lock:
+                    fake.active -= 1
+                if reject:
+                    self.send_response(429)
+                    self.end_headers()
+                    return
+                bbox = next((b for b in areas if f'({b[1]:.7f},{b[3]:.7f},{b[0]:.7f},{b[2]:.7f})' in query), None)
+                body = json.dumps({'version': 0.6, 'elements': areas.get(bbox, everything)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/api'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def failure_log():
+    log = FailureLog(verbose=False)
+    previous = set_failure_log(log)
+    yield log
+    set_failure_log(previous)
+
+
+def test_one_coalesced_request_per_area_within_slots(failure_log):
+    fake = FakeOverpass()
+    try:
+        results = OverpassClient(fake.url, max_slots=2).retrieve_tiles(TILES + TILES[:2])
+    finally:
+        fake.close()
+
+    assert len(fake.queries) == 3 and fake.max_active == 2
+    assert not len(failure_log)
+    for tileXYZ in TILES:
+        G_r, bbox, gdf = results[tileXYZ]
+        assert bbox == tile_bbox(tileXYZ)
+        assert G_r.number_of_nodes() == 2 and G_r.number_of_edges() == 2  # simplified, both ways
+        assert len(gdf) == 1 and gdf.iloc[0]['building'] == 'yes'
+
+
+def test_retries_rate_limited_requests(failure_log):
+    fake = FakeOverpass(delay=0, n_reject=1)
+    try:
+        results = OverpassClient(fake.url, base_delay=0.01).retrieve_tiles(TILES[:1])
+    finally:
+        fake.close()
+    assert len(fake.queries) == 2 and not len(failure_log)
+    assert results[TILES[0]][0] is not None
+
+
+def test_split_response():
+    roads, geoms = split_response({'elements': _area_elements(tile_bbox(TILES[0]))})
+    assert [e['type'] for e in roads['elements']] == ['node'] * 3 + ['way']
+    assert [e['type'] for e in geoms['elements']] == ['node'] * 4 + ['way']
+    with pytest.raises(ValueError):
+        split_response({'elements': []})
+
+
+def test_region_of_a_chunk_with_one_request(failure_log):
+    fake = FakeOverpass(delay=0)
+    try:
+        region, gdf = OverpassClient(fake.url).retrieve_region(tiles_bbox(TILES), TILES)
+    finally:
+        fake.close()
+
+    assert len(fake.queries) == 1 and not len(failure_log)
+    assert len(gdf) == len(TILES)
+    for tileXYZ in TILES:
+        G_r, bbox = region.tile_subgraph(tileXYZ)
+        north, south, east, west = bbox
+        assert G_r.number_of_edges() == 2 and len(gdf.cx[west:east, south:north]) == 1
+
+
+def test_region_failure_is_recorded_for_each_tile(failure_log):
+    def refuse(url, query, timeout):
+        raise ConnectionError('refused')
+
+    region, gdf = OverpassClient(post=refuse, max_retries=0).retrieve_region(tiles_bbox(TILES), TILES)
+    assert region is None and gdf is None
+    assert sorted(failure_log.tiles()) == sorted(TILES)
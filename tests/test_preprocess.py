@@ -0,0 +1,49 @@
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+import shapely
+from shapely.geometry import LineString, Polygon, box
+
+from tilemani.retrieve.preprocess import pixel_size, preprocess_geoms, preprocess_graph
+
+BBOX = (48.82, 48.80, 2.32, 2.30)  # north, south, east, west
+SIZE_PX = 200  # 1e-4 degree per pixel
+
+
+def _dense_ring(west, south, east, north, n=400):
+    """Closed ring of a box with `n` vertices per side"""
+    t = np.linspace(0, 1, n, endpoint=False)
+    xs = np.concatenate([west + (east - west) * t, np.full(n, east), east - (east - west) * t, np.full(n, west)])
+    ys = np.concatenate([np.full(n, south), south + (north - south) * t, np.full(n, north), north - (north - south) * t])
+    return np.column_stack([xs, ys])
+
+
+def test_preprocess_geoms_clips_and_simplifies():
+    courtyard = Polygon(_dense_ring(2.305, 48.805, 2.315, 48.815), [_dense_ring(2.309, 48.809, 2.311, 48.811)])
+    across = box(2.31, 48.81, 2.33, 48.83)  # crosses the north-east corner
+    far = box(2.40, 48.90, 2.41, 48.91)
+    gdf = gpd.GeoDataFrame({'name': ['a', 'b', 'c']}, geometry=[courtyard, across, far], crs='epsg:4326')
+
+    out = preprocess_geoms(gdf, BBOX, SIZE_PX)
+    assert out['name'].tolist() == ['a', 'b'] and out.crs == gdf.crs
+    assert shapely.get_num_coordinates(out.geometry.values[0]) == 10  # two boxes, hole kept
+    margin = 4 * pixel_size(BBOX, SIZE_PX)
+    assert np.allclose(out.geometry.values[1].bounds, (2.31, 48.81, 2.32 + margin, 48.82 + margin))
+
+
+def test_preprocess_graph_keeps_edges_through_the_bbox():
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_node(1, x=2.25, y=48.81)
+    G.add_node(2, x=2.35, y=48.81)
+    G.add_node(3, x=2.40, y=48.90)
+    G.add_node(4, x=2.41, y=48.90)
+    wiggly = LineString([(2.25 + 0.1 * t, 48.81 + 1e-6 * np.sin(50 * t)) for t in np.linspace(0, 1, 500)])
+    G.add_edge(1, 2, highway='primary', geometry=wiggly)  # both nodes outside, line across
+    G.add_edge(3, 4, highway='primary')  # outside
+
+    H = preprocess_graph(G, BBOX, SIZE_PX)
+    assert list(H.edges(keys=True)) == [(1, 2, 0)] and G.number_of_edges() == 2
+    line = H.edges[1, 2, 0]['geometry']
+    assert shapely.get_num_coordinates(line) == 2
+    margin = 4 * pixel_size(BBOX, SIZE_PX)
+    assert np.allclose(line.bounds[::2], (2.30 - margin, 2.32 + margin))
@@ -0,0 +1,45 @@
+import networkx as nx
+import numpy as np
+from pyproj import Geod
+from shapely.geometry import LineString, box
+
+from tilemani.cfgs.osm.road import OSMRoad
+from tilemani.utils.projection import TileContext, get_tile_context
+from tilemani.utils.tiles import lnglat_to_mercator
+
+
+def _graph():
+    """Two streets of a 0.02 x 0.01 degree block in Paris, one with a bent geometry"""
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_node(1, x=2.30, y=48.80)
+    G.add_node(2, x=2.32, y=48.80)
+    G.add_node(3, x=2.32, y=48.81)
+    G.add_edge(1, 2, highway='primary')
+    G.add_edge(2, 3, highway='residential',
+               geometry=LineString([(2.32, 48.80), (2.321, 48.805), (2.32, 48.81)]))
+    return G
+
+
+def test_tile_context_coords_and_areas():
+    ctx = TileContext(_graph())
+    assert ctx.node_xy.shape == (3, 2) and ctx.n_edges == 2
+    lines = ctx.edge_lines()
+    assert [len(line) for line in lines] == [2, 3]
+    assert np.allclose(lines[1], np.column_stack(lnglat_to_mercator([2.32, 2.321, 2.32], [48.80, 48.805, 48.81])))
+
+    area = abs(Geod(ellps='WGS84').geometry_area_perimeter(box(2.30, 48.80, 2.321, 48.81))[0])
+    assert abs(ctx.total_area() / area - 1) < 5e-3
+    # ~ 1.47 km + 1.15 km of a 6 m wide road
+    assert abs(ctx.road_area(3.0) / (6 * 2620) - 1) < 0.02
+    # per road class: 3.5 m wide primary, 3 m wide residential
+    assert list(ctx.edge_class) == [OSMRoad.PRIMARY.value, OSMRoad.RESIDENTIAL.value]
+    assert abs(ctx.road_area(None) / (3.5 * 1470 + 3 * 1150) - 1) < 0.03
+
+    xmin, ymin, xmax, ymax = ctx.bounds()
+    node_px, edge_px = ctx.to_pixels((xmin, ymin, xmax, ymax), 100, 50)
+    assert np.allclose(node_px[0], (0, 50)) and np.allclose(edge_px[3], (100, 25), atol=0.5)
+
+
+def test_tile_context_is_cached():
+    G = _graph()
+    assert get_tile_context(G) is get_tile_context(G)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from tilemani.rasterize.pyramid import downsample_2x2, build_pyramid, pyramid_from_arrays, write_tile, read_tile
+from tilemani.utils.failures import FailureLog, set_failure_log
+
+
+def test_downsample_2x2_modes():
+    labels = np.array([[1, 1, 0, 2],
+                       [2, 1, 3, 2],
+                       [0, 0, 5, 6],
+                       [0, 0, 7, 8]], dtype=np.uint8)
+    assert downsample_2x2(labels, 'mode').tolist() == [[1, 2], [0, 5]]
+    assert downsample_2x2(labels, 'max').tolist() == [[2, 3], [0, 8]]
+    assert downsample_2x2(labels, 'mean').tolist() == [[1, 2], [0, 6]]
+
+    rgb = np.stack([labels * 10, labels, labels], axis=-1)
+    assert downsample_2x2(rgb, 'mode')[:, :, 0].tolist() == [[10, 20], [0, 50]]
+    assert downsample_2x2(rgb, 'mean').shape == (2, 2, 3)
+
+
+def test_build_pyramid_matches_in_memory_pyramid(tmp_path):
+    rng = np.random.default_rng(0)
+    tiles = {(x, y, 16): rng.integers(0, 255, (8, 8, 3), dtype=np.uint8)
+             for x in range(4, 8) for y in range(4, 7)}
+    for (x, y, z), arr in tiles.items():
+        write_tile(tmp_path / str(z) / f'{x}_{y}_{z}.png', arr)
+
+    n_built = build_pyramid(tmp_path, max_zoom=16, min_zoom=14, fill=(255, 0, 0, 255))
+    assert n_built == {15: 4, 14: 1}
+
+    expected = pyramid_from_arrays(tiles, min_zoom=14, fill=(255, 0, 0, 255))
+    for (x, y, z), arr in expected.items():
+        assert np.array_equal(read_tile(tmp_path / str(z) / f'{x}_{y}_{z}.png'), arr)
+    # the missing children of (3, 3, 15) are filled with the background
+    assert expected[(3, 3, 15)][-1, 0].tolist() == [255, 0, 0]
+
+
+def test_build_pyramid_fills_planned_children_without_a_file(tmp_path):
+    arr = np.full((8, 8, 3), 200, dtype=np.uint8)
+    write_tile(tmp_path / '14' / '8301_5639_14.png', arr)
+    planned = [(8300, 5638, 14), (8301, 5638, 14), (8300, 5639, 14), (8301, 5639, 14), (8400, 5600, 14)]
+    log = FailureLog(verbose=False)
+    previous = set_failure_log(log)
+    try:
+        n_built = build_pyramid(tmp_path, max_zoom=14, min_zoom=12, fill=(0, 0, 0), tiles=planned)
+    finally:
+        set_failure_log(previous)
+
+    # the parent of the tile without any child file is not built
+    assert n_built == {13: 1, 12: 1} and not len(log)
+    expected = pyramid_from_arrays({(8301, 5639, 14): arr}, min_zoom=13, fill=(0, 0, 0))
+    assert np.array_equal(read_tile(tmp_path / '13' / '4150_2819_13.png'), expected[(4150, 2819, 13)])
@@ -0,0 +1,56 @@
+import networkx as nx
+import numpy as np
+
+from tilemani.cfgs.osm.road import ROAD_CLASSES
+from tilemani.rasterize.rasterizer import PreparedGraph
+
+STREET_WIDTHS = {'footway': 1.5, 'motorway': 6}
+
+
+def _graph():
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    for node, (x, y) in enumerate([(0, 0), (1, 0), (1, 1), (0, 1)]):
+        G.add_node(node, x=x, y=y)
+    G.add_node(4, x=2, y=2)  # isolated
+    G.add_edge(0, 1, osmid=1, highway='residential')
+    G.add_edge(1, 2, osmid=2, highway=['footway', 'motorway'])
+    G.add_edge(2, 3, osmid=3, highway='footway')
+    G.add_edge(2, 3, key=1, osmid=4, highway='motorway')  # parallel edge, ignored for the joints
+    return G
+
+
+def test_prepared_graph_widths_and_joints():
+    pg = PreparedGraph(_graph())
+    widths = dict(zip(pg.Gu.edges(keys=True), pg.edge_linewidths(STREET_WIDTHS, 4, lw_factor=2)))
+    assert widths == {(0, 1, 0): 4, (1, 2, 0): 3, (2, 3, 0): 3, (2, 3, 1): 12}
+
+    sizes = dict(zip(pg.Gu.nodes, pg.node_sizes(STREET_WIDTHS, 4)))
+    assert sizes == {0: 16, 1: 36, 2: 36, 3: 1.5 ** 2, 4: 0}
+    assert np.allclose(pg.node_coords()[4], [2, 2])
+
+
+def test_widths_of_types_outside_of_the_class_table():
+    G = _graph()
+    G.add_edge(3, 0, osmid=5, highway='busway')
+    G.add_edge(0, 2, osmid=6, highway='bus_guideway')
+    pg = PreparedGraph(G)
+    osmids = [d['osmid'] for *_, d in pg.Gu.edges(data=True)]
+    widths = dict(zip(osmids, pg.edge_linewidths({**STREET_WIDTHS, 'busway': 2.5}, 4)))
+    assert widths[5] == 2.5 and widths[6] == 4 and widths[1] == 4
+    # their road class is 'other'
+    assert np.isfinite(pg.edge_meters()).all()
+
+
+def test_widths_of_links_outside_of_the_class_table():
+    G = _graph()
+    G.add_edge(3, 0, osmid=5, highway='residential_link')
+    G.add_edge(0, 2, osmid=6, highway='footway_link')
+    pg = PreparedGraph(G)
+    osmids = [d['osmid'] for *_, d in pg.Gu.edges(data=True)]
+    street_widths = {**STREET_WIDTHS, 'residential': 3, 'residential_link': 2.5}
+    widths = dict(zip(osmids, pg.edge_linewidths(street_widths, 4)))
+    # the width of the link type applies, and a link without one gets the default (not its road's)
+    assert widths[5] == 2.5 and widths[6] == 4
+    # but their road class is that of their road type
+    edge_class = dict(zip(osmids, pg.edge_class))
+    assert ROAD_CLASSES.names[edge_class[5]] == 'residential' and ROAD_CLASSES.names[edge_class[6]] == 'footway'
@@ -0,0 +1,68 @@
+import osmnx as ox
+import shapely
+import pytest
+
+from tilemani.retrieve.region_graph import RegionGraph, parse_osm_filter, way_filter
+from tilemani.utils.geo import getGeoFromTile, getTileExtent
+
+TILE_XYZ = (8301, 5639, 14)
+N = 12
+
+
+def _grid_elements(tileXYZ=TILE_XYZ, n=N):
+    """A n x n street grid around the tile (3 tiles wide), with a footway and a parking aisle"""
+    x, y, z = tileXYZ
+    lat0, lng0 = getGeoFromTile(x, y, z)
+    extent, _ = getTileExtent(x, y, z)
+    north, south, east, west = ox.utils_geo.bbox_from_point((lat0, lng0), dist=extent * 1.5)
+    node_id = lambda i, j: 1 + i * n + j
+    elements = [{'type': 'node', 'id': node_id(i, j),
+                 'lat': south + (north - south) * i / (n - 1), 'lon': west + (east - west) * j / (n - 1)}
+                for i in range(n) for j in range(n)]
+    for i in range(n):
+        elements.append({'type': 'way', 'id': 1 + 2 * i, 'nodes': [node_id(i, j) for j in range(n)],
+                         'tags': {'highway': 'residential' if i % 3 else 'primary'}})
+        tags = {'highway': 'footway'} if i == 1 else {'highway': 'service', 'service': 'parking_aisle'} \
+            if i == 2 else {'highway': 'residential', 'lanes': '2'}
+        elements.append({'type': 'way', 'id': 2 + 2 * i, 'nodes': [node_id(j, i) for j in range(n)], 'tags': tags})
+    return {'version': 0.6, 'elements': elements}
+
+
+@pytest.fixture(scope='module')
+def region():
+    return RegionGraph.from_elements([_grid_elements()], network_type='drive_service')
+
+
+def test_way_filter_follows_overpass_semantics():
+    assert parse_osm_filter('["highway"]["area"!~"yes"]')[0][:2] == ('highway', None)
+    keep = way_filter('drive_service')
+    assert keep({'highway': 'residential'}) and keep({'highway': 'service', 'service': 'driveway'})
+    assert not keep({'highway': 'footway'}) and not keep({'highway': 'service', 'service': 'parking_aisle'})
+    assert not keep({'building': 'yes'}) and not keep({'highway': 'primary', 'access': 'private'})
+    assert way_filter(custom_filter='["highway"~"primary"]')({'highway': 'primary_link'})
+
+
+def test_region_drops_filtered_ways(region):
+    osmids = {osmid for *_, d in region.G.edges(data=True)
+              for osmid in (d['osmid'] if isinstance(d['osmid'], list) else [d['osmid']])}
+    assert 4 not in osmids and 6 not in osmids and 1 in osmids
+    # simplified: no interstitial nodes on the straight streets
+    assert all(d['street_count'] != 2 for _, d in region.G.nodes(data=True))
+
+
+def test_tile_subgraph_is_the_edges_crossing_the_tile(region):
+    G_r, bbox = region.tile_subgraph(TILE_XYZ)
+    north, south, east, west = bbox
+    tile_box = shapely.box(west, south, east, north)
+    expected = {(u, v, k) for (u, v, k), geom in zip(region.edges, region.geoms) if geom.intersects(tile_box)}
+    assert set(G_r.edges(keys=True)) == expected and len(expected)
+    assert set(G_r.nodes) == {n for u, v, _ in expected for n in (u, v)}
+    assert G_r.graph['crs'] == region.G.graph['crs']
+
+    # the subgraph can be modified without changing the region
+    u, v, k = next(iter(expected))
+    G_r.edges[u, v, k]['highway'] = 'changed'
+    assert region.G.edges[u, v, k]['highway'] != 'changed'
+
+    G_far, _ = region.tile_subgraph((TILE_XYZ[0] + 10, TILE_XYZ[1], 14))
+    assert G_far is None
@@ -0,0 +1,87 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from tilemani.rasterize.renderer import (get_batch_renderer, bbox_to_extent, road_layer,
+                                         footprint_layer, batch_rasterize_road_and_bldg)
+from tilemani.utils.geo import getMetersPerPixel
+from tilemani.utils.tiles import get_tile_bbox
+
+TILE = (8301, 5639, 14)
+
+
+def _road_across(bbox, highway='primary'):
+    """A road graph with one street crossing the bbox from west to east, at its middle latitude"""
+    north, south, east, west = bbox
+    lat = (north + south) / 2
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_node(1, x=west - 0.01, y=lat)
+    G.add_node(2, x=east + 0.01, y=lat)
+    G.add_edge(1, 2, highway=highway)
+    G.add_edge(2, 1, highway=highway)
+    return G
+
+
+def _courtyard(bbox):
+    """A bldg footprint over the middle of the bbox, with a hole (courtyard) in its center"""
+    north, south, east, west = bbox
+    dx, dy = (east - west) / 8, (north - south) / 8
+    cx, cy = (east + west) / 2, (north + south) / 2
+    outer = box(cx - 3 * dx, cy - 3 * dy, cx + 3 * dx, cy + 3 * dy)
+    inner = box(cx - dx, cy - dy, cx + dx, cy + dy)
+    return gpd.GeoDataFrame(geometry=[Polygon(outer.exterior, [inner.exterior])], crs='epsg:4326')
+
+
+def test_batch_renderer_layers_and_reuse():
+    bbox = get_tile_bbox(TILE)
+    renderer = get_batch_renderer(64, 64, dpi=50)
+    assert get_batch_renderer(64, 64, dpi=50) is renderer
+    renderer.set_extent(*bbox_to_extent(bbox))
+    renderer.set_roads(*road_layer(_road_across(bbox)))
+    renderer.set_footprints(*footprint_layer(_courtyard(bbox)))
+    renderer.set_widths({'primary': 2})
+
+    road = renderer.render('k', 'w', None).copy()
+    assert road.shape == (64, 64, 4)
+    assert road[:, 5, 0].max() == 255 and road[5, :, 0].max() == 0  # street only at mid latitude
+
+    bldg = renderer.render('k', None, 'w').copy()
+    assert bldg[32, 32, 0] == 0  # courtyard is not filled
+    assert bldg[32, 20, 0] == 255 and bldg[5, 5, 0] == 0
+
+    # same inputs, same image, whatever was rendered in between
+    assert np.array_equal(renderer.render('k', 'w', None), road)
+
+
+def test_batch_rasterize_styles(tmp_path):
+    bbox = get_tile_bbox(TILE)
+    images = batch_rasterize_road_and_bldg(_road_across(bbox), _courtyard(bbox), TILE, bbox,
+                                           ['k'], ['w'], ['silver'], [0.5], save=True,
+                                           out_dir_root=tmp_path, figsize=(1, 1), dpi=50)
+    assert sorted(images) == ['OSMnxB-k-silver-0.5', 'OSMnxR-k-w-0.5', 'OSMnxRB-k-w-silver-0.5']
+    assert all(img.shape == (38, 38, 4) for img in images.values())  # as rasterize_road_and_bldg
+    assert (tmp_path / 'OSMnxRB-k-w-silver-0.5' / '14' / '8301_5639_14.png').exists()
+
+
+def test_metric_widths():
+    tileXYZ = (65490, 43578, 17)  # ~0.78 m per pixel of a 256 px tile
+    bbox = get_tile_bbox(tileXYZ)
+    G = _road_across(bbox)
+    nx.set_edge_attributes(G, '6', 'lanes')  # 6 x 3.6 m = 21.6 m
+    renderer = get_batch_renderer(256, 256, dpi=50)
+    renderer.set_extent(*bbox_to_extent(bbox))
+    renderer.set_roads(*road_layer(G))
+    mpp = getMetersPerPixel(*tileXYZ, 256)
+    renderer.set_metric_widths(mpp)
+    img = renderer.render('k', 'w', None)
+    assert abs((img[:, 128, 0] > 127).sum() - 21.6 / mpp) <= 1
+
+    # without the lanes tag: the width of the primary road class (3.5 m)
+    renderer.set_roads(*road_layer(_road_across(bbox)))
+    renderer.set_metric_widths(mpp)
+    img = renderer.render('k', 'w', None)
+    assert abs((img[:, 128, 0] > 127).sum() - 3.5 / mpp) <= 1
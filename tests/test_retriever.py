@@ -1,8 +1,8 @@
 import osmnx as ox
-from src.tilemani.retrieve.retriever import get_road_graph_and_bbox
-from src.tilemani.rasterize.rasterizer import plot_figure_ground
+from tilemani.retrieve.retriever import get_road_graph_and_bbox
+from tilemani.rasterize.rasterizer import plot_figure_ground
 
-def test_get_road_graph_and_bbox(tileXYZ):
+def check_road_graph_and_bbox(tileXYZ):
     G_r, bbox = get_road_graph_and_bbox(tileXYZ)
     print("Manual bbox: ", bbox)
     f1, ax1 = ox.plot_graph(G_r)
@@ -18,12 +18,12 @@ def test_get_road_graph_and_bbox(tileXYZ):
 
 def test_get_road_graph_and_bbox_8301_5639_14():
     tileXYZ = (8301, 5639, 14)
-    test_get_road_graph_and_bbox(tileXYZ)
+    check_road_graph_and_bbox(tileXYZ)
 
 
 def test_get_road_graph_and_bbox_8301_5637_14():
     tileXYZ = (8301, 5637, 14)
-    test_get_road_graph_and_bbox(tileXYZ)
+    check_road_graph_and_bbox(tileXYZ)
 
 
 
@@ -0,0 +1,48 @@
+import numpy as np
+
+from tilemani.cfgs.osm.road import (ROAD_CLASSES, OSMRoad, RoadType, SpacenetRoad, parse_lanes,
+                                    r_osm2spacenet, rt2color)
+
+
+def test_encode_highway_tags():
+    tags = ['primary', ['footway', 'motorway'], 'Trunk_Link', 'primary_link', 'residential_link',
+            'busway', None, []]
+    codes = ROAD_CLASSES.encode(tags)
+    assert [ROAD_CLASSES.names[c] for c in codes] == \
+        ['primary', 'footway', 'trunk_link', 'primary_link', 'residential', 'other', 'other', 'other']
+    # codes of the OSMRoad types are their values
+    assert codes[0] == OSMRoad.PRIMARY.value
+
+    flat, tag = ROAD_CLASSES.encode_flat(tags[:2])
+    assert list(tag) == [0, 1, 1]
+    assert list(flat) == [OSMRoad.PRIMARY.value, OSMRoad.FOOTWAY.value, OSMRoad.MOTORWAY.value]
+
+
+def test_class_arrays_match_the_mappings():
+    for r in OSMRoad:
+        spacenet = r_osm2spacenet(r)
+        assert ROAD_CLASSES.spacenet[r.value] == (0 if spacenet is None else spacenet.value)
+        if spacenet is not None:
+            assert ROAD_CLASSES.radius[r.value] == spacenet.get_radius()
+            assert ROAD_CLASSES.road_type[r.value] == spacenet.to_global()
+        assert np.allclose(ROAD_CLASSES.width[r.value], 2 * ROAD_CLASSES.radius[r.value])
+    assert r_osm2spacenet(OSMRoad.STEPS) is None
+    assert ROAD_CLASSES.road_type[0] == RoadType.OTHER
+    assert ROAD_CLASSES.spacenet[ROAD_CLASSES.code('motorway_link')] == SpacenetRoad.MOTORWAY
+
+    codes = ROAD_CLASSES.encode(['primary', 'motorway_link', 'busway'])
+    assert np.allclose(ROAD_CLASSES.color[codes][:, :3], [[1, 0.549, 0], [1, 0, 1], [0.502, 0.502, 0.502]],
+                       atol=1e-3)
+    assert rt2color('primary') == 'darkorange' and rt2color('Service', {'service': 'k'}) == 'k'
+
+    widths = ROAD_CLASSES.lookup({'footway': 1.5, 'motorway': 6}, default=4)
+    assert list(widths[codes]) == [4, 4, 4]
+    assert widths[OSMRoad.MOTORWAY.value] == 6
+
+
+def test_lanes_and_metric_widths():
+    lanes = parse_lanes(['2', ['1', '3'], None, '2;4', 'yes', []])
+    assert np.array_equal(lanes, [2, 3, np.nan, 4, np.nan, np.nan], equal_nan=True)
+    codes = ROAD_CLASSES.encode(['primary'] * 3 + ['residential'] * 3)
+    widths = ROAD_CLASSES.metric_widths(codes, lanes)
+    assert np.allclose(widths, [7.2, 10.8, 3.5, 14.4, 3., 3.])
@@ -0,0 +1,65 @@
+import json
+
+import networkx as nx
+import numpy as np
+
+from tilemani.rasterize.labels import osm_tile_labels, spacenet_tile_labels
+from tilemani.retrieve.spacenet import buffer_roads, read_spacenet_roads
+from tilemani.utils.tiles import get_tile_bbox
+
+TILE = (65490, 43578, 17)  # a few streets in Paris
+
+
+def _roads(tileXYZ=TILE):
+    """A primary road across the tile (west to east) and a residential street (north to south)"""
+    north, south, east, west = get_tile_bbox(tileXYZ)
+    mid_lat, mid_lng = (north + south) / 2, (east + west) / 2
+    return [('2', [(west - 1e-3, mid_lat), (east + 1e-3, mid_lat)]),
+            ('5', [(mid_lng, north + 1e-3), (mid_lng, south - 1e-3)])]
+
+
+def _geojson(fp, roads):
+    features = [{'type': 'Feature',
+                 'properties': {'road_type': road_type, 'lane_number': '2', 'heading': 'Two-Way',
+                                'origarea': 0, 'paved': '1'},
+                 'geometry': {'type': 'LineString', 'coordinates': coords}}
+                for road_type, coords in roads]
+    fp.write_text(json.dumps({'type': 'FeatureCollection', 'features': features}))
+
+
+def test_read_and_buffer_spacenet_roads(tmp_path):
+    roads = _roads()
+    _geojson(tmp_path / 'img1.geojson', roads[:1])
+    _geojson(tmp_path / 'img2.geojson', roads[1:])
+    _geojson(tmp_path / 'img3.geojson', [])
+    gdf = buffer_roads(read_spacenet_roads(tmp_path))
+    assert len(gdf) == 2
+    assert 'heading' not in gdf.columns and 'origarea' not in gdf.columns
+    assert gdf['road_type'].tolist() == [2, 5] and gdf['lane_number'].dtype == np.int64
+    assert gdf['buff_geo'].crs.to_epsg() == 3857
+
+    labels = spacenet_tile_labels(gdf, zoom=17, tile_px=256)
+    assert TILE in labels and all(t[2] == 17 for t in labels)
+    tile = labels[TILE]
+    assert tile.shape == (256, 256) and tile.dtype == np.uint8
+    assert set(np.unique(tile)) == {0, 2, 5}
+    # the primary wins at the crossing
+    assert tile[128, 128] == 2 and tile[128, 5] == 2 and tile[5, 128] == 5
+    # 3.5 m wide primary, ~0.78 m pixels at zoom 17 in Paris
+    assert 3 <= (tile[:, 5] == 2).sum() <= 6
+
+
+def test_osm_and_spacenet_labels_agree(tmp_path):
+    roads = _roads()
+    _geojson(tmp_path / 'img.geojson', roads)
+    spacenet = spacenet_tile_labels(buffer_roads(read_spacenet_roads(tmp_path / 'img.geojson')),
+                                    zoom=17, tile_px=256)[TILE]
+
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    for i, (highway, (_, coords)) in enumerate(zip(['primary', 'residential'], roads)):
+        G.add_node(2 * i, x=coords[0][0], y=coords[0][1])
+        G.add_node(2 * i + 1, x=coords[1][0], y=coords[1][1])
+        G.add_edge(2 * i, 2 * i + 1, highway=highway)
+    G.add_edge(0, 2, highway='steps')  # no spacenet type: not labeled
+    osm = osm_tile_labels(G, TILE, tile_px=256)
+    assert (osm != spacenet).mean() < 1e-3
@@ -0,0 +1,106 @@
+import io
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tilemani.retrieve.downloader import TileDownloader
+from tilemani.retrieve.tile_cache import FetchResult, TileCache, Validators, fetch_url_conditional
+from tilemani.retrieve.tile_sources import TileProvider, image_signature
+
+
+def _png(value: int) -> bytes:
+    arr = np.zeros((8, 8, 3), dtype=np.uint8)
+    if value:
+        arr[2:4, 2:6] = value
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class VersionedServer:
+    """Tiles with an ETag per version; x == 0 tiles all have the same content, y == 0 are blank"""
+
+    def __init__(self):
+        self.version = {}
+        self.statuses = Counter()
+
+    def content(self, x, y):
+        return _png(0 if y == 0 else 1 if x == 0 else 10 * x + y + self.version.get((x, y), 0))
+
+    def fetch(self, url: str, validators: Validators = None) -> FetchResult:
+        z, x, y = map(int, url.rsplit('.', 1)[0].split('/')[-3:])
+        etag = f'"{x}-{y}-{self.version.get((x, y), 0)}"'
+        if validators is not None and validators.etag == etag:
+            self.statuses[304] += 1
+            return FetchResult(304, etag=etag)
+        self.statuses[200] += 1
+        return FetchResult(200, self.content(x, y), etag=etag)
+
+
+@pytest.fixture
+def provider():
+    return TileProvider('Local', {'default': 'http://local/{Z}/{X}/{Y}.png'}, requests_per_sec=0)
+
+
+def test_refresh_skips_unmodified_tiles(tmp_path, provider):
+    server = VersionedServer()
+    tiles = [(x, y, 5) for x in range(3) for y in range(3)]
+    out_dir = tmp_path / 'LocalDefault' / '5'
+    with TileCache(tmp_path) as cache:
+        downloader = TileDownloader(cache=cache, fetch_conditional=server.fetch)
+        assert downloader.download(provider, 'default', tiles, out_dir) == Counter(downloaded=6, blank=3)
+        # the x == 0 tiles have the same content: stored once
+        assert len(list(cache.blob_dir.rglob('*.png'))) == 5
+        assert (out_dir / '0_1_5.png').samefile(out_dir / '0_2_5.png')
+        assert (out_dir / '2_1_5.png').read_bytes() == server.content(2, 1)
+        assert len(cache) == 9
+
+        server.version[(2, 1)] = 5
+        stats = downloader.download(provider, 'default', tiles, out_dir)
+        assert stats == Counter(not_modified=5, downloaded=1, blank=3)
+        assert server.statuses == Counter({200: 9 + 1, 304: 8})
+        assert (out_dir / '2_1_5.png').read_bytes() == server.content(2, 1)
+
+    # validators persist across runs
+    with TileCache(tmp_path) as cache:
+        assert cache.validators('LocalDefault', (2, 1, 5)) == Validators(
+            '"2-1-5"', None, image_signature(server.content(2, 1)), False)
+        assert cache.validators('LocalDefault', (2, 0, 5)).blank
+        assert cache.validators('LocalDefault', (9, 9, 5)) is None
+
+
+def test_fetch_url_conditional_handles_304():
+    body = _png(1)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Last-Modified', 'Wed, 21 Oct 2015 07:28:00 GMT')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/1/2/3.png'
+    try:
+        first = fetch_url_conditional(url)
+        assert (first.status, first.data, first.etag) == (200, body, '"v1"')
+        second = fetch_url_conditional(url, Validators(first.etag, first.last_modified))
+        assert second.not_modified and second.data == b''
+    finally:
+        server.shutdown()
+        server.server_close()
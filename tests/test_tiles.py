@@ -0,0 +1,53 @@
+import numpy as np
+import shapely
+
+from tilemani.utils.tiles import (tiles_in_bbox, get_children, get_parent, tiles_in_polygon,
+                                  tiles_in_areas, tile_boxes)
+from tilemani.retrieve.planner import plan_quadtree
+
+# lng/lat bbox of paris in locations/paris.json
+PARIS = (2.125608, 2.564374, 48.758445, 48.992376)
+
+
+def test_parent_children_roundtrip():
+    tile = (8301, 5639, 14)
+    assert all(get_parent(c) == tile for c in get_children(tile))
+    assert get_parent(tile, 10) == (8301 >> 4, 5639 >> 4, 10)
+
+
+def test_plan_quadtree_without_empty_tiles_is_the_bbox():
+    tiles = plan_quadtree(PARIS, 14, is_empty=lambda tile: False, probe_zoom=10)
+    assert sorted(tiles) == sorted(tiles_in_bbox(*PARIS, 14))
+
+
+def test_plan_quadtree_prunes_descendants_of_empty_tiles():
+    empty = get_parent((8301, 5639, 14), 12)
+    probed = []
+
+    def is_empty(tile):
+        probed.append(tile)
+        return tile == empty
+
+    tiles = plan_quadtree(PARIS, 14, is_empty=is_empty, probe_zoom=10)
+    expected = [t for t in tiles_in_bbox(*PARIS, 14) if get_parent(t, 12) != empty]
+    assert sorted(tiles) == sorted(expected) and len(tiles) < len(tiles_in_bbox(*PARIS, 14))
+    assert max(z for _, _, z in probed) == 13  # only probes down to zoom - 1
+
+
+def test_tiles_in_polygon_of_a_bbox_is_the_bbox():
+    area = shapely.box(PARIS[0], PARIS[2], PARIS[1], PARIS[3])
+    tiles = tiles_in_polygon(area, 14)
+    assert sorted(map(tuple, tiles.tolist())) == sorted(tiles_in_bbox(*PARIS, 14))
+
+
+def test_tiles_in_polygon_matches_brute_force_and_dedupes_areas():
+    area = shapely.Point(2.35, 48.86).buffer(0.1)
+    tiles = tiles_in_polygon(area, 14)
+    candidates = np.array(tiles_in_bbox(*PARIS, 14))
+    hit = shapely.intersects(area, tile_boxes(candidates[:, 0], candidates[:, 1], 14))
+    assert sorted(map(tuple, tiles.tolist())) == sorted(map(tuple, candidates[hit].tolist()))
+
+    areas = tiles_in_areas({'a': area, 'b': shapely.Point(2.45, 48.86).buffer(0.1)}, 14)
+    assert len(areas['a']) == len(tiles)
+    keys = lambda t: set(map(tuple, t.tolist()))
+    assert not keys(areas['a']) & keys(areas['b'])
@@ -0,0 +1,59 @@
+import numpy as np
+from PIL import Image
+
+from tilemani.rasterize.writer import TileWriter, to_palette
+from tilemani.utils.failures import FailureLog, set_failure_log
+from tilemani.utils.instrument import Instrument, set_instrument
+
+
+def _figure_ground(size=32):
+    """Black tile with a white street and an anti-aliased (gray) edge"""
+    img = np.zeros((size, size, 4), dtype=np.uint8)
+    img[..., 3] = 255
+    img[size // 2 - 2:size // 2 + 2, :, :3] = 255
+    img[size // 2 + 2, :, :3] = 100
+    return img
+
+
+def test_to_palette():
+    img = _figure_ground()
+    indices, colors = to_palette(img)
+    assert len(colors) == 3 and np.array_equal(colors[indices], img[..., :3])
+
+    indices, colors = to_palette(img, palette=['k', 'w'])
+    assert colors.tolist() == [[0, 0, 0], [255, 255, 255]]
+    assert indices[16, 0] == 1 and indices[18, 0] == 0 and indices[0, 0] == 0
+
+
+def test_tile_writer_codecs(tmp_path):
+    img = _figure_ground()
+    with TileWriter('png-palette', max_workers=2) as writer:
+        writer.submit(tmp_path / 'p.png', img, palette=['k', 'w'])
+    with Image.open(tmp_path / 'p.png') as im:
+        assert im.mode == 'P'
+    assert (tmp_path / 'p.png').read_bytes()[24] == 1  # bit depth in the IHDR chunk
+
+    for codec in ('png', 'webp', 'raw'):
+        with TileWriter(codec, compress_level=1) as writer:
+            fp = tmp_path / f'tile{writer.suffix}'
+            writer.submit(fp, img)
+        arr = np.load(fp) if codec == 'raw' else np.asarray(Image.open(fp))
+        assert np.array_equal(arr[..., :3], img[..., :3])
+
+
+def test_tile_writer_records_failures(tmp_path):
+    log = FailureLog(verbose=False)
+    previous = set_failure_log(log)
+    instrument = Instrument(run_id='test')
+    previous_instrument = set_instrument(instrument)
+    try:
+        (tmp_path / 'file').write_text('')
+        with TileWriter('png') as writer:  # parent of the tile is a file
+            writer.submit(tmp_path / 'file' / 'tile.png', _figure_ground(), tileXYZ=(1, 2, 3))
+            writer.submit(tmp_path / 'tile.png', _figure_ground(), tileXYZ=(1, 3, 3))
+    finally:
+        set_failure_log(previous)
+        set_instrument(previous_instrument)
+    assert [(r.tileXYZ, r.stage) for r in log.records] == [((1, 2, 3), 'save_png')]
+    # only the tile that was written is counted
+    assert instrument.counters['tiles_written'] == 1
@@ -1,5 +1,8 @@
 from enum import IntEnum
-from typing import Dict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from matplotlib.colors import to_rgba
 
 
 G_RTS = [
@@ -22,7 +25,7 @@ G_RTS = [
 G_RT_COLORS = {
     "motorway": 'r',
     "trunk": 'orangered',
-    "primary": 'daskorange',
+    "primary": 'darkorange',
     "secondary": 'orange',
     "tertiary": 'yellow',
     "unclassified": 'greenyellow',
@@ -37,17 +40,10 @@ def rt2color(rt: str,
              link_color: str = "magenta",
              default_color: str = "gray"):
     rt = rt.lower()
-
-    color = default_color
     if rt.endswith("link"):
-        color = link_color
-
-    else:
-        try:
-            color = G_RT_COLORS[rt]
-        except KeyError:
-            pass
-    return color
+        return link_color
+    rt_colors = G_RT_COLORS if rt_colors is None else rt_colors
+    return rt_colors.get(rt, default_color)
 
 
 class Road(IntEnum):
@@ -156,30 +152,23 @@ _osm_rtypes_str = ' '. join(list(map(lambda x: x.upper(), _osm_rtypes)))
 # print(_osm_rtypes_str)
 
 #todo: remap this based on the WFP pdf
-def r_osm2spacenet(osmroad_type):
-
-    """osm_roadtype to spacenet_roadtype mapping"""
-    spacenet_type = None
-    if osmroad_type.name in ['MOTORWAY', 'MOTORWAY_LINK']:
-        spacenet_type = SpacenetRoad['MOTORWAY']
-    elif osmroad_type.name in ['PRIMARY', 'TRUNK', 'TRUNK_LINK']:
-        spacenet_type = SpacenetRoad['PRIMARY']
-    elif osmroad_type.name in ['SECONDARY', 'SECONDARY_LINK']:
-        spacenet_type = SpacenetRoad['SECONDARY']
-    elif osmroad_type.name in ['TERTIARY', 'TERTIARY_LINK']:
-        spacenet_type = SpacenetRoad['TERTIARY']
-    elif osmroad_type.name in ['CYCLEWAY', 'FOOTWAY', 'LIVING_STREET', 'PEDESTRIAN',
-                               'RESIDENTIAL', 'SERVICE']:
-        spacenet_type = SpacenetRoad['RESIDENTIAL']
-    elif osmroad_type.name in ['UNCLASSIFIED']:
-        spacenet_type = SpacenetRoad['UNCLASSIFIED']
-    elif osmroad_type.name in ['PATH']:
-        spacenet_type = SpacenetRoad['CART']
-    else:
-        print("This osm_rtype is not mapped to any spacenet_rtype: {}".
-              format(osmroad_type.name) )
-        print(" For now we assign None")
-    return spacenet_type
+_OSM2SPACENET = {
+    'MOTORWAY': 'MOTORWAY', 'MOTORWAY_LINK': 'MOTORWAY',
+    'PRIMARY': 'PRIMARY', 'PRIMARY_LINK': 'PRIMARY', 'TRUNK': 'PRIMARY', 'TRUNK_LINK': 'PRIMARY',
+    'SECONDARY': 'SECONDARY', 'SECONDARY_LINK': 'SECONDARY',
+    'TERTIARY': 'TERTIARY', 'TERTIARY_LINK': 'TERTIARY',
+    'CYCLEWAY': 'RESIDENTIAL', 'FOOTWAY': 'RESIDENTIAL', 'LIVING_STREET': 'RESIDENTIAL',
+    'PEDESTRIAN': 'RESIDENTIAL', 'RESIDENTIAL': 'RESIDENTIAL', 'SERVICE': 'RESIDENTIAL',
+    'UNCLASSIFIED': 'UNCLASSIFIED',
+    'PATH': 'CART',
+}
+
+
+def r_osm2spacenet(osmroad_type) -> Optional[SpacenetRoad]:
+    """osm_roadtype to spacenet_roadtype mapping (None for the osm types that are not mapped
+    to any spacenet type)"""
+    spacenet_name = _OSM2SPACENET.get(osmroad_type.name)
+    return None if spacenet_name is None else SpacenetRoad[spacenet_name]
 
 @staticmethod
 def __osm_radius_per_lane():
@@ -201,6 +190,168 @@ setattr(OSMRoad, 'radius_per_lane', __osm_radius_per_lane)
 setattr(OSMRoad, 'default_lane_nums', __osm_default_lane_nums)
 
 
+################################################################################
+## Road class table
+################################################################################
+DEFAULT_ROAD_WIDTH = 3.  # meters, of the road classes without a spacenet type
+
+
+class RoadClassTable:
+    """Integer codes of the OSM road classes, and per-class lookup arrays.
+
+    Code 0 is 'other' (any highway type not in the table), and codes 1.. are the `OSMRoad`
+    values, followed by the `*_link` types missing from `OSMRoad`. Highway tags are encoded
+    to codes once per graph (`encode`): the distinct tags (a handful per tile) are looked up
+    in a dict, and scattered to the edges with numpy. Everything per class is then an array
+    indexed by the codes, e.g. `ROAD_CLASSES.width[codes]` is the width of each edge.
+
+    Tags are matched case-insensitively. A list-valued tag (ways merged by osmnx) is encoded
+    by its first type, as osmnx does, or by all its types with `encode_flat`. A `*_link` type
+    that is not in the table gets the class of its road type (with `encode_flat_extended`, it
+    gets its own code, whose class is that of its road type).
+
+    Attributes (arrays indexed by the class code)
+    ----------
+    names : class names (lowercase OSM highway types, and 'other')
+    is_link : whether the class is a `*_link` type
+    spacenet : `SpacenetRoad` value of the class (0 if not mapped to any spacenet type)
+    road_type : `RoadType` value of the class (MAJOR, MINOR or OTHER, via its spacenet type)
+    width : road width, in meters (spacenet widths, `DEFAULT_ROAD_WIDTH` if not mapped)
+    radius : half of the width, in meters
+    color : (n_classes, 4) RGBA colors of `rt2color`
+    """
+
+    def __init__(self, extra_types: Sequence[str] = ('primary_link',)):
+        self.names: List[str] = ['other'] + [r.name.lower() for r in OSMRoad] + list(extra_types)
+        self._codes: Dict[str, int] = {name: code for code, name in enumerate(self.names)}
+        self.is_link = np.array([name.endswith('_link') for name in self.names])
+
+        spacenet = [SpacenetRoad[_OSM2SPACENET[name.upper()]] if name.upper() in _OSM2SPACENET
+                    else None for name in self.names]
+        self.spacenet = np.array([0 if r is None else r.value for r in spacenet], dtype=np.int64)
+        self.road_type = np.array([RoadType.OTHER if r is None else r.to_global() for r in spacenet],
+                                  dtype=np.int64)
+        radii = SpacenetRoad.radius_mapping()
+        self.radius = np.array([DEFAULT_ROAD_WIDTH / 2 if r is None else radii[r] for r in spacenet])
+        self.width = 2 * self.radius
+        self.color = np.array([to_rgba(rt2color(name, default_color=G_RT_COLORS['others']))
+                               for name in self.names])
+
+    def __len__(self):
+        return len(self.names)
+
+    def code(self, highway: str) -> int:
+        """Class code of a single highway type"""
+        highway = str(highway).lower()
+        code = self._codes.get(highway, 0)
+        if not code and highway.endswith('_link'):
+            code = self._codes.get(highway[:-len('_link')], 0)
+        return code
+
+    def encode_flat(self, highways: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+        """Class codes of all the types of the highway tags (str, list of str or None).
+
+        Returns
+        -------
+        - (n_types,) int array of the codes of the types, tag after tag
+        - (n_types,) int array of the index of the tag of each type
+        """
+        codes, tag, _ = self.encode_flat_extended(highways, extend=False)
+        return codes, tag
+
+    def encode_flat_extended(self, highways: Sequence,
+                             extend: bool = True) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """`encode_flat`, where (if `extend`) each distinct type that is not in the table (including
+        the `*_link` types not in it, otherwise encoded by their road type) gets its own code
+        len(self) + i, e.g. so that the `street_widths` given for it still apply. Per-class arrays
+        must be indexed with the classes of the codes (`classes_of`).
+
+        Returns
+        -------
+        - codes, tag: as `encode_flat`
+        - list of the types not in the table, the i-th one with code len(self) + i
+        """
+        types = [h if isinstance(h, list) else [h] for h in highways]
+        n_types = np.fromiter(map(len, types), dtype=np.int64, count=len(types))
+        flat = np.array([str(t) for ts in types for t in ts], dtype=str)
+        if not len(flat):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), []
+        distinct, inverse = np.unique(flat, return_inverse=True)
+        lut = np.fromiter(map(self.code, distinct), dtype=np.int64, count=len(distinct))
+        unknown = []
+        if extend:
+            outside = np.array([str(t).lower() not in self._codes for t in distinct], dtype=bool)
+            unknown = [str(t) for t in distinct[outside]]
+            lut[outside] = len(self) + np.arange(len(unknown))
+        return lut[inverse], np.repeat(np.arange(len(types)), n_types), unknown
+
+    def encode(self, highways: Sequence) -> np.ndarray:
+        """(n_tags,) int array of the class codes of the highway tags (the first type of
+        list-valued tags)"""
+        return self.first_codes(*self.encode_flat(highways), len(highways))
+
+    def classes_of(self, codes: np.ndarray, unknown: Sequence[str]) -> np.ndarray:
+        """Class codes (indices of the per-class arrays) of the codes of `encode_flat_extended`:
+        the codes of the types outside of the table are mapped to the class of their road type
+        for `*_link` types, and to 'other' otherwise"""
+        lut = np.concatenate([np.arange(len(self)),
+                              np.fromiter(map(self.code, unknown), dtype=np.int64, count=len(unknown))])
+        return lut[codes]
+
+    @staticmethod
+    def first_codes(codes: np.ndarray, tag: np.ndarray, n_tags: int) -> np.ndarray:
+        """Code of the first type of each tag, from the output of `encode_flat` (0 for empty tags)"""
+        first = np.ones(len(tag), dtype=bool)
+        first[1:] = tag[1:] != tag[:-1]
+        out = np.zeros(n_tags, dtype=np.int64)
+        out[tag[first]] = codes[first]
+        return out
+
+    def metric_widths(self, codes: np.ndarray, lanes: np.ndarray,
+                      radius_per_lane: Optional[float] = None) -> np.ndarray:
+        """Width (meters) of each edge: its number of `lanes` (see `parse_lanes`) x the width of a
+        lane (2 x `OSMRoad.radius_per_lane`), or the width of its class where lanes is NaN"""
+        radius_per_lane = OSMRoad.radius_per_lane() if radius_per_lane is None else radius_per_lane
+        lanes = np.asarray(lanes, dtype=float)
+        return np.where(lanes > 0, lanes * 2 * radius_per_lane, self.width[codes])
+
+    def lookup(self, values: Dict[str, float], default: float = np.nan) -> np.ndarray:
+        """Per-class array of the values of a dict keyed by highway type, e.g. the
+        `street_widths` of `ox.plot_figure_ground` (`default` for the classes not in it)"""
+        return np.array([values.get(name, default) for name in self.names], dtype=float)
+
+
+def _max_lanes(lanes: str) -> float:
+    """Largest number of a `lanes` tag value ('2', '2;3', ...), NaN if there is none"""
+    numbers = []
+    for part in lanes.split(';'):
+        try:
+            numbers.append(float(part))
+        except ValueError:
+            pass
+    numbers = [n for n in numbers if np.isfinite(n) and n > 0]
+    return max(numbers) if numbers else np.nan
+
+
+def parse_lanes(lanes: Sequence) -> np.ndarray:
+    """(n_tags,) float array of the number of lanes of the `lanes` tags (str, list of str merged
+    by osmnx, or None): the largest number of each tag, NaN where it has none. The distinct
+    values are parsed once, as in `RoadClassTable.encode_flat`"""
+    values = [v if isinstance(v, list) else [v] for v in lanes]
+    n_values = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    out = np.full(len(values), np.nan)
+    flat = np.array([str(v) for vs in values for v in vs], dtype=str)
+    if not len(flat):
+        return out
+    distinct, inverse = np.unique(flat, return_inverse=True)
+    flat_lanes = np.fromiter(map(_max_lanes, distinct), dtype=float, count=len(distinct))[inverse]
+    np.fmax.at(out, np.repeat(np.arange(len(values)), n_values), flat_lanes)
+    return out
+
+
+ROAD_CLASSES = RoadClassTable()
+
+
 ################################################################################
 ## Tests
 ################################################################################
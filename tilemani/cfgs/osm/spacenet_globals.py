@@ -1,6 +1,6 @@
 #spacenet data preprocessing global variables
 import numpy as np
-from Road import *
+from tilemani.cfgs.osm.road import Road
 
 # Road type value definition
 ## Defined as enum in class Road
@@ -43,13 +43,13 @@ G_COLS = ['bridge_type',
 #             Road.Unclassified: 3.,
 #             Road.Cart: 3.,
 #             }
-G_WIDTHS = {Road.Motorway.value: 3.5,
-            Road.Primary.value: 3.5,
-            Road.Secondary.value: 3.,
-            Road.Tertiary.value: 3.,
-            Road.Residential.value: 3.,
-            Road.Unclassified.value: 3.,
-            Road.Cart.value: 3.,
+G_WIDTHS = {Road.MOTORWAY.value: 3.5,
+            Road.PRIMARY.value: 3.5,
+            Road.SECONDARY.value: 3.,
+            Road.TERTIARY.value: 3.,
+            Road.RESIDENTIAL.value: 3.,
+            Road.UNCLASSIFIED.value: 3.,
+            Road.CART.value: 3.,
             }
 
 G_DROP_COLS = ['heading', 
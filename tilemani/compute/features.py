@@ -2,58 +2,50 @@ import osmnx as ox
 from typing import Tuple, Dict
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
+from tilemani.utils.instrument import timed
+from tilemani.utils.projection import get_tile_context
 
 
 def get_total_area(G) -> float:
     """Computes the total area (in square meters) of the square maptile of the graph (when it's rasterized)
     G: unprojected (ie.e in lat,lng degree crs)
 
+    The bounds of the nodes and edges are those of the graph's `TileContext` (Web Mercator, scaled
+    to the ground at the tile's latitude), shared with the rasterizers.
     """
-    gdf_n, gdf_e = ox.utils_graph.graph_to_gdfs(G)
-    gdfproj_n, gdfproj_e = ox.project_gdf(gdf_n), ox.project_gdf(gdf_e)
-    node_bounds, edge_bounds = gdfproj_n.total_bounds, gdfproj_e.total_bounds
-    total_bounds = (
-        min(node_bounds[0], edge_bounds[0]),
-        min(node_bounds[1], edge_bounds[1]),
-        max(node_bounds[2], edge_bounds[2]),
-        max(node_bounds[3], edge_bounds[3])
-    )
-
-    minx, miny, maxx, maxy = total_bounds
-    dx = maxx - minx
-    dy = maxy - miny
-    total_area = dx * dy
-    return total_area
+    return get_tile_context(G).total_area()
 
 
 def get_road_area(G, avg_road_radius=3.0):
     """
     G: unprojected (ie. in lat,lng degree)
     avg_road_radis: radius of the roads on average, in meters
+        (None: the radius of the road class of each edge, see `tilemani.cfgs.osm.road.RoadClassTable`)
     """
-    gdf_nodes, gdf_edges = ox.utils_graph.graph_to_gdfs(G)
-    road_geom = ox.project_gdf(gdf_edges).unary_union  # Multistring obj in UTM
-    buffered_road_geom = road_geom.buffer(avg_road_radius)
-    road_area = buffered_road_geom.area
+    road_area = get_tile_context(G).road_area(avg_road_radius)
     print('Area of the roads: ', road_area)
 
     return road_area
 
 
+@timed('stats')
 def compute_road_network_stats(G) -> Dict:
     # compute total area of the area covered by the rastered image of this graph/network
     total_area = get_total_area(G)
 
     # unpack dicts into individiual keys:values
     stats = ox.basic_stats(G, area=total_area)
+    # osmnx>=1.1 renamed `streets_per_node_proportion` to `streets_per_node_proportions`
+    proportion_key = ("streets_per_node_proportions" if "streets_per_node_proportions" in stats
+                      else "streets_per_node_proportion")
     for k, count in stats["streets_per_node_counts"].items():
         stats["int_{}_count".format(k)] = count
-    for k, proportion in stats["streets_per_node_proportion"].items():
+    for k, proportion in stats[proportion_key].items():
         stats["int_{}_prop".format(k)] = proportion
 
     # delete the no longer needed dict elements
     del stats["streets_per_node_counts"]
-    del stats["streets_per_node_proportion"]
+    del stats[proportion_key]
 
     # change key named 'n' to 'n_nodes', and 'm' to 'n_edges'
     stats['n_nodes'] = stats.pop('n', None)
@@ -0,0 +1,112 @@
+"""Per-tile road label arrays: (H, W) uint8 arrays of the `SpacenetRoad` type of the road
+covering each pixel (0: no road), for the SpaceNet road labels and the OSM road graphs alike,
+so that both can be used as training targets of the same model.
+
+The roads are buffered by the radius of their type in meters on the ground (OSM road classes
+are mapped to their SpaceNet type by `ROAD_CLASSES`; the classes without one, e.g. steps or
+tracks, are not labeled), and filled with the scanline fill of the bldg footprints, one pass
+per type. Where roads of different types overlap, the major type (lower value) wins.
+
+Usage
+-----
+from tilemani.rasterize.labels import osm_tile_labels, spacenet_tile_labels
+
+labels = osm_tile_labels(G_r, tileXYZ)               # (350, 350) uint8
+labels = spacenet_tile_labels(gdf, zoom=17)          # tileXYZ -> (350, 350) uint8, all tiles of the AOI
+pyramid_from_arrays(labels, min_zoom=14, mode='mode')
+"""
+from typing import Dict, Tuple
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from networkx.classes.graph import Graph
+
+from tilemani.cfgs.osm.road import ROAD_CLASSES
+from tilemani.rasterize.footprints import fill_edges, polygon_edges
+from tilemani.utils.instrument import timed
+from tilemani.utils.projection import buffer_meters, get_tile_context
+from tilemani.utils.tiles import MERCATOR_HALF_SIZE, TileXYZ, tile_mercator_bounds
+
+Extent = Tuple[float, float, float, float]  # Web Mercator (xmin, ymin, xmax, ymax)
+
+
+def rasterize_labels(polygons: np.ndarray, labels: np.ndarray, extent: Extent, width_px: int,
+                     height_px: int) -> np.ndarray:
+    """(height_px, width_px) uint8 array of the label of the Web Mercator polygons covering each
+    pixel center (0 where there is none). Labels are filled from the highest to the lowest, so
+    the lowest label wins where polygons overlap"""
+    out = np.zeros((height_px, width_px), dtype=np.uint8)
+    labels = np.asarray(labels)
+    for label in np.unique(labels[labels > 0])[::-1]:
+        edges, edge_polygon = polygon_edges(polygons[labels == label], extent, width_px, height_px,
+                                            lnglat=False)
+        out[fill_edges(edges, edge_polygon, width_px, height_px)] = label
+    return out
+
+
+def osm_road_polygons(G: Graph) -> Tuple[np.ndarray, np.ndarray]:
+    """Web Mercator buffers of the edges of the road graph that have a SpaceNet type, and
+    their types"""
+    ctx = get_tile_context(G)
+    labels = ROAD_CLASSES.spacenet[ctx.edge_class]
+    keep = labels > 0
+    buffers = buffer_meters(ctx.line_geoms()[keep], ROAD_CLASSES.radius[ctx.edge_class[keep]],
+                            ctx.center_lat)
+    return buffers, labels[keep]
+
+
+@timed('labels')
+def osm_road_labels(G: Graph, extent: Extent, width_px: int, height_px: int) -> np.ndarray:
+    """Label array of the road graph over the Web Mercator extent (see the module doc)"""
+    if G is None or G.number_of_edges() == 0:
+        return np.zeros((height_px, width_px), dtype=np.uint8)
+    return rasterize_labels(*osm_road_polygons(G), extent, width_px, height_px)
+
+
+def osm_tile_labels(G: Graph, tileXYZ: TileXYZ, tile_px: int = 350) -> np.ndarray:
+    """Label array of the road graph of a tile over the exact extent of the tile"""
+    return osm_road_labels(G, tile_mercator_bounds(tileXYZ), tile_px, tile_px)
+
+
+@timed('labels')
+def spacenet_tile_labels(gdf: gpd.GeoDataFrame, zoom: int, tile_px: int = 350,
+                         type_col: str = 'road_type') -> Dict[TileXYZ, np.ndarray]:
+    """Label arrays of all the tiles at `zoom` that the SpaceNet roads of `gdf` intersect.
+
+    Args
+    ----
+    gdf : GeoDataFrame
+        roads with their buffers in Web Mercator (`buff_geo` column, see
+        `tilemani.retrieve.spacenet.buffer_roads`) and their SpacenetRoad type in `type_col`
+
+    Returns
+    -------
+    - dict of tileXYZ -> (tile_px, tile_px) uint8 label array
+    """
+    buffers = np.asarray(gdf['buff_geo'].values)
+    labels = gdf[type_col].to_numpy().astype(np.int64)
+    keep = (labels > 0) & ~shapely.is_empty(buffers)
+    buffers, labels = buffers[keep], labels[keep]
+    if not len(buffers):
+        return {}
+
+    # tiles of the bounds of the AOI, and the roads of each tile (one STRtree query)
+    size = 2 * MERCATOR_HALF_SIZE / 2 ** zoom
+    xmin, ymin, xmax, ymax = shapely.total_bounds(buffers)
+    xs = np.arange(int((xmin + MERCATOR_HALF_SIZE) // size), int((xmax + MERCATOR_HALF_SIZE) // size) + 1)
+    ys = np.arange(int((MERCATOR_HALF_SIZE - ymax) // size), int((MERCATOR_HALF_SIZE - ymin) // size) + 1)
+    xs, ys = (a.ravel() for a in np.meshgrid(xs, ys, indexing='ij'))
+    x0, y1 = xs * size - MERCATOR_HALF_SIZE, MERCATOR_HALF_SIZE - ys * size
+    boxes = shapely.box(x0, y1 - size, x0 + size, y1)
+    tile_idx, road_idx = shapely.STRtree(buffers).query(boxes, predicate='intersects')
+
+    order = np.argsort(tile_idx, kind='stable')
+    tile_idx, road_idx = tile_idx[order], road_idx[order]
+    tiles, starts = np.unique(tile_idx, return_index=True)
+    out = {}
+    for t, roads in zip(tiles, np.split(road_idx, starts[1:])):
+        tileXYZ = (int(xs[t]), int(ys[t]), zoom)
+        out[tileXYZ] = rasterize_labels(buffers[roads], labels[roads], tile_mercator_bounds(tileXYZ),
+                                        tile_px, tile_px)
+    return out
@@ -0,0 +1,293 @@
+"""Metatile rendering: rasterize an N x N block of maptiles in a single figure and slice it
+into the per-tile images.
+
+`rasterize_road_and_bldg` renders each maptile in its own figure, so the edges and bldgs
+shared by neighboring tiles are projected and drawn once per tile, and line joints are cut
+at the tile borders. Here, the block (a "metatile") is drawn once in Web Mercator, the
+projection of the maptiles, so that the tiles are exactly aligned to the pixel grid; the
+block is rendered with a margin of `buffer_px` pixels on each side (drawn from data retrieved
+in the buffered area) so that the lines and joints crossing the border of the block are
+complete, and the margin is cropped when slicing.
+
+A metatile of size n (a power of 2) at zoom z is identified by its tile at zoom z - log2(n),
+i.e. the parent of its tiles (see `get_metatile`).
+
+The tiles of a metatile are not the same images as those of `rasterize_road_and_bldg`, which
+renders the square bbox of the retriever (centered on the NW corner of the tile, see
+`tilemani.utils.geo.get_latlng_and_radius`) and crops the figure to its axes (269 px for the
+default figsize and dpi). A metatile tile covers the exact Web Mercator bounds of the maptile
+at figsize * dpi pixels (350 px). So that a dataset never mixes the two, the metatile styles
+are saved to their own directories, named with the `METATILE_PREFIX` ('OSMnxMR-', 'OSMnxMB-',
+'OSMnxMRB-' instead of 'OSMnxR-', ...).
+
+Usage
+-----
+from tilemani.rasterize.metatile import get_metatile, retrieve_metatile, rasterize_metatile
+
+metatileXYZ = get_metatile((8301, 5639, 14), n=8)
+G_r, gdf_b = retrieve_metatile(metatileXYZ, n=8)
+rasterize_metatile(G_r, gdf_b, metatileXYZ, n=8, bgcolors=['k'], edge_colors=['cyan'],
+                   bldg_colors=['silver'], lw_factors=[0.5], save=True, out_dir_root=Path('./temp'))
+"""
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from pathlib import Path
+
+import numpy as np
+import geopandas as gpd
+import osmnx as ox
+from networkx.classes.graph import Graph
+
+from tilemani.rasterize.rasterizer import PreparedGraph
+from tilemani.rasterize.renderer import (BatchRenderer, get_batch_renderer, road_layer, footprint_layer,
+                                         set_footprint_layer, write_png, DEFAULT_STREET_WIDTHS)
+from tilemani.rasterize.writer import TileWriter
+from tilemani.utils.failures import capture
+from tilemani.utils.geo import getMetersPerPixel
+from tilemani.utils.instrument import timer, count
+from tilemani.utils.tiles import (TileXYZ, get_parent, tile_mercator_bounds,
+                                  EARTH_RADIUS)
+
+METATILE_PREFIX = 'OSMnxM'  # prefix of the style names of the metatile tiles (see the module doc)
+
+
+def _levels(n: int) -> int:
+    levels = int(n).bit_length() - 1
+    if n < 1 or 2 ** levels != n:
+        raise ValueError(f"metatile size must be a power of 2: {n}")
+    return levels
+
+
+def get_metatile(tileXYZ: TileXYZ, n: int = 8) -> TileXYZ:
+    """The metatile of size `n` (as a tile at zoom z - log2(n)) that contains the tile"""
+    return get_parent(tileXYZ, tileXYZ[2] - _levels(n))
+
+
+def metatile_tiles(metatileXYZ: TileXYZ, n: int = 8) -> List[TileXYZ]:
+    """The n x n tiles of the metatile, column-major"""
+    x, y, z = metatileXYZ
+    return [(x * n + i, y * n + j, z + _levels(n)) for i in range(n) for j in range(n)]
+
+
+def group_by_metatile(tiles: Iterable[TileXYZ], n: int = 8) -> Dict[TileXYZ, List[TileXYZ]]:
+    """Group the tiles by their metatile (in the order of the first tile of each metatile)"""
+    groups = {}
+    for tile in tiles:
+        groups.setdefault(get_metatile(tile, n), []).append(tile)
+    return groups
+
+
+def metatile_extent(metatileXYZ: TileXYZ, n: int = 8, tile_px: int = 350,
+                    buffer_px: int = 0) -> Tuple[float, float, float, float]:
+    """Web Mercator bounds (xmin, ymin, xmax, ymax) of the metatile, extended by `buffer_px`
+    pixels (of the tiles of `tile_px` pixels) on each side"""
+    xmin, ymin, xmax, ymax = tile_mercator_bounds(metatileXYZ)
+    buffer = buffer_px * (xmax - xmin) / (n * tile_px)
+    return xmin - buffer, ymin - buffer, xmax + buffer, ymax + buffer
+
+
+def metatile_bbox(metatileXYZ: TileXYZ, n: int = 8, tile_px: int = 350,
+                  buffer_px: int = 0) -> Tuple[float, float, float, float]:
+    """Bounds of the (buffered) metatile as (north, south, east, west) in lat,lng degree,
+    i.e. in the same order as the bbox of osmnx"""
+    xmin, ymin, xmax, ymax = metatile_extent(metatileXYZ, n, tile_px, buffer_px)
+    west, east = np.degrees(np.array([xmin, xmax]) / EARTH_RADIUS)
+    south, north = np.degrees(2 * np.arctan(np.exp(np.array([ymin, ymax]) / EARTH_RADIUS)) - np.pi / 2)
+    return float(north), float(south), float(east), float(west)
+
+
+def retrieve_metatile(
+        metatileXYZ: TileXYZ,
+        n: int = 8,
+        tile_px: int = 350,
+        buffer_px: int = 16,
+        network_type: str = "drive_service",
+        tag: Optional[Dict] = None,
+) -> Tuple[Optional[Graph], Optional[gpd.GeoDataFrame]]:
+    """Retrieve the road network and the bldg geoms of the (buffered) metatile from OSM,
+    with one query each instead of one per tile.
+    Failures are recorded in the failure log under the metatile's index.
+
+    Returns
+    -------
+    - G_r: graph of the retrieved road network (None on failure or if the area has no road)
+    - gdf_b: geoms of the bldgs (None on failure or if the area has no bldg)
+    """
+    tag = {'building': True} if tag is None else tag
+    north, south, east, west = metatile_bbox(metatileXYZ, n, tile_px, buffer_px)
+
+    G_r = None
+    with capture(metatileXYZ, 'retrieve_road'), timer('retrieve_road'):
+        count('overpass_queries')
+        G_r = ox.graph_from_bbox(north, south, east, west, network_type=network_type,
+                                 truncate_by_edge=True)
+    gdf_b = None
+    with capture(metatileXYZ, 'retrieve_bldg'), timer('retrieve_bldg'):
+        count('overpass_queries')
+        gdf_b = ox.geometries_from_bbox(north, south, east, west, tags=tag)
+
+    return G_r, gdf_b
+
+
+def render_metatile(
+        G: Optional[Union[Graph, PreparedGraph]],
+        gdf_b: Optional[gpd.GeoDataFrame],
+        metatileXYZ: TileXYZ,
+        n: int = 8,
+        tile_px: int = 350,
+        buffer_px: int = 16,
+        dpi: int = 50,
+        bgcolor='k',
+        edge_color='w',
+        bldg_color=None,
+        street_widths: Dict[str, float] = None,
+        default_width: float = 4,
+        smooth_joints: bool = True,
+        lw_factor: float = 1.,
+) -> np.ndarray:
+    """Render the road graph `G` and (if `bldg_color` is not None) the bldg footprints `gdf_b`
+    of the metatile in one figure. The widths in `street_widths` are in points, as in
+    `plot_figure_ground` with figsize = tile_px / dpi, but each tile covers the exact bounds of
+    the maptile (not the bbox of `rasterize_road_and_bldg`, see the module doc).
+
+    Returns
+    -------
+    - (n * tile_px, n * tile_px, 4) uint8 RGBA array of the metatile, without the buffer margin
+    """
+    street_widths = DEFAULT_STREET_WIDTHS if street_widths is None else street_widths
+    renderer = _metatile_renderer(metatileXYZ, n, tile_px, buffer_px, dpi)
+    if G is not None:
+        renderer.set_roads(*road_layer(G))
+    else:
+        renderer.set_roads(None)
+    renderer.set_footprints(*footprint_layer(gdf_b if bldg_color is not None else None))
+    renderer.set_widths(street_widths, default_width, lw_factor, smooth_joints)
+    return _crop(renderer.render(bgcolor, edge_color, bldg_color), buffer_px)
+
+
+def _metatile_renderer(metatileXYZ: TileXYZ, n: int, tile_px: int, buffer_px: int,
+                       dpi: int) -> BatchRenderer:
+    """This thread's renderer for the (buffered) metatile, with its extent set"""
+    size_px = n * tile_px + 2 * buffer_px
+    renderer = get_batch_renderer(size_px, size_px, dpi)
+    renderer.set_extent(*metatile_extent(metatileXYZ, n, tile_px, buffer_px))
+    return renderer
+
+
+def _crop(img: np.ndarray, buffer_px: int) -> np.ndarray:
+    """Copy of the image without the buffer margin"""
+    return img[buffer_px:img.shape[0] - buffer_px, buffer_px:img.shape[1] - buffer_px].copy()
+
+
+def slice_metatile(img: np.ndarray, metatileXYZ: TileXYZ, n: int = 8) -> Dict[TileXYZ, np.ndarray]:
+    """Slice the (unbuffered) metatile image into its n x n tile images (views of `img`)"""
+    tile_px = img.shape[0] // n
+    x0, y0, z = metatile_tiles(metatileXYZ, n)[0]
+    return {(x0 + i, y0 + j, z): img[j * tile_px:(j + 1) * tile_px, i * tile_px:(i + 1) * tile_px]
+            for i in range(n) for j in range(n)}
+
+
+def save_tiles(tile_imgs: Dict[TileXYZ, np.ndarray], out_dir: Path, suffix: str = '.png',
+               tiles: Optional[Iterable[TileXYZ]] = None, writer: Optional[TileWriter] = None,
+               palette: Optional[List] = None) -> None:
+    """Save the tile images as `out_dir`/z/f'{x}_{y}_{z}{suffix}' (RGB).
+    If `tiles` is given, only those tiles are saved. If a `writer` is given, the tiles are
+    queued to it (with its suffix, and `palette` for its 'png-palette' codec)"""
+    tiles = tile_imgs.keys() if tiles is None else tiles
+    if writer is not None:
+        for x, y, z in tiles:
+            writer.submit(out_dir / str(z) / f'{x}_{y}_{z}{writer.suffix}', tile_imgs[(x, y, z)][..., :3],
+                          (x, y, z), palette=palette)
+        return
+    with timer('save_png'):
+        for x, y, z in tiles:
+            write_png(out_dir / str(z) / f'{x}_{y}_{z}{suffix}', tile_imgs[(x, y, z)][..., :3])
+
+
+def rasterize_metatile(
+        G: Optional[Graph],
+        gdf_b: Optional[gpd.GeoDataFrame],
+        metatileXYZ: TileXYZ,
+        n: int,
+        bgcolors: List,
+        edge_colors: List,
+        bldg_colors: List,
+        lw_factors: List[float],
+        save: bool,
+        out_dir_root: Path,
+        tiles: Optional[Iterable[TileXYZ]] = None,
+        suffix: str = '.png',  # Note: Do include a dot
+        dpi=50,
+        figsize: Tuple[int, int] = (7, 7),
+        buffer_px: int = 16,
+        street_widths: Dict[str, float] = None,
+        verbose=False,
+        writer: Optional[TileWriter] = None,
+        footprint_fill: str = 'agg',
+        metric_widths: bool = False,
+) -> Dict[str, int]:
+    """Metatile version of `rasterize_road_and_bldg`: rasterize the road graph and bldg geoms
+    of the metatile in all (distinct) combinations of the style parameters, and (if save) save
+    each of its tiles to `out_dir_root`/{style_name}/z/f'{x}_{y}_{z}{suffix}', with the style
+    names of `rasterize_road_and_bldg` prefixed with `METATILE_PREFIX` (OSMnxMR-, OSMnxMB-,
+    OSMnxMRB-), since the tiles differ from its (see the module doc).
+    The layers are set once in this thread's `BatchRenderer`; only colors and widths change
+    between the styles. The image of each style is released once its tiles are saved.
+
+    Args
+    ----
+    - tiles: tiles of the metatile to save (Default: all n x n tiles)
+    - figsize, dpi: of a single tile, as in `rasterize_road_and_bldg` (tile_px = figsize[0] * dpi)
+    - buffer_px: margin rendered around the metatile and cropped, to avoid cut lines at its border
+    - writer: if given, the tiles are saved by it (see `save_tiles`)
+    - footprint_fill: 'agg' (matplotlib) or 'scanline' (see `renderer.set_footprint_layer`)
+    - metric_widths: draw the roads at their width on the ground, at the meters per pixel of the
+      metatile (see `renderer.batch_rasterize_road_and_bldg`)
+
+    Returns
+    -------
+    - dict of style_name -> number of its tiles saved
+    """
+    street_widths = DEFAULT_STREET_WIDTHS if street_widths is None else street_widths
+    tiles = None if tiles is None else list(tiles)  # saved for each style
+    has_bldg = gdf_b is not None and not gdf_b.empty
+    tile_px = int(round(figsize[0] * dpi))
+    renderer = _metatile_renderer(metatileXYZ, n, tile_px, buffer_px, dpi)
+    meters_per_px = getMetersPerPixel(*metatileXYZ, n * tile_px) if metric_widths else None
+    # undirected graph and per-edge street types, shared by all styles
+    if G is not None:
+        renderer.set_roads(*road_layer(G))
+    else:
+        renderer.set_roads(None)
+    set_footprint_layer(renderer, gdf_b if has_bldg else None, footprint_fill)
+
+    n_saved = {}
+    for bgcolor in bgcolors:
+        for edge_color in edge_colors:
+            if bgcolor == edge_color: continue
+            for bldg_color in bldg_colors:
+                for lw_factor in lw_factors:
+                    renderer.set_road_widths(street_widths, lw_factor, meters_per_px)
+                    styles = []
+                    if G is not None:
+                        styles.append((f'{METATILE_PREFIX}R-{bgcolor}-{edge_color}-{lw_factor}', 'render_road',
+                                       edge_color, None))
+                    if has_bldg:
+                        styles.append((f'{METATILE_PREFIX}B-{bgcolor}-{bldg_color}-{lw_factor}', 'render_bldg',
+                                       None, bldg_color))
+                        styles.append((f'{METATILE_PREFIX}RB-{bgcolor}-{edge_color}-{bldg_color}-{lw_factor}',
+                                       'render_road_bldg', edge_color, bldg_color))
+
+                    for style_name, stage, e_color, b_color in styles:
+                        with timer(stage):
+                            img = _crop(renderer.render(bgcolor, e_color, b_color), buffer_px)
+                        tile_imgs = slice_metatile(img, metatileXYZ, n)
+                        n_saved[style_name] = 0
+                        if save:
+                            palette = [c for c in (bgcolor, e_color, b_color) if c is not None]
+                            save_tiles(tile_imgs, out_dir_root / style_name, suffix, tiles, writer, palette)
+                            n_saved[style_name] = len(tile_imgs if tiles is None else tiles)
+                            if verbose:
+                                print(f'\tSaved {style_name} of metatile {metatileXYZ}')
+                        # don't keep the image of a style (n * tile_px squared RGBA) past its saving
+                        del img, tile_imgs
+    return n_saved
@@ -0,0 +1,215 @@
+"""Pyramid generation: derive the tiles of lower zoom levels from the rasterized tiles of the
+highest zoom, instead of retrieving and rendering each zoom level separately.
+
+A parent tile is the 2x2 mosaic of its children downsampled by 2:
+- color images (e.g. the OSMnx* styles) with a 2x2 box filter (mean), which anti-aliases the
+  lines as a render at the lower zoom would;
+- semantic arrays (class labels) with the mode of each 2x2 block (or its max, e.g. to keep
+  thin roads in a binary road mask), so that no new label is made up by averaging.
+
+Tiles are read from and written to the output layout of the rasterizers,
+`style_dir`/z/f'{x}_{y}_{z}{suffix}', as png images or .npy arrays.
+
+Usage
+-----
+from tilemani.rasterize.pyramid import build_pyramid
+
+# z=16 tiles in ./temp/images/paris/OSMnxR-k-cyan-0.5/16 -> zoom levels 15 and 14
+build_pyramid(Path('./temp/images/paris/OSMnxR-k-cyan-0.5'), max_zoom=16, min_zoom=14)
+"""
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from tilemani.utils.failures import capture
+from tilemani.utils.instrument import timer, count
+from tilemani.utils.tiles import TileXYZ, get_parent
+
+DOWNSAMPLE_MODES = ('mean', 'mode', 'max')
+
+
+def _blocks(arr: np.ndarray) -> np.ndarray:
+    """(H/2, W/2, 4, ...) view-like array of the 2x2 blocks of the (H, W, ...) array"""
+    h, w = arr.shape[:2]
+    if h % 2 or w % 2:
+        raise ValueError(f"height and width must be even to downsample by 2: {arr.shape}")
+    blocks = arr.reshape(h // 2, 2, w // 2, 2, *arr.shape[2:]).swapaxes(1, 2)
+    return blocks.reshape(h // 2, w // 2, 4, *arr.shape[2:])
+
+
+def downsample_2x2(arr: np.ndarray, mode: str = 'mean') -> np.ndarray:
+    """Downsample the (H, W) or (H, W, C) array by 2 in height and width.
+
+    Args
+    ----
+    mode : str
+        - 'mean': 2x2 box filter, rounded back to the dtype of `arr` (for color images)
+        - 'mode': most frequent value of each 2x2 block (for label arrays); ties go to the first
+          of the tied values in the block's order (top-left, top-right, bottom-left, bottom-right).
+          For a (H, W, C) array, the values are the C-vectors (e.g. the colors of a label image)
+        - 'max': max of each 2x2 block (e.g. for binary masks of thin features)
+    """
+    blocks = _blocks(arr)
+    if mode == 'mean':
+        mean = blocks.mean(axis=2, dtype=np.float32)
+        if np.issubdtype(arr.dtype, np.integer):
+            return np.rint(mean).astype(arr.dtype)
+        return mean.astype(arr.dtype)
+    if mode == 'max':
+        return blocks.max(axis=2)
+    if mode == 'mode':
+        # (H/2, W/2, 4, 4): whether value i of a block is equal to value j
+        eq = blocks[:, :, :, None] == blocks[:, :, None, :]
+        if arr.ndim == 3:
+            eq = eq.all(axis=-1)
+        winner = eq.sum(axis=-1).argmax(axis=-1)  # first of the most frequent values
+        return np.take_along_axis(blocks, winner.reshape(*winner.shape, 1, *([1] * (arr.ndim - 2))),
+                                  axis=2)[:, :, 0]
+    raise ValueError(f"mode must be one of {DOWNSAMPLE_MODES}: {mode}")
+
+
+def merge_children(children: Dict[Tuple[int, int], Optional[np.ndarray]],
+                   fill=0) -> np.ndarray:
+    """2x2 mosaic of the children tiles, keyed by their (dx, dy) position in the parent
+    (see `tilemani.utils.tiles.get_children`). Missing children (None or not in the dict)
+    are filled with `fill` (e.g. the background color of the style; an RGBA color is cut to
+    the number of channels of the tiles)."""
+    first = next(c for c in children.values() if c is not None)
+    h, w = first.shape[:2]
+    fill = np.asarray(fill, dtype=first.dtype)
+    if fill.ndim == 1 and first.ndim == 3:
+        fill = fill[:first.shape[2]]
+    mosaic = np.empty((2 * h, 2 * w, *first.shape[2:]), dtype=first.dtype)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = children.get((dx, dy))
+            mosaic[dy * h:(dy + 1) * h, dx * w:(dx + 1) * w] = fill if child is None else child
+    return mosaic
+
+
+def build_parent(children: Dict[Tuple[int, int], Optional[np.ndarray]],
+                 mode: str = 'mean', fill=0) -> np.ndarray:
+    """Parent tile (of the same size as a child) from its children tiles"""
+    return downsample_2x2(merge_children(children, fill), mode)
+
+
+def pyramid_from_arrays(tiles: Dict[TileXYZ, np.ndarray], min_zoom: int,
+                        mode: str = 'mean', fill=0) -> Dict[TileXYZ, np.ndarray]:
+    """In-memory pyramid: the tiles of the zoom levels below that of `tiles`, down to `min_zoom`.
+    Only the parents of the given tiles are built (other children are filled with `fill`).
+
+    Returns
+    -------
+    - dict of tileXYZ -> array of the built tiles (not including the input tiles)
+    """
+    built = {}
+    level = tiles
+    while level and next(iter(level))[2] > min_zoom:
+        parents = {}
+        for (x, y, z), arr in level.items():
+            parents.setdefault(get_parent((x, y, z)), {})[(x % 2, y % 2)] = arr
+        level = {parent: build_parent(children, mode, fill) for parent, children in parents.items()}
+        built.update(level)
+    return built
+
+
+def _tile_fp(style_dir: Path, tileXYZ: TileXYZ, suffix: str) -> Path:
+    x, y, z = tileXYZ
+    return style_dir / str(z) / f'{x}_{y}_{z}{suffix}'
+
+
+def read_tile(fp: Path) -> np.ndarray:
+    """Read a tile saved as an image (png, ...) or a .npy array.
+    Palette images are read as their indices (i.e. the labels of a semantic tile)"""
+    if fp.suffix == '.npy':
+        return np.load(fp)
+    with Image.open(fp) as im:
+        return np.asarray(im)
+
+
+def write_tile(fp: Path, arr: np.ndarray) -> None:
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    if fp.suffix == '.npy':
+        np.save(fp, arr)
+    else:
+        Image.fromarray(arr).save(fp)
+
+
+def list_tiles(style_dir: Path, zoom: int, suffix: str = '.png') -> List[TileXYZ]:
+    """Tiles saved in `style_dir`/zoom as f'{x}_{y}_{z}{suffix}'"""
+    tiles = []
+    for fp in (style_dir / str(zoom)).glob(f'*{suffix}'):
+        x, y, z = fp.name[:-len(suffix)].split('_')
+        tiles.append((int(x), int(y), int(z)))
+    return tiles
+
+
+def build_pyramid(
+        style_dir: Union[Path, str],
+        max_zoom: int,
+        min_zoom: int,
+        suffix: str = '.png',
+        mode: Optional[str] = None,
+        fill=0,
+        tiles: Optional[Iterable[TileXYZ]] = None,
+        overwrite: bool = True,
+        verbose: bool = False,
+) -> Dict[int, int]:
+    """Build the tiles of zoom levels max_zoom-1 ... min_zoom of the style from its tiles at
+    `max_zoom`, in the same layout: `style_dir`/z/f'{x}_{y}_{z}{suffix}'.
+
+    Each level is built from the previous one, one parent at a time (so only 4 children are
+    in memory at once). The cost is about 1/3 of that of the tiles at max_zoom, whatever the
+    number of levels, instead of a full retrieval and rendering per level.
+
+    Args
+    ----
+    mode : str
+        downsampling of `downsample_2x2`. Default: 'mode' for .npy (semantic arrays), else 'mean'
+    fill : scalar or array
+        value of the missing children tiles (e.g. the background color of the style)
+    tiles : iterable of tileXYZ
+        tiles at max_zoom to build from. Default: all the tiles in `style_dir`/max_zoom.
+        The tiles without a file (e.g. planned tiles with no road, which are not saved) are
+        missing children; a parent without any child file is not built
+    overwrite : bool
+        if False, parents that already exist are not built again
+
+    Returns
+    -------
+    - number of tiles built at each zoom level
+    """
+    style_dir = Path(style_dir)
+    mode = mode or ('mode' if suffix == '.npy' else 'mean')
+    level = set(list_tiles(style_dir, max_zoom, suffix) if tiles is None else tiles)
+
+    n_built = {}
+    for z in range(max_zoom, min_zoom, -1):
+        parents = {}
+        for (x, y, _) in level:
+            parents.setdefault(get_parent((x, y, z)), set()).add((x, y, z))
+
+        n_built[z - 1] = 0
+        next_level = set()
+        for parent, children in parents.items():
+            fp = _tile_fp(style_dir, parent, suffix)
+            if not overwrite and fp.exists():
+                next_level.add(parent)
+                continue
+            child_fps = {(x % 2, y % 2): _tile_fp(style_dir, (x, y, z), suffix) for (x, y, z) in children}
+            child_fps = {pos: child_fp for pos, child_fp in child_fps.items() if child_fp.exists()}
+            if not child_fps:
+                continue
+            with capture(parent, 'pyramid'), timer('pyramid'):
+                # the children without a file are missing, and filled by `build_parent`
+                arrs = {pos: read_tile(child_fp) for pos, child_fp in child_fps.items()}
+                write_tile(fp, build_parent(arrs, mode, fill))
+                n_built[z - 1] += 1
+                next_level.add(parent)
+                count('pyramid_tiles')
+        if verbose:
+            print(f'\tBuilt {n_built[z - 1]} tiles at zoom {z - 1} in: ', style_dir / str(z - 1))
+        level = next_level
+    return n_built
@@ -1,9 +1,158 @@
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Optional, Union
 from pathlib import Path
 import osmnx as ox
-from osmnx.plot import utils_graph, plot_graph
+from osmnx.plot import plot_graph
 import geopandas as gpd
+import numpy as np
+import matplotlib.pyplot as plt
 from networkx.classes.graph import Graph
+from tilemani.utils.instrument import timer
+from tilemani.utils.graph import get_undirected
+from tilemani.cfgs.osm.road import ROAD_CLASSES, parse_lanes
+
+
+def _save_show_close(fig, ax, save: bool, show: bool, close: bool, filepath: Path, dpi: int):
+    """Same as `osmnx.plot._save_and_show` (for raster formats), except that the canvas
+    is not drawn a second time before saving, and saving is timed as `save_png`
+    separately from the rendering.
+    Plot functions should be called with `save=False, show=False, close=False` before this.
+    """
+    if save:
+        with timer('save_png'):
+            filepath = Path(filepath)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            # constrain saved figure's extent to interior of the axis
+            extent = ax.bbox.transformed(fig.dpi_scale_trans.inverted())
+            # temporarily turn figure frame on to save with facecolor
+            fig.set_frameon(True)
+            fig.savefig(filepath, dpi=dpi, bbox_inches=extent, format=filepath.suffix.strip("."),
+                        facecolor=fig.get_facecolor(), transparent=True)
+            fig.set_frameon(False)
+    if show:
+        plt.show()
+    if close:
+        plt.close(fig)
+    return fig, ax
+
+
+class PreparedGraph:
+    """Undirected road graph with its per-edge street types and incidences as arrays, prepared
+    once and shared by all the renders (styles, lw_factors) of the same graph.
+
+    Per render, `edge_linewidths` and `node_sizes` only look up the widths of the (few)
+    distinct street types and scatter them to the edges/nodes with numpy, instead of
+    looping over the edges and the neighbors of every node in python.
+
+    Args
+    ----
+    G : networkx.MultiDiGraph
+        input graph, must be unprojected. An undirected graph (e.g. already converted with
+        `tilemani.utils.graph.get_undirected`) is used as is
+    """
+
+    def __init__(self, G: Graph):
+        self.G = G
+        # we need an undirected graph to find every edge incident on a node
+        # (converted once per graph, see `tilemani.utils.graph`)
+        self.Gu = get_undirected(G)
+        node_idx = {node: i for i, node in enumerate(self.Gu.nodes)}
+        self.n_nodes = len(node_idx)
+
+        highways, lanes, us, vs = [], [], [], []
+        first_key = {}  # (u, v) -> (smallest key, its edge)
+        for i, (u, v, k, d) in enumerate(self.Gu.edges(keys=True, data=True)):
+            highways.append(d["highway"])
+            lanes.append(d.get("lanes"))
+            us.append(node_idx[u])
+            vs.append(node_idx[v])
+            pair = frozenset((u, v))
+            if pair not in first_key or k < first_key[pair][0]:
+                first_key[pair] = (k, i)
+
+        # road class codes of all the types of all the edges, in one pass (see `RoadClassTable`);
+        # the types outside of the table get their own codes, after those of the table
+        self.flat_type, self.flat_edge, self.extra_types = ROAD_CLASSES.encode_flat_extended(highways)
+        self.street_types = ROAD_CLASSES.names + self.extra_types  # code -> street type
+        # code of the first type of each edge
+        self.edge_type = ROAD_CLASSES.first_codes(self.flat_type, self.flat_edge, len(highways))
+        # road class of each edge (that of the road type of a link outside of the table, else 'other')
+        self.edge_class = ROAD_CLASSES.classes_of(self.edge_type, self.extra_types)
+        self.edge_lanes = parse_lanes(lanes)  # number of lanes of each edge (NaN if not tagged)
+        self.u = np.asarray(us, dtype=np.int64)
+        self.v = np.asarray(vs, dtype=np.int64)
+        # as in `Gu.get_edge_data(node, nbr)[min(keys)]`, only the parallel edge with the
+        # smallest key counts for the joints
+        self.joint_edge = np.zeros(len(highways), dtype=bool)
+        self.joint_edge[[i for _, i in first_key.values()]] = True
+        self._lines = None
+
+    def __len__(self):
+        return self.n_nodes
+
+    def type_widths(self, street_widths: Dict[str, float], default_width: float,
+                    lw_factor: float = 1.) -> np.ndarray:
+        """Width of each street type (by code). The widths in `street_widths` are scaled by
+        `lw_factor`, the fallback `default_width` is not. The types outside of the road class
+        table are looked up by their own name (e.g. a 'busway' key applies to the busways)"""
+        widths = np.concatenate([ROAD_CLASSES.lookup(street_widths),
+                                 [street_widths.get(t, np.nan) for t in self.extra_types]]) * lw_factor
+        return np.where(np.isnan(widths), default_width, widths)
+
+    def edge_linewidths(self, street_widths: Dict[str, float], default_width: float,
+                        lw_factor: float = 1.) -> np.ndarray:
+        """Linewidth of each edge (in the order of `Gu.edges`) according to its street type"""
+        if not len(self.edge_type):
+            return np.empty(0)
+        return self.type_widths(street_widths, default_width, lw_factor)[self.edge_type]
+
+    def node_sizes(self, street_widths: Dict[str, float], default_width: float,
+                   lw_factor: float = 1.) -> np.ndarray:
+        """Marker size (area) of each node (in the order of `Gu.nodes`) that smooths the joints
+        of its incident edges.
+
+        Node diameter equals the largest width of the street types of its incident edges, to
+        make joints perfectly smooth (0 for a node without edges). Circle marker sizes are in
+        area, so the diameter is squared.
+        """
+        if not len(self.edge_type):
+            return np.zeros(self.n_nodes)
+        widths = self.type_widths(street_widths, default_width, lw_factor)
+        edge_max = np.zeros(len(self.edge_type))
+        np.maximum.at(edge_max, self.flat_edge, widths[self.flat_type])
+        return self.joint_sizes(edge_max)
+
+    def joint_sizes(self, edge_widths: np.ndarray) -> np.ndarray:
+        """Marker size (area) of each node for the given width of each edge: the largest width of
+        its incident (joint) edges, squared"""
+        node_widths = np.zeros(self.n_nodes)
+        if len(edge_widths):
+            np.maximum.at(node_widths, self.u[self.joint_edge], edge_widths[self.joint_edge])
+            np.maximum.at(node_widths, self.v[self.joint_edge], edge_widths[self.joint_edge])
+        return node_widths ** 2
+
+    def edge_meters(self, radius_per_lane: Optional[float] = None) -> np.ndarray:
+        """Width (meters on the ground) of each edge, from its lanes tag or its road class
+        (see `RoadClassTable.metric_widths`)"""
+        return ROAD_CLASSES.metric_widths(self.edge_class, self.edge_lanes, radius_per_lane)
+
+    def edge_lines(self) -> List[np.ndarray]:
+        """lng/lat coordinates of each edge (in the order of `Gu.edges`), computed once"""
+        if self._lines is None:
+            nodes = self.Gu.nodes
+            self._lines = [np.asarray(d["geometry"].coords) if "geometry" in d
+                           else np.array([[nodes[u]["x"], nodes[u]["y"]], [nodes[v]["x"], nodes[v]["y"]]])
+                           for u, v, d in self.Gu.edges(keys=False, data=True)]
+        return self._lines
+
+    def node_coords(self) -> np.ndarray:
+        """(N, 2) array of the lng/lat of the nodes (in the order of `Gu.nodes`)"""
+        return np.array([(d["x"], d["y"]) for _, d in self.Gu.nodes(data=True)],
+                        dtype=float).reshape(-1, 2)
+
+
+def prepare_graph(G: Union[Graph, PreparedGraph]) -> PreparedGraph:
+    """`G` prepared for rendering (as is if it's already a PreparedGraph)"""
+    return G if isinstance(G, PreparedGraph) else PreparedGraph(G)
 
 
 def plot_figure_ground(
@@ -15,6 +164,7 @@ def plot_figure_ground(
     figsize=(8, 8),
     edge_color="w",
     smooth_joints=True,
+    lw_factor=1.0,
     **pg_kwargs,
 ):
     """Plot a figure-ground diagram of a street network.
@@ -33,8 +183,9 @@ def plot_figure_ground(
 
     Parameters
     ----------
-    G : networkx.MultiDiGraph
-        input graph, must be unprojected
+    G : networkx.MultiDiGraph or PreparedGraph
+        input graph, must be unprojected. Pass a `PreparedGraph` to render the same graph
+        several times (e.g. in several styles) without preparing it for each render
     bbox : Tuple of numeric
         how many meters to extend north, south, east, west from center point
     network_type : string
@@ -50,6 +201,8 @@ def plot_figure_ground(
     smooth_joints : bool
         if True, plot nodes same width as streets to smooth line joints and
         prevent cracks between them from showing
+    lw_factor : float
+        scale of the widths in street_widths (not of default_width)
     pg_kwargs
         keyword arguments to pass to plot_graph
     Returns
@@ -71,52 +224,14 @@ def plot_figure_ground(
             "motorway": 6,
         }
 
-    # we need an undirected graph to find every edge incident on a node
-    Gu = utils_graph.get_undirected(G)
+    pg = prepare_graph(G)
 
     # for each edge, get a linewidth according to street type
-    edge_linewidths = []
-    for _, _, d in Gu.edges(keys=False, data=True):
-        street_type = d["highway"][0] if isinstance(d["highway"], list) else d["highway"]
-        if street_type in street_widths:
-            edge_linewidths.append(street_widths[street_type])
-        else:
-            edge_linewidths.append(default_width)
+    edge_linewidths = pg.edge_linewidths(street_widths, default_width, lw_factor)
 
     if smooth_joints:
-        # for each node, get a nodesize according to the narrowest incident edge
-        node_widths = dict()
-        for node in Gu.nodes:
-            # first, identify all the highway types of this node's incident edges
-            ie_data = [Gu.get_edge_data(node, nbr) for nbr in Gu.neighbors(node)]
-            edge_types = [d[min(d)]["highway"] for d in ie_data]
-            if not edge_types:
-                # if node has no incident edges, make size zero
-                node_widths[node] = 0
-            else:
-                # flatten the list of edge types
-                et_flat = []
-                for et in edge_types:
-                    if isinstance(et, list):
-                        et_flat.extend(et)
-                    else:
-                        et_flat.append(et)
-
-                # lookup corresponding width for each edge type in flat list
-                edge_widths = [
-                    street_widths[et] if et in street_widths else default_width for et in et_flat
-                ]
-
-                # node diameter should equal largest edge width to make joints
-                # perfectly smooth. alternatively use min(?) to prevent
-                # anything larger from extending past smallest street's line.
-                # circle marker sizes are in area, so use diameter squared.
-                circle_diameter = max(edge_widths)
-                circle_area = circle_diameter ** 2
-                node_widths[node] = circle_area
-
-        # assign the node size to each node in the graph
-        node_sizes = [node_widths[node] for node in Gu.nodes]
+        # for each node, get a nodesize according to the widest incident edge
+        node_sizes = pg.node_sizes(street_widths, default_width, lw_factor)
     else:
         node_sizes = 0
 
@@ -127,7 +242,7 @@ def plot_figure_ground(
     override = {"bbox", "node_size", "node_color", "edge_linewidth"}
     kwargs = {k: v for k, v in pg_kwargs.items() if k not in override}
     fig, ax = plot_graph(
-        G=Gu,
+        G=pg.Gu,
         bbox=bbox,
         figsize=figsize,
         node_size=node_sizes,
@@ -191,31 +306,31 @@ def rasterize_road_graph(
         }
     x, y, z = tileXYZ
     filename = f'{x}_{y}_{z}{suffix}'
+    # undirected graph and per-edge street types, shared by all styles
+    pg = prepare_graph(G)
 
     for bgcolor in bgcolors:
         for edge_color in edge_colors:
             if bgcolor == edge_color: continue
             for lw_factor in lw_factors:
-                # Scale the edge widths of each street type
-                lw = {k: v * lw_factor for (k, v) in street_widths.items()}
-
                 style_name = f'OSMnxR-{bgcolor}-{edge_color}-{lw_factor}'
                 fp = out_dir_root / style_name / str(z)/ filename
 
-                f, ax = plot_figure_ground(
-                    G,
-                    bbox=bbox,
-                    street_widths=lw,
-                    figsize=figsize,
-                    bgcolor=bgcolor,
-                    node_color=edge_color,
-                    edge_color=edge_color,
-                    show=show,
-                    close=True,
-                    save=save,  # false?
-                    filepath=fp,
-                    dpi=dpi,
-                )
+                with timer('render_road'):
+                    f, ax = plot_figure_ground(
+                        pg,
+                        bbox=bbox,
+                        street_widths=street_widths,
+                        lw_factor=lw_factor,
+                        figsize=figsize,
+                        bgcolor=bgcolor,
+                        node_color=edge_color,
+                        edge_color=edge_color,
+                        show=False,
+                        close=False,
+                        save=False,
+                    )
+                _save_show_close(f, ax, save, show, True, fp, dpi)
                 if show and show_only_once:
                     show = False
 
@@ -293,34 +408,34 @@ def rasterize_road_and_bldg(
     if verbose:
         print('rasterize_road_and_blgd -- x,y,z: ', x, y, z)
         # print('dpi: ', dpi)
+    # undirected graph and per-edge street types, shared by all styles
+    pg = prepare_graph(G) if G is not None else None
 
     for bgcolor in bgcolors:
         for edge_color in edge_colors:
             if bgcolor == edge_color: continue
             for bldg_color in bldg_colors:
                 for lw_factor in lw_factors:
-                    # Scale the edge widths of each street type
-                    lw = {k: v * lw_factor for (k, v) in street_widths.items()}
-
                     style_name, fp = '', ''
                     # 1. Plot road network
                     if G is not None:
                         style_name = f'OSMnxR-{bgcolor}-{edge_color}-{lw_factor}'
                         fp = out_dir_root / style_name / str(z) / filename
-                        f, ax = plot_figure_ground(
-                            G,
-                            bbox=bbox,
-                            street_widths=lw,
-                            figsize=figsize,
-                            bgcolor=bgcolor,
-                            node_color=edge_color,
-                            edge_color=edge_color,
-                            show=show,
-                            close=True,
-                            save=save,  # false?
-                            filepath=fp,
-                            dpi=dpi,
-                        )
+                        with timer('render_road'):
+                            f, ax = plot_figure_ground(
+                                pg,
+                                bbox=bbox,
+                                street_widths=street_widths,
+                                lw_factor=lw_factor,
+                                figsize=figsize,
+                                bgcolor=bgcolor,
+                                node_color=edge_color,
+                                edge_color=edge_color,
+                                show=False,
+                                close=False,
+                                save=False,
+                            )
+                        _save_show_close(f, ax, save, show, True, fp, dpi)
                         if verbose:
                             print('\tSaved ROAD to: ', fp)
 
@@ -333,37 +448,37 @@ def rasterize_road_and_bldg(
                         # (a) Plot only bldg footprints
                         style_name = f'OSMnxB-{bgcolor}-{bldg_color}-{lw_factor}'
                         fp = out_dir_root / style_name / str(z) / filename
-                        _ = ox.plot_footprints(
-                            gdf_b,
-                            figsize=figsize,
-                            color=bldg_color,
-                            bgcolor=bgcolor,
-                            bbox=bbox,
-                            show=show,
-                            close=True,
-                            save=save,
-                            filepath=fp,
-                            dpi=dpi,
-                        )
+                        with timer('render_bldg'):
+                            f_b, ax_b = ox.plot_footprints(
+                                gdf_b,
+                                figsize=figsize,
+                                color=bldg_color,
+                                bgcolor=bgcolor,
+                                bbox=bbox,
+                                show=False,
+                                close=False,
+                                save=False,
+                            )
+                        _save_show_close(f_b, ax_b, save, show, True, fp, dpi)
                         if verbose:
                             print('\tSaved BLDG to: ', fp)
 
                         # (b) Plot bldg footprints, on top of the road-graph image
                         style_name = f'OSMnxRB-{bgcolor}-{edge_color}-{bldg_color}-{lw_factor}'
                         fp = out_dir_root / style_name / str(z)/ filename
-                        f, ax = ox.plot_footprints(
-                            gdf_b,
-                            ax=ax,
-                            figsize=figsize,
-                            color=bldg_color,
-                            bgcolor=bgcolor,
-                            bbox=bbox,
-                            show=show,
-                            close=True,
-                            save=save,
-                            filepath=fp,
-                            dpi=dpi,
-                        )
+                        with timer('render_road_bldg'):
+                            f, ax = ox.plot_footprints(
+                                gdf_b,
+                                ax=ax,
+                                figsize=figsize,
+                                color=bldg_color,
+                                bgcolor=bgcolor,
+                                bbox=bbox,
+                                show=False,
+                                close=False,
+                                save=False,
+                            )
+                        _save_show_close(f, ax, save, show, True, fp, dpi)
                         if verbose:
                             print('\tSaved BLDG and ROAD to: ', fp)
 
@@ -0,0 +1,342 @@
+"""Headless batch renderer: one matplotlib figure and Agg canvas per worker, reused for all
+the renders (tiles x styles) of the worker.
+
+`rasterize_road_and_bldg` creates, saves and closes a new figure (via osmnx) for every style
+of every tile; for small tiles, building and tearing down the figure, axes and canvas costs
+more than drawing. `BatchRenderer` keeps a single figure with one collection per layer
+(road lines, joint markers, bldg footprints), updates their data, colors and widths between
+renders, and reads the pixels straight from the canvas with `fig_to_np` (no `savefig`).
+
+The layers are drawn in Web Mercator, with the axes filling the figure, so the extent of an
+image is exactly the given bbox.
+
+Usage
+-----
+from tilemani.rasterize.renderer import get_batch_renderer, road_layer, footprint_layer
+
+renderer = get_batch_renderer(350, 350, dpi=50)  # one per thread
+renderer.set_extent(*bbox_to_extent(bbox))
+renderer.set_roads(*road_layer(G_r))
+renderer.set_footprints(*footprint_layer(gdf_b))
+img = renderer.render(bgcolor='k', edge_color='cyan', bldg_color='silver')  # (350, 350, 4) view
+"""
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from PIL import Image
+from matplotlib import rcParams
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.path import Path as MplPath
+from networkx.classes.graph import Graph
+
+from tilemani.rasterize.footprints import rasterize_footprints, composite, solid
+from tilemani.rasterize.rasterizer import PreparedGraph, prepare_graph
+from tilemani.rasterize.writer import TileWriter
+from tilemani.utils.geo import getMetersPerPixel
+from tilemani.utils.instrument import timer, count
+from tilemani.utils.np import fig_to_np
+from tilemani.utils.projection import get_tile_context
+from tilemani.utils.tiles import lnglat_to_mercator
+
+DEFAULT_STREET_WIDTHS = {
+    "footway": 1.5,
+    "steps": 1.5,
+    "pedestrian": 1.5,
+    "service": 1.5,
+    "path": 1.5,
+    "track": 1.5,
+    "motorway": 3,
+}
+
+
+def bbox_to_extent(bbox: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+    """Web Mercator extent (xmin, ymin, xmax, ymax) of the lat,lng bbox (north, south, east, west)"""
+    north, south, east, west = bbox
+    (xmin, xmax), (ymin, ymax) = lnglat_to_mercator([west, east], [south, north])
+    return float(xmin), float(ymin), float(xmax), float(ymax)
+
+
+def figure_ground_px(figsize: Tuple[float, float], dpi: int) -> int:
+    """Size in pixels of the (square) tiles saved by `rasterize_road_and_bldg` for the figsize and
+    dpi: the extent of the equal-aspect axes of a default subplot, e.g. 269 for (7, 7) at 50 dpi"""
+    w = figsize[0] * dpi * (rcParams['figure.subplot.right'] - rcParams['figure.subplot.left'])
+    h = figsize[1] * dpi * (rcParams['figure.subplot.top'] - rcParams['figure.subplot.bottom'])
+    return int(min(w, h))
+
+
+def road_layer(G: Union[Graph, PreparedGraph]) -> Tuple[PreparedGraph, List[np.ndarray], np.ndarray]:
+    """Road graph prepared for `BatchRenderer.set_roads`: the prepared graph (for the widths),
+    the Web Mercator lines of its edges and the Web Mercator coordinates of its nodes, from the
+    graph's (cached) `TileContext`"""
+    pg = prepare_graph(G)
+    ctx = get_tile_context(pg.G)
+    return pg, ctx.edge_lines(), ctx.node_xy
+
+
+def footprint_layer(gdf_b: Optional[gpd.GeoDataFrame]) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Vertices and path codes (Web Mercator) of the bldg footprints (polygons only), for
+    `BatchRenderer.set_footprints`. Each polygon is a single path with its holes as
+    sub-paths, oriented so that the holes are not filled. All the vertices are oriented and
+    projected at once"""
+    if gdf_b is None or gdf_b.empty:
+        return [], []
+    geoms = gdf_b.geometry.values
+    polygons = shapely.get_parts(geoms[np.isin(shapely.get_type_id(geoms), [3, 6])])
+    if not len(polygons):
+        return [], []
+    rings, ring_polygon = shapely.get_rings(polygons, return_index=True)
+    coords, point_ring = shapely.get_coordinates(rings, return_index=True)
+    n_points = np.bincount(point_ring, minlength=len(rings))
+    ring_start = np.concatenate([[0], np.cumsum(n_points)[:-1]])
+    ring_stop = ring_start + n_points
+
+    # exterior ccw, holes cw: nonzero winding leaves holes empty
+    exterior = np.concatenate([[True], ring_polygon[1:] != ring_polygon[:-1]])
+    flip = (shapely.is_ccw(rings) != exterior)[point_ring]
+    idx = np.arange(len(coords))
+    idx[flip] = (ring_start + ring_stop - 1)[point_ring[flip]] - idx[flip]
+    xy = np.column_stack(lnglat_to_mercator(coords[idx, 0], coords[idx, 1]))
+
+    codes = np.full(len(coords), MplPath.LINETO, dtype=np.uint8)
+    codes[ring_start] = MplPath.MOVETO
+    codes[ring_stop - 1] = MplPath.CLOSEPOLY
+    polygon_start = ring_start[exterior][1:]
+    return np.split(xy, polygon_start), np.split(codes, polygon_start)
+
+
+class BatchRenderer:
+    """A figure of `width_px` x `height_px` pixels with an Agg canvas and an axes filling it,
+    reused for many renders. Not thread-safe: use one per thread (see `get_batch_renderer`).
+
+    Line widths and marker sizes are in points, as in `plot_figure_ground`, so the images look
+    the same as those of `rasterize_road_and_bldg` of the same size and dpi.
+    """
+
+    def __init__(self, width_px: int, height_px: int, dpi: int = 50):
+        self.width_px, self.height_px, self.dpi = width_px, height_px, dpi
+        # half a pixel more, since the canvas size in pixels is truncated (not rounded) by Agg
+        self.fig = Figure(figsize=((width_px + 0.5) / dpi, (height_px + 0.5) / dpi), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+
+        self.roads = LineCollection([], zorder=1)
+        self.joints = self.ax.scatter(np.empty(0), np.empty(0), linewidths=0, zorder=2)
+        self.bldgs = PolyCollection([], linewidths=0, zorder=3)
+        self.ax.add_collection(self.roads)
+        self.ax.add_collection(self.bldgs)
+        self._pg = None
+        self._coverage = None  # bldg coverage of `fill_footprints`
+        self.extent = None
+
+    def set_extent(self, xmin: float, ymin: float, xmax: float, ymax: float) -> None:
+        self.extent = (xmin, ymin, xmax, ymax)
+        self.ax.set_xlim(xmin, xmax)
+        self.ax.set_ylim(ymin, ymax)
+
+    def set_roads(self, pg: Optional[PreparedGraph], lines: List[np.ndarray] = (),
+                  node_xy: Optional[np.ndarray] = None) -> None:
+        """Set the road layer (see `road_layer`); None to clear it"""
+        self._pg = pg
+        self.roads.set_segments(lines if pg is not None else [])
+        self.joints.set_offsets(node_xy if pg is not None else np.empty((0, 2)))
+
+    def set_footprints(self, verts: List[np.ndarray], codes: List[np.ndarray]) -> None:
+        """Set the bldg layer (see `footprint_layer`)"""
+        self._coverage = None
+        self.bldgs.set_verts_and_codes(verts, codes)
+
+    def fill_footprints(self, gdf_b: Optional[gpd.GeoDataFrame], supersample: int = 1) -> None:
+        """Set the bldg layer as the coverage of the footprints in the current extent, filled
+        with `tilemani.rasterize.footprints` and composited over the render (instead of drawn
+        by matplotlib). Call after `set_extent`"""
+        self.bldgs.set_verts([])
+        self._coverage = rasterize_footprints(gdf_b, self.extent, self.width_px, self.height_px,
+                                              supersample)
+
+    def set_widths(self, street_widths: Dict[str, float], default_width: float = 4,
+                   lw_factor: float = 1., smooth_joints: bool = True) -> None:
+        """Set the widths of the road lines and joints as in `plot_figure_ground`"""
+        if self._pg is None:
+            return
+        self.roads.set_linewidths(self._pg.edge_linewidths(street_widths, default_width, lw_factor))
+        self.joints.set_sizes(self._pg.node_sizes(street_widths, default_width, lw_factor)
+                              if smooth_joints else [0])
+
+    def set_metric_widths(self, meters_per_px: float, lw_factor: float = 1.,
+                          smooth_joints: bool = True) -> None:
+        """Set the widths of the road lines and joints to the widths of the roads on the ground
+        (`PreparedGraph.edge_meters`, scaled by `lw_factor`), for images of `meters_per_px`"""
+        if self._pg is None:
+            return
+        # meters -> pixels -> points
+        widths = self._pg.edge_meters() * lw_factor / meters_per_px * 72 / self.dpi
+        self.roads.set_linewidths(widths)
+        self.joints.set_sizes(self._pg.joint_sizes(widths) if smooth_joints else [0])
+
+    def set_road_widths(self, street_widths: Dict[str, float], lw_factor: float = 1.,
+                        meters_per_px: Optional[float] = None) -> None:
+        """`set_metric_widths` if `meters_per_px` is given, `set_widths` otherwise"""
+        if meters_per_px is not None:
+            self.set_metric_widths(meters_per_px, lw_factor)
+        else:
+            self.set_widths(street_widths, lw_factor=lw_factor)
+
+    def render(self, bgcolor='k', edge_color=None, bldg_color=None) -> np.ndarray:
+        """Draw the layers with the given colors; a layer whose color is None is hidden.
+
+        Returns
+        -------
+        - (height_px, width_px, 4) uint8 RGBA view of the canvas' buffer. It's overwritten by the
+          next render: copy it (or write it out) before rendering again.
+          (A new array if the bldgs are composited, see `fill_footprints`)
+        """
+        self.fig.set_facecolor(bgcolor)
+        self.ax.set_facecolor(bgcolor)
+        show_roads = edge_color is not None and self._pg is not None
+        self.roads.set_visible(show_roads)
+        self.joints.set_visible(show_roads)
+        if show_roads:
+            self.roads.set_color(edge_color)
+            self.joints.set_facecolor(edge_color)
+        composited = self._coverage is not None and bldg_color is not None
+        self.bldgs.set_visible(bldg_color is not None and not composited)
+        if bldg_color is not None:
+            self.bldgs.set_facecolor(bldg_color)
+        if composited and not show_roads:
+            return composite(solid(self.height_px, self.width_px, bgcolor), self._coverage, bldg_color)
+
+        count('batch_renders')
+        img = fig_to_np(self.fig)
+        return composite(img, self._coverage, bldg_color) if composited else img
+
+
+_local = threading.local()
+
+
+def get_batch_renderer(width_px: int, height_px: int, dpi: int = 50) -> BatchRenderer:
+    """The BatchRenderer of this thread (worker) for the image size and dpi"""
+    renderers = getattr(_local, 'renderers', None)
+    if renderers is None:
+        renderers = _local.renderers = {}
+    key = (width_px, height_px, dpi)
+    if key not in renderers:
+        renderers[key] = BatchRenderer(width_px, height_px, dpi)
+    return renderers[key]
+
+
+FOOTPRINT_FILLS = ('agg', 'scanline')
+
+
+def set_footprint_layer(renderer: BatchRenderer, gdf_b: Optional[gpd.GeoDataFrame],
+                        footprint_fill: str = 'agg') -> None:
+    """Set the bldg layer of the renderer, drawn by matplotlib ('agg') or filled with
+    `tilemani.rasterize.footprints` ('scanline')"""
+    if footprint_fill == 'agg':
+        renderer.set_footprints(*footprint_layer(gdf_b))
+    elif footprint_fill == 'scanline':
+        with timer('fill_footprints'):
+            renderer.fill_footprints(gdf_b)
+    else:
+        raise ValueError(f"footprint_fill must be one of {FOOTPRINT_FILLS}: {footprint_fill}")
+
+
+def write_png(fp: Path, img: np.ndarray) -> None:
+    """Save the RGB(A) image as a png"""
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(np.ascontiguousarray(img)).save(fp)
+
+
+def batch_rasterize_road_and_bldg(
+        G: Optional[Union[Graph, PreparedGraph]],
+        gdf_b: Optional[gpd.GeoDataFrame],
+        tileXYZ: Tuple[int, int, int],
+        bbox: Tuple[float],
+        bgcolors: List,
+        edge_colors: List,
+        bldg_colors: List,
+        lw_factors: List[float],
+        save: bool,
+        out_dir_root: Path,
+        suffix: str = '.png',  # Note: Do include a dot
+        dpi=50,
+        verbose=False,
+        figsize: Tuple[int, int] = (7, 7),
+        street_widths: Dict[str, float] = None,
+        writer: Optional[TileWriter] = None,
+        footprint_fill: str = 'agg',
+        metric_widths: bool = False,
+        **kwargs,
+) -> Dict[str, np.ndarray]:
+    """Same as `rasterize_road_and_bldg` (same styles, style names, image size and output layout),
+    but rendered with this thread's `BatchRenderer`: the layers of the tile are set once and
+    only the colors and widths change between styles.
+    Other kwargs of `rasterize_road_and_bldg` (show, show_only_once) are ignored.
+    If a `writer` is given, the tiles are saved by it (off this thread, with its codec and
+    suffix; a 'png-palette' writer gets the colors of each style as palette).
+    With footprint_fill='scanline', the bldg footprints are filled once per tile by
+    `BatchRenderer.fill_footprints` (no anti-aliasing) and composited over each style,
+    instead of drawn by matplotlib ('agg').
+    With metric_widths=True, the roads are drawn at their width on the ground (from their lanes
+    tag, or their road class), at the meters per pixel of the tile (`getMetersPerPixel`), times
+    each lw_factor; `street_widths` is ignored.
+
+    Returns
+    -------
+    - dict of style_name -> image (RGBA) of the tile
+    """
+    street_widths = DEFAULT_STREET_WIDTHS if street_widths is None else street_widths
+    x, y, z = tileXYZ
+    suffix = writer.suffix if writer is not None else suffix
+    filename = f'{x}_{y}_{z}{suffix}'
+    size_px = figure_ground_px(figsize, dpi)
+    renderer = get_batch_renderer(size_px, size_px, dpi)
+    renderer.set_extent(*bbox_to_extent(bbox))
+    meters_per_px = getMetersPerPixel(x, y, z, size_px) if metric_widths else None
+    if G is not None:
+        renderer.set_roads(*road_layer(G))
+    else:
+        renderer.set_roads(None)
+        print('\tNo road network is plotted/saved: ', x, y, z)
+    has_bldg = gdf_b is not None and not gdf_b.empty
+    set_footprint_layer(renderer, gdf_b if has_bldg else None, footprint_fill)
+    if not has_bldg:
+        print('\tNo bldg footprint is plotted/saved: ', x, y, z)
+
+    images = {}
+    for bgcolor in bgcolors:
+        for edge_color in edge_colors:
+            if bgcolor == edge_color: continue
+            for bldg_color in bldg_colors:
+                for lw_factor in lw_factors:
+                    renderer.set_road_widths(street_widths, lw_factor, meters_per_px)
+                    styles = []
+                    if G is not None:
+                        styles.append((f'OSMnxR-{bgcolor}-{edge_color}-{lw_factor}', 'render_road',
+                                       edge_color, None))
+                    if has_bldg:
+                        styles.append((f'OSMnxB-{bgcolor}-{bldg_color}-{lw_factor}', 'render_bldg',
+                                       None, bldg_color))
+                        styles.append((f'OSMnxRB-{bgcolor}-{edge_color}-{bldg_color}-{lw_factor}',
+                                       'render_road_bldg', edge_color, bldg_color))
+                    for style_name, stage, e_color, b_color in styles:
+                        with timer(stage):
+                            img = renderer.render(bgcolor, e_color, b_color).copy()
+                        images[style_name] = img
+                        if save:
+                            fp = out_dir_root / style_name / str(z) / filename
+                            if writer is not None:
+                                palette = [c for c in (bgcolor, e_color, b_color) if c is not None]
+                                writer.submit(fp, img, tileXYZ, palette=palette)
+                            else:
+                                with timer('save_png'):
+                                    write_png(fp, img)
+                            if verbose:
+                                print(f'\tSaved {style_name} to: ', fp)
+    return images
@@ -0,0 +1,199 @@
+"""Tile writer: encode and save the rasterized tiles in a thread pool, off the render thread,
+with a selectable codec.
+
+Codecs
+------
+- 'png': RGB(A) png at zlib `compress_level` (0-9; PIL's default is 6, lower is faster)
+- 'png-palette': indexed png, with a palette of the colors of the tile (or of the given
+  `palette`, to which each pixel is snapped). Bit depth is the smallest that fits the palette:
+  a two-color figure-ground tile is a 1-bit png, several times smaller and faster to encode
+- 'webp': lossless webp
+- 'raw': the array as a .npy file (no encoding)
+
+PIL and zlib release the GIL while compressing, so the encoding of several tiles runs in
+parallel with the rendering of the next ones.
+
+Usage
+-----
+from tilemani.rasterize.writer import TileWriter
+
+with TileWriter(codec='png-palette', max_workers=4) as writer:
+    for tileXYZ, img in rendered:  # img must not be modified after it is submitted
+        writer.submit(out_dir / f'{x}_{y}_{z}{writer.suffix}', img, tileXYZ)
+# all tiles are written when the block exits
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+from matplotlib.colors import to_rgb
+
+from tilemani.utils.failures import get_failure_log
+from tilemani.utils.instrument import timer, count
+
+CODECS = ('png', 'png-palette', 'webp', 'raw')
+CODEC_SUFFIX = {'png': '.png', 'png-palette': '.png', 'webp': '.webp', 'raw': '.npy'}
+
+
+def _pack_rgb(rgb: np.ndarray) -> np.ndarray:
+    """(H, W, 3) uint8 -> (H, W) uint32 of 0xRRGGBB"""
+    rgb = rgb.astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def to_palette(img: np.ndarray, palette: Optional[Sequence] = None,
+               max_colors: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+    """Indexed version of the (opaque) RGB(A) image; the alpha channel is dropped.
+
+    Args
+    ----
+    palette : list of colors (matplotlib color names/hex strings or RGB uint8 triplets)
+        if given, each pixel is snapped to the nearest color of the palette (e.g. the
+        bgcolor and edge_color of a figure-ground style, to drop the anti-aliased shades).
+        Otherwise the palette is the colors of the image, which must have at most `max_colors`
+
+    Returns
+    -------
+    - (H, W) uint8 array of indices, (n_colors, 3) uint8 palette
+    """
+    rgb = img[..., :3]
+    if palette is None:
+        colors, indices = np.unique(_pack_rgb(rgb), return_inverse=True)
+        if len(colors) > max_colors:
+            raise ValueError(f"image has {len(colors)} colors, more than max_colors={max_colors}: "
+                             f"give a palette to snap the pixels to")
+        palette = np.stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255], axis=-1)
+        return indices.reshape(rgb.shape[:2]).astype(np.uint8), palette.astype(np.uint8)
+
+    palette = np.array([np.rint(np.multiply(to_rgb(c), 255)) if isinstance(c, str) else c[:3]
+                        for c in palette], dtype=np.int32)
+    if len(palette) > max_colors:
+        raise ValueError(f"palette has more than max_colors={max_colors} colors: {len(palette)}")
+    # squared distance of each pixel to each palette color, (H, W, n_colors)
+    dist = ((rgb[..., None, :].astype(np.int32) - palette) ** 2).sum(axis=-1)
+    return dist.argmin(axis=-1).astype(np.uint8), palette.astype(np.uint8)
+
+
+def _bits(n_colors: int) -> int:
+    for bits in (1, 2, 4):
+        if n_colors <= 2 ** bits:
+            return bits
+    return 8
+
+
+def encode_tile(fp: Path, img: np.ndarray, codec: str = 'png', compress_level: int = 6,
+                palette: Optional[Sequence] = None) -> None:
+    """Save the tile image (H, W[, C]) uint8 array to `fp` with the codec (see the module doc)"""
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    if codec == 'raw':
+        np.save(fp, img)
+    elif codec == 'png':
+        Image.fromarray(np.ascontiguousarray(img)).save(fp, format='PNG', compress_level=compress_level)
+    elif codec == 'png-palette':
+        indices, colors = to_palette(img, palette)
+        im = Image.fromarray(indices, mode='P')
+        im.putpalette(colors.ravel().tolist())
+        im.save(fp, format='PNG', compress_level=compress_level, bits=_bits(len(colors)))
+    elif codec == 'webp':
+        Image.fromarray(np.ascontiguousarray(img)).save(fp, format='WEBP', lossless=True)
+    else:
+        raise ValueError(f"codec must be one of {CODECS}: {codec}")
+
+
+class TileWriter:
+    """Writes tiles with a codec in a pool of `max_workers` threads.
+
+    `submit` returns as soon as the tile is queued; at most `max_pending` tiles are queued at
+    once (`submit` blocks beyond that), which bounds the memory held by images waiting to be
+    written. Writing is timed as 'save_png' (the stage name of the rasterizers), whatever the
+    codec.
+
+    Errors of a tile submitted with its tileXYZ are recorded as a 'save_png' failure of the
+    tile in the failure log that was current at submit time; other errors are raised by
+    `flush`/`close`.
+
+    Args
+    ----
+    codec : str
+        one of CODECS
+    compress_level : int
+        zlib level of the png codecs
+    palette : list of colors
+        palette of the 'png-palette' codec (see `to_palette`). Default: the colors of each tile
+    max_workers : int
+        number of writer threads (0: write synchronously in `submit`)
+    max_pending : int
+        max number of tiles queued or being written
+    """
+
+    def __init__(self, codec: str = 'png', compress_level: int = 6, palette: Optional[Sequence] = None,
+                 max_workers: int = 4, max_pending: int = 64):
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {CODECS}: {codec}")
+        self.codec = codec
+        self.compress_level = compress_level
+        self.palette = palette
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='tile-writer') \
+            if max_workers > 0 else None
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._futures: List[Future] = []
+
+    @property
+    def suffix(self) -> str:
+        """File suffix (with the dot) of the tiles written with this codec"""
+        return CODEC_SUFFIX[self.codec]
+
+    def _write(self, fp: Path, img: np.ndarray, tileXYZ, palette, failure_log) -> None:
+        try:
+            if tileXYZ is None:
+                with timer('save_png'):
+                    encode_tile(fp, img, self.codec, self.compress_level, palette)
+                count('tiles_written')
+            else:
+                with failure_log.capture(tileXYZ, 'save_png'), timer('save_png'):
+                    encode_tile(fp, img, self.codec, self.compress_level, palette)
+                    # not reached if the encoding fails (the failure is captured)
+                    count('tiles_written')
+        finally:
+            self._slots.release()
+
+    def submit(self, fp: Path, img: np.ndarray, tileXYZ: Optional[Tuple[int, int, int]] = None,
+               palette: Optional[Sequence] = None) -> Optional[Future]:
+        """Queue the image to be written to `fp`. The image is not copied: don't modify it
+        afterwards (e.g. don't pass a view of a reused render buffer).
+        `palette` overrides the writer's palette for this tile (e.g. the colors of its style)"""
+        self._slots.acquire()
+        args = (Path(fp), img, tileXYZ, self.palette if palette is None else palette, get_failure_log())
+        if self._executor is None:
+            self._write(*args)
+            return None
+        # keep only the futures that can still raise in `flush`
+        self._futures = [f for f in self._futures if not f.done() or f.exception() is not None]
+        future = self._executor.submit(self._write, *args)
+        self._futures.append(future)
+        return future
+
+    def flush(self) -> None:
+        """Wait until all the queued tiles are written; raises the first error of a tile
+        submitted without its tileXYZ"""
+        futures, self._futures = self._futures, []
+        errors = [f.exception() for f in futures]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1 +1,2 @@
+from . import planner
 from . import retriever
\ No newline at end of file
@@ -0,0 +1,304 @@
+"""Concurrent maptile downloader, within the limits of each provider of the tile source registry
+(`tilemani.retrieve.tile_sources`).
+
+Tiles are downloaded by a pool of threads; the requests to each provider are capped by its
+`max_concurrency` (a semaphore) and paced by its `requests_per_sec` (a shared schedule of
+request slots), so that several providers (or styles) can be downloaded at once, each at the
+rate it allows. Each tile is fetched with a single GET, checked for blankness in memory, and
+written (with its lng/lat boundary file) only if it's not blank. The tiles are requested in the
+Hilbert order (`tilemani.utils.ordering`), so that the requests in flight are for neighboring
+tiles, which the caches of the tile servers (and our region caches) are more likely to hold.
+
+`co_fetch` downloads several styles (of one or several providers) at once, with one scheduling
+unit per tile: the styles of a tile are fetched one after the other by the same worker, while
+the other workers fetch the other tiles, from all the providers at once. A blank tile of a
+"pruner" style (e.g. Esri imagery of the sea) skips the tile in all the other styles.
+
+With a `TileCache` (`tilemani.retrieve.tile_cache`), downloads are refreshes: the tiles that
+were downloaded before are requested conditionally on their ETag / Last-Modified, and only the
+new contents are written (once, in the content-addressed store of the cache).
+
+Usage
+-----
+from tilemani.retrieve.downloader import TileDownloader
+
+downloader = TileDownloader()
+stats = downloader.download(get_provider('carto'), 'light_no_labels', tiles, out_dir)
+# Counter({'downloaded': 120, 'blank': 8})
+
+# all styles of each tile in one unit; the tiles blank in Esri imagery are skipped in the others
+stats = downloader.co_fetch([(esri, 'imagery', esri_dir), (carto, 'light_no_labels', carto_dir)],
+                            tiles, pruners=['EsriImagery'])
+
+# refresh run: Counter({'not_modified': 110, 'downloaded': 10})
+stats = TileDownloader(cache=TileCache(out_dir_root)).download(provider, style, tiles, out_dir)
+"""
+import itertools
+import threading
+import time
+import urllib.request as ur
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from tilemani.retrieve.tile_cache import FetchResult, TileCache, Validators, fetch_url_conditional
+from tilemani.retrieve.tile_sources import TileProvider, image_signature
+from tilemani.utils.failures import get_failure_log
+from tilemani.utils.geo import getGeoFromTile
+from tilemani.utils.instrument import timer, count
+from tilemani.utils.ordering import order_tiles
+
+TileXYZ = Tuple[int, int, int]
+Source = Tuple[TileProvider, str, Path]  # provider, style, out_dir of its tiles
+
+
+def fetch_url(url: str, timeout: float = 30.) -> bytes:
+    """Body of the response to a GET of the url (raises on HTTP errors)"""
+    with ur.urlopen(ur.Request(url, headers={'User-Agent': 'tilemani'}), timeout=timeout) as resp:
+        return resp.read()
+
+
+def write_lnglat_boundary(fp: Path, x: int, y: int, z: int) -> None:
+    """Write the lat, lng of the 4 corners of the tile, one per line (as the downloaded maptiles)"""
+    corners = [getGeoFromTile(x + dx, y + dy, z) for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]]
+    fp.write_text(''.join("%f %f\n" % (lat, lng) for lat, lng in corners))
+
+
+class RateLimiter:
+    """Paces the calls of `wait` to at most `rate` per second, across threads: each call is given
+    the next free slot of the schedule and sleeps until it (0: no limit)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1. / rate if rate > 0 else 0.
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _interleave_providers(jobs: Iterable[Tuple]) -> List[Tuple]:
+    """The jobs in round-robin order of their providers (in the order of each provider), so that
+    the workers are not all waiting for the slots of the same provider"""
+    per_provider: Dict[str, List[Tuple]] = {}
+    for job in jobs:
+        per_provider.setdefault(job[0].name, []).append(job)
+    queues = list(per_provider.values())
+    return [job for rnd in itertools.zip_longest(*queues) for job in rnd if job is not None]
+
+
+class TileDownloader:
+    """Downloads tiles from the registered providers with a pool of threads, within the
+    `max_concurrency` and `requests_per_sec` of each provider.
+
+    Errors of a tile are recorded as a 'download' failure in the failure log that is current
+    when `download` is called (`tilemani.utils.failures`).
+
+    Args
+    ----
+    max_workers : int
+        number of threads. Default: enough for the max concurrency of the providers used at once
+        (see `download_many`), up to 32
+    fetch : callable
+        url -> bytes (Default: `fetch_url`)
+    cache : TileCache
+        validators and blobs of the tiles downloaded before. If given, the tiles are refreshed
+        with conditional requests (see `refresh_tile`). Default: no cache, the tiles are
+        downloaded in full
+    fetch_conditional : callable
+        (url, validators) -> FetchResult, the requests of the refreshes
+        (Default: `fetch_url_conditional`)
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, fetch: Callable[[str], bytes] = fetch_url,
+                 cache: Optional[TileCache] = None,
+                 fetch_conditional: Callable[[str, Optional[Validators]], FetchResult] = fetch_url_conditional):
+        self.max_workers = max_workers
+        self.fetch = fetch
+        self.cache = cache
+        self.fetch_conditional = fetch_conditional
+        self._limits: Dict[str, Tuple[threading.Semaphore, RateLimiter]] = {}
+        self._lock = threading.Lock()
+
+    def _provider_limits(self, provider: TileProvider) -> Tuple[threading.Semaphore, RateLimiter]:
+        with self._lock:
+            if provider.name not in self._limits:
+                self._limits[provider.name] = (threading.BoundedSemaphore(max(provider.max_concurrency, 1)),
+                                               RateLimiter(provider.requests_per_sec))
+            return self._limits[provider.name]
+
+    def fetch_tile(self, provider: TileProvider, style: str, tileXYZ: TileXYZ) -> bytes:
+        """Image bytes of the tile, within the limits of the provider"""
+        slots, limiter = self._provider_limits(provider)
+        with slots:
+            limiter.wait()
+            with timer('download'):
+                return self.fetch(provider.url(style, *tileXYZ))
+
+    def fetch_tile_conditional(self, provider: TileProvider, style: str, tileXYZ: TileXYZ,
+                               validators: Optional[Validators]) -> FetchResult:
+        """Response to the request of the tile, conditional on the validators (if any), within
+        the limits of the provider"""
+        slots, limiter = self._provider_limits(provider)
+        with slots:
+            limiter.wait()
+            with timer('download'):
+                return self.fetch_conditional(provider.url(style, *tileXYZ), validators)
+
+    def refresh_tile(self, provider: TileProvider, style: str, tileXYZ: TileXYZ, out_dir: Path) -> str:
+        """Download the tile as `download_tile`, through the cache: a tile downloaded before is
+        requested conditionally, and nothing is written if the server answers 304 Not Modified or
+        the same bytes. A new content is stored once in the cache, and linked to in `out_dir`.
+
+        Returns
+        -------
+        - 'downloaded', 'not_modified' (tile already up to date in `out_dir`) or 'blank'
+        """
+        source = provider.source_name(style)
+        x, y, z = tileXYZ
+        fp = out_dir / f'{x}_{y}_{z}.png'
+        known = self.cache.validators(source, tileXYZ)
+        if known is not None and not known.blank and not self.cache.blob_path(known.sha1).exists():
+            known = None  # the blob is gone: download in full
+
+        result = self.fetch_tile_conditional(provider, style, tileXYZ, known)
+        if result.not_modified:
+            if known is None:
+                raise ValueError(f'304 Not Modified for an unconditional request of {source} {tileXYZ}')
+            count('not_modified_tiles')
+            sha1, blank = known.sha1, known.blank
+        else:
+            sha1 = image_signature(result.data)
+            if known is not None and sha1 == known.sha1:
+                count('unchanged_tiles')
+                blank = known.blank
+            else:
+                blank = provider.is_blank(result.data)
+                if not blank:
+                    self.cache.store(result.data, sha1)
+            self.cache.update(source, tileXYZ, Validators(result.etag, result.last_modified, sha1, blank))
+        if blank:
+            count('blank_tiles')
+            return 'blank'
+
+        outcome = 'not_modified' if fp.exists() and fp.samefile(self.cache.blob_path(sha1)) else 'downloaded'
+        if outcome == 'downloaded':
+            (out_dir / 'lnglat').mkdir(parents=True, exist_ok=True)
+            self.cache.link(sha1, fp)
+            write_lnglat_boundary(out_dir / 'lnglat' / f'{x}_{y}_{z}.txt', x, y, z)
+            count('tiles_downloaded')
+        return outcome
+
+    def download_tile(self, provider: TileProvider, style: str, tileXYZ: TileXYZ, out_dir: Path,
+                      failure_log=None) -> str:
+        """Download the tile to `out_dir`/f'{x}_{y}_{z}.png' (and its boundary to
+        `out_dir`/lnglat/f'{x}_{y}_{z}.txt'), unless it's blank. With a cache, the tile is
+        refreshed instead (see `refresh_tile`).
+
+        Returns
+        -------
+        - 'downloaded', 'blank' or 'failed' ('not_modified' with a cache)
+        """
+        failure_log = get_failure_log() if failure_log is None else failure_log
+        x, y, z = tileXYZ
+        if self.cache is not None:
+            try:
+                return self.refresh_tile(provider, style, tileXYZ, out_dir)
+            except Exception as e:
+                failure_log.add_exception(tileXYZ, 'download', e)
+                return 'failed'
+        try:
+            data = self.fetch_tile(provider, style, tileXYZ)
+            if provider.is_blank(data):
+                count('blank_tiles')
+                return 'blank'
+            (out_dir / 'lnglat').mkdir(parents=True, exist_ok=True)
+            (out_dir / f'{x}_{y}_{z}.png').write_bytes(data)
+            write_lnglat_boundary(out_dir / 'lnglat' / f'{x}_{y}_{z}.txt', x, y, z)
+        except Exception as e:
+            failure_log.add_exception(tileXYZ, 'download', e)
+            return 'failed'
+        count('tiles_downloaded')
+        return 'downloaded'
+
+    def download_many(self, jobs: Iterable[Tuple[TileProvider, str, TileXYZ, Path]]) -> Counter:
+        """Download the (provider, style, tileXYZ, out_dir) jobs concurrently (see `download_tile`).
+        Jobs of different providers run in parallel, each provider within its own limits.
+
+        Returns
+        -------
+        - Counter of the outcomes ('downloaded', 'blank', 'failed', and 'not_modified' with a cache)
+        """
+        jobs = _interleave_providers(jobs)
+        if not jobs:
+            return Counter()
+        max_workers = self.max_workers or min(
+            32, sum(p.max_concurrency for p in {p.name: p for p, *_ in jobs}.values()))
+        failure_log = get_failure_log()
+        with ThreadPoolExecutor(max_workers, thread_name_prefix='tile-downloader') as executor:
+            outcomes = executor.map(lambda job: self.download_tile(*job, failure_log=failure_log), jobs)
+            return Counter(outcomes)
+
+    def download(self, provider: TileProvider, style: str, tiles: Iterable[TileXYZ],
+                 out_dir: Path, curve: Optional[str] = 'hilbert') -> Counter:
+        """Download the tiles of the provider's style to `out_dir` (see `download_many`), in the
+        order of the curve (None: in the given order)"""
+        out_dir = Path(out_dir)
+        tiles = order_tiles(tiles, curve) if curve is not None else tiles
+        return self.download_many((provider, style, tuple(t), out_dir) for t in tiles)
+
+    def _co_fetch_tile(self, tileXYZ: TileXYZ, sources: Sequence[Source], pruners: Collection[str],
+                       failure_log) -> List[str]:
+        """Outcome of each source for the tile; the pruners come first in `sources`"""
+        outcomes, pruned = [], False
+        for provider, style, out_dir in sources:
+            if pruned:
+                count('pruned_tiles')
+                outcomes.append('pruned')
+                continue
+            outcome = self.download_tile(provider, style, tileXYZ, out_dir, failure_log)
+            outcomes.append(outcome)
+            pruned = outcome == 'blank' and provider.source_name(style) in pruners
+        return outcomes
+
+    def co_fetch(self, sources: Sequence[Source], tiles: Iterable[TileXYZ],
+                 pruners: Collection[str] = (), curve: Optional[str] = 'hilbert') -> Dict[str, Counter]:
+        """Download the tiles in all the (provider, style, out_dir) sources, with one scheduling
+        unit per tile: the tiles are enumerated once, and the units run concurrently, so that all
+        the providers are fetched from at once (each within its own limits).
+
+        A blank tile of a source named in `pruners` (e.g. 'EsriImagery': an ocean tile) is
+        blank for all the sources: the pruners of a tile are fetched first, and its other
+        sources are skipped (outcome 'pruned') as soon as one of them is blank.
+        The tiles are fetched in the order of the curve (None: in the given order).
+
+        Returns
+        -------
+        - dict of source name (`TileProvider.source_name`) -> Counter of the outcomes of its tiles
+        """
+        pruners = {name.lower() for name in pruners}
+        sources = sorted(((p, s, Path(d)) for p, s, d in sources),
+                         key=lambda src: src[0].source_name(src[1]).lower() not in pruners)
+        names = [p.source_name(s) for p, s, _ in sources]
+        pruners = {name for name in names if name.lower() in pruners}
+        stats = {name: Counter() for name in names}
+        tiles = order_tiles(tiles, curve) if curve is not None else [tuple(t) for t in tiles]
+        if not tiles or not sources:
+            return stats
+
+        max_workers = self.max_workers or min(
+            32, sum(p.max_concurrency for p in {p.name: p for p, _, _ in sources}.values()))
+        failure_log = get_failure_log()
+        with ThreadPoolExecutor(max_workers, thread_name_prefix='tile-downloader') as executor:
+            for outcomes in executor.map(lambda t: self._co_fetch_tile(t, sources, pruners, failure_log), tiles):
+                for name, outcome in zip(names, outcomes):
+                    stats[name][outcome] += 1
+        return stats
@@ -0,0 +1,298 @@
+"""Async Overpass client: the road graph and the bldg geoms of an area with a single request.
+
+`get_road_graph_and_bbox` and `get_geoms` query Overpass twice for the same area of a tile (the
+road ways, then the bldgs), and block on each request. `OverpassClient` instead:
+- sends one combined query per area: the road ways of the network type (in the area buffered
+  by 500m, as `ox.graph_from_bbox` does to clean the periphery of the graph), a marker element,
+  then the elements with the geometry tags (e.g. the bldgs) in the area;
+- coalesces the concurrent requests of the same area into one (e.g. a tile planned twice, or
+  retried while its first request is in flight);
+- keeps to the number of slots of the server: at most `max_slots` requests in flight, and the
+  requests rejected by rate limits (429) or timeouts (504) are retried with exponential backoff;
+- does the blocking work off the event loop: each request (and the json decoding of its
+  response) runs in a worker thread, and so does the building of the graph and geoms with osmnx.
+
+The graph and geoms are the same as those of `ox.graph_from_bbox` and `ox.geometries_from_bbox`.
+
+`retrieve_region` retrieves the area of a group of tiles (e.g. a chunk of a streaming run) with
+one request instead, as a `RegionGraph` (to cut the road graph of each tile out of) and the geoms.
+
+Usage
+-----
+from tilemani.retrieve.overpass import OverpassClient
+
+client = OverpassClient(max_slots=2)
+results = client.retrieve_tiles(tiles)  # tileXYZ -> (G_r, bbox, gdf_b)
+
+# or from a coroutine
+G_r, bbox, gdf_b = await client.retrieve_tile(tileXYZ)
+
+# all the tiles of a chunk at once
+region, gdf_b = client.retrieve_region(tiles_bbox(chunk), chunk)
+G_r, bbox = region.tile_subgraph(chunk[0])
+"""
+import asyncio
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import requests
+import networkx as nx
+import osmnx as ox
+from geopandas import GeoDataFrame
+from networkx.classes.graph import Graph
+
+from tilemani.retrieve.region_graph import RegionGraph
+from tilemani.utils.failures import backoff_delay, capture, is_empty_result, is_retryable, record_failure
+from tilemani.utils.geo import get_latlng_and_radius
+from tilemani.utils.instrument import count, timer
+
+TileXYZ = Tuple[int, int, int]
+BBox = Tuple[float, float, float, float]  # north, south, east, west (as osmnx)
+Result = Tuple[Optional[Graph], BBox, Optional[GeoDataFrame]]
+
+# type of the element that separates the roads from the geoms in the combined response
+SPLIT_MARKER = 'split'
+PERIPHERY_BUFFER = 500  # meters, as `ox.graph_from_polygon(clean_periphery=True)`
+
+
+def buffered_polygon(bbox: BBox, buffer_dist: float = PERIPHERY_BUFFER):
+    """(polygon of the bbox, the polygon buffered by `buffer_dist` meters), in lng/lat"""
+    polygon = ox.utils_geo.bbox_to_poly(*bbox)
+    poly_proj, crs_utm = ox.projection.project_geometry(polygon)
+    poly_buff, _ = ox.projection.project_geometry(poly_proj.buffer(buffer_dist), crs=crs_utm, to_latlong=True)
+    return polygon, poly_buff
+
+
+def _overpass_bbox(north: float, south: float, east: float, west: float) -> str:
+    return f"({south:.7f},{west:.7f},{north:.7f},{east:.7f})"
+
+
+def combined_query(bbox: BBox, network_type: str = 'drive_service', tags: Optional[Dict] = None,
+                   buffer_dist: float = PERIPHERY_BUFFER) -> str:
+    """Overpass query of the road ways (and their nodes) of the network type in the bbox buffered by
+    `buffer_dist`, then a `SPLIT_MARKER` element, then the elements with the `tags` (as in
+    `ox.geometries_from_bbox`: {key: True, or a value, or a list of values}) in the bbox"""
+    tags = {'building': True} if tags is None else tags
+    north, south, east, west = bbox
+    _, poly_buff = buffered_polygon(bbox, buffer_dist)
+    west_b, south_b, east_b, north_b = poly_buff.bounds
+    road_bbox = _overpass_bbox(north_b, south_b, east_b, west_b)
+    osm_filter = ox.downloader._get_osm_filter(network_type)
+
+    geom_bbox = _overpass_bbox(north, south, east, west)
+    components = []
+    for key, values in tags.items():
+        if isinstance(values, bool):
+            filters = [f'[{key!r}]']
+        else:
+            filters = [f'[{key!r}={v!r}]' for v in ([values] if isinstance(values, str) else values)]
+        for tag_filter in filters:
+            components.extend(f'({kind}{tag_filter}{geom_bbox};(._;>;););' for kind in ('node', 'way', 'relation'))
+
+    return (f'{ox.downloader._make_overpass_settings()};'
+            f'(way{osm_filter}{road_bbox};>;);out;'
+            f'make {SPLIT_MARKER};out;'
+            f'({"".join(components)});out;')
+
+
+def split_response(response_json: Dict) -> Tuple[Dict, Dict]:
+    """Response jsons of the roads and of the geoms of a `combined_query`"""
+    elements = response_json.get('elements', [])
+    idx = next((i for i, e in enumerate(elements) if e.get('type') == SPLIT_MARKER), None)
+    if idx is None:
+        raise ValueError('The Overpass response has no split marker: not the response of a combined query')
+    return ({**response_json, 'elements': elements[:idx]},
+            {**response_json, 'elements': elements[idx + 1:]})
+
+
+def build_road_graph(roads_json: Dict, bbox: BBox, network_type: str = 'drive_service',
+                     retain_all: bool = False, truncate_by_edge: bool = False,
+                     buffer_dist: float = PERIPHERY_BUFFER) -> Graph:
+    """Road graph of the bbox from the roads of a combined response, as `ox.graph_from_bbox`
+    (clean_periphery=True, simplify=True) builds it from its own response"""
+    polygon, poly_buff = buffered_polygon(bbox, buffer_dist)
+    bidirectional = network_type in ox.settings.bidirectional_network_types
+    G_buff = ox.graph._create_graph([roads_json], retain_all=True, bidirectional=bidirectional)
+    G_buff = ox.truncate.truncate_graph_polygon(G_buff, poly_buff, True, truncate_by_edge)
+    G_buff = ox.simplification.simplify_graph(G_buff)
+    G = ox.truncate.truncate_graph_polygon(G_buff, polygon, retain_all, truncate_by_edge)
+    # streets per node counted in the buffered graph, as osmnx
+    spn = ox.stats.count_streets_per_node(G_buff, nodes=G.nodes)
+    nx.set_node_attributes(G, values=spn, name='street_count')
+    return G
+
+
+def build_geoms(geoms_json: Dict, bbox: BBox, tags: Optional[Dict] = None) -> GeoDataFrame:
+    """Geoms of the bbox with the tags from the geoms of a combined response, as
+    `ox.geometries_from_bbox`"""
+    tags = {'building': True} if tags is None else tags
+    return ox.geometries._create_gdf([geoms_json], ox.utils_geo.bbox_to_poly(*bbox), tags)
+
+
+def tile_bbox(tileXYZ: TileXYZ) -> BBox:
+    """Bbox of the area that the retriever queries for a tile (as `get_road_graph_and_bbox`)"""
+    lat, lng, radius = get_latlng_and_radius(tileXYZ)
+    return ox.utils_geo.bbox_from_point((lat, lng), dist=radius)
+
+
+def tiles_bbox(tiles: Iterable[TileXYZ]) -> BBox:
+    """Bbox of the union of the areas of the tiles (see `tile_bbox`)"""
+    bboxes = [tile_bbox(t) for t in tiles]
+    return (max(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), min(b[3] for b in bboxes))
+
+
+def post_overpass(url: str, query: str, timeout: float) -> Dict:
+    """POST the query to the Overpass interpreter at `url`; the decoded json response"""
+    response = requests.post(url, data={'data': query}, timeout=timeout,
+                             headers={'User-Agent': ox.settings.default_user_agent})
+    response.raise_for_status()
+    return response.json()
+
+
+class OverpassClient:
+    """Async Overpass client of the retriever (see the module doc).
+
+    Args
+    ----
+    endpoint : str
+        Overpass API url (Default: `ox.settings.overpass_endpoint`)
+    max_slots : int
+        max number of requests in flight (the slots of the server per client, 2 at overpass-api.de)
+    max_retries : int
+        retries of a request rejected with a retryable error (429, 504, connection errors, ...)
+    base_delay, max_delay : float
+        exponential backoff of the retries (see `tilemani.utils.failures.backoff_delay`)
+    post : callable
+        (url, query, timeout) -> response json, run in a worker thread (Default: `post_overpass`)
+    """
+
+    def __init__(self, endpoint: Optional[str] = None, max_slots: int = 2, max_retries: int = 3,
+                 base_delay: float = 1., max_delay: float = 60.,
+                 post: Callable[[str, str, float], Dict] = post_overpass):
+        self.endpoint = (endpoint or ox.settings.overpass_endpoint).rstrip('/')
+        self.max_slots = max_slots
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.post = post
+        self._loop = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _bind(self) -> asyncio.Semaphore:
+        """Slots and in-flight requests of the running event loop"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._slots, self._inflight = loop, asyncio.Semaphore(self.max_slots), {}
+        return self._slots
+
+    async def request(self, query: str) -> Dict:
+        """Response json of the query, in one of the slots, retried with backoff on retryable errors"""
+        slots = self._bind()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with slots:
+                    count('overpass_queries')
+                    return await loop.run_in_executor(
+                        None, self.post, f'{self.endpoint}/interpreter', query, ox.settings.timeout)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+            count('overpass_retries')
+            await asyncio.sleep(backoff_delay(attempt, self.base_delay, self.max_delay))
+
+    async def fetch_area(self, bbox: BBox, network_type: str = 'drive_service',
+                         tags: Optional[Dict] = None) -> Dict:
+        """Combined response of the area; concurrent requests of the same area share one request"""
+        self._bind()
+        query = combined_query(bbox, network_type, tags)
+        if query in self._inflight:
+            count('overpass_coalesced')
+            return await asyncio.shield(self._inflight[query])
+        task = asyncio.ensure_future(self.request(query))
+        self._inflight[query] = task
+        task.add_done_callback(lambda _: self._inflight.pop(query, None))
+        return await asyncio.shield(task)
+
+    async def retrieve_bbox(self, bbox: BBox, tileXYZ: TileXYZ, network_type: str = 'drive_service',
+                            tags: Optional[Dict] = None, retain_all: bool = False,
+                            truncate_by_edge: bool = False) -> Tuple[Optional[Graph], Optional[GeoDataFrame]]:
+        """Road graph and geoms of the bbox. Failures are recorded in the failure log under
+        `tileXYZ` ('retrieve' for the request, 'retrieve_road'/'retrieve_bldg' for the parsing);
+        the graph (geoms) is None on a failure and if the area has none."""
+        G_r, gdf, responses = None, None, None
+        with capture(tileXYZ, 'retrieve'), timer('retrieve'):
+            responses = split_response(await self.fetch_area(bbox, network_type, tags))
+        if responses is None:
+            return G_r, gdf
+
+        roads_json, geoms_json = responses
+        loop = asyncio.get_running_loop()
+        with capture(tileXYZ, 'retrieve_road'), timer('retrieve_road'):
+            G_r = await loop.run_in_executor(None, build_road_graph, roads_json, bbox, network_type,
+                                             retain_all, truncate_by_edge)
+        with capture(tileXYZ, 'retrieve_bldg'), timer('retrieve_bldg'):
+            gdf = await loop.run_in_executor(None, build_geoms, geoms_json, bbox, tags)
+        return G_r, gdf
+
+    async def retrieve_region_async(self, bbox: BBox, tiles: Iterable[TileXYZ], network_type: str = 'drive_service',
+                                    tags: Optional[Dict] = None
+                                    ) -> Tuple[Optional[RegionGraph], Optional[GeoDataFrame]]:
+        """Region graph and geoms of the bbox (see `retrieve_region`)"""
+        tiles = [tuple(t) for t in tiles]
+        loop = asyncio.get_running_loop()
+
+        def record(stage: str, exc: Exception) -> None:
+            # a failure of the region is a failure of each of its tiles
+            if is_empty_result(exc):
+                count('empty_results')
+                return
+            for tileXYZ in tiles:
+                record_failure(tileXYZ, stage, exc)
+
+        region, gdf = None, None
+        try:
+            with timer('retrieve'):
+                roads_json, geoms_json = split_response(await self.fetch_area(bbox, network_type, tags))
+        except Exception as e:
+            record('retrieve', e)
+            return region, gdf
+        try:
+            with timer('retrieve_road'):
+                region = await loop.run_in_executor(None, RegionGraph.from_elements, [roads_json], network_type)
+        except Exception as e:
+            record('retrieve_road', e)
+        try:
+            with timer('retrieve_bldg'):
+                gdf = await loop.run_in_executor(None, build_geoms, geoms_json, bbox, tags)
+        except Exception as e:
+            record('retrieve_bldg', e)
+        return region, gdf
+
+    def retrieve_region(self, bbox: BBox, tiles: Iterable[TileXYZ], network_type: str = 'drive_service',
+                        tags: Optional[Dict] = None) -> Tuple[Optional[RegionGraph], Optional[GeoDataFrame]]:
+        """Road graph (a `RegionGraph`, to cut out the subgraphs of the tiles) and geoms of the
+        bbox of a group of `tiles`, with one request. Failures are recorded under each of the
+        tiles; the region (geoms) is None on a failure and if the area has none.
+        Blocks until done: to be called outside of an event loop."""
+        return asyncio.run(self.retrieve_region_async(bbox, tiles, network_type, tags))
+
+    async def retrieve_tile(self, tileXYZ: TileXYZ, network_type: str = 'drive_service',
+                            tags: Optional[Dict] = None) -> Result:
+        """Same as `get_road_graph_and_bbox` and `get_geoms` of the tile, with one request"""
+        bbox = tile_bbox(tileXYZ)
+        G_r, gdf = await self.retrieve_bbox(bbox, tileXYZ, network_type, tags)
+        return G_r, bbox, gdf
+
+    async def retrieve_tiles_async(self, tiles: Iterable[TileXYZ], network_type: str = 'drive_service',
+                                   tags: Optional[Dict] = None) -> Dict[TileXYZ, Result]:
+        tiles = list(dict.fromkeys(tuple(t) for t in tiles))
+        results = await asyncio.gather(*(self.retrieve_tile(t, network_type, tags) for t in tiles))
+        return dict(zip(tiles, results))
+
+    def retrieve_tiles(self, tiles: Iterable[TileXYZ], network_type: str = 'drive_service',
+                       tags: Optional[Dict] = None) -> Dict[TileXYZ, Result]:
+        """(G_r, bbox, gdf_b) of each tile (see `retrieve_tile`), retrieved concurrently.
+        Blocks until all are done: to be called outside of an event loop."""
+        return asyncio.run(self.retrieve_tiles_async(tiles, network_type, tags))
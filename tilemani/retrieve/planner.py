@@ -0,0 +1,131 @@
+"""Quadtree planning of the tiles to retrieve/render/download in an area.
+
+Instead of enumerating every tile of a city's bbox at the target zoom (most of which can
+be water or empty land for cities like khartoum or shanghai), the planner probes coarse
+tiles first and descends only into the children of the non-empty ones.
+
+Usage
+-----
+from tilemani.retrieve.planner import plan_quadtree, osm_count_probe
+
+geo = city_geos['khartoum']
+tiles = plan_quadtree((geo['xmin'], geo['xmax'], geo['ymin'], geo['ymax']), zoom=14,
+                      is_empty=osm_count_probe('drive_service'), probe_zoom=10)
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+from tilemani.retrieve.retriever import count_roads_and_bldgs
+from tilemani.utils.instrument import count
+from tilemani.utils.tiles import TileXYZ, tile_range_in_bbox, get_children, tile_boxes
+
+
+def plan_quadtree(
+        bbox: Tuple[float, float, float, float],
+        zoom: int,
+        is_empty: Callable[[TileXYZ], bool],
+        probe_zoom: Optional[int] = None,
+        max_probe_zoom: Optional[int] = None,
+        area: Optional[BaseGeometry] = None,
+        verbose: bool = False,
+) -> List[TileXYZ]:
+    """Tiles at `zoom` covering the bbox, except those under a coarser tile found empty.
+
+    Starting from the tiles covering the bbox at `probe_zoom`, each tile is probed with
+    `is_empty(tileXYZ)`; the children (that intersect the bbox) of non-empty tiles are probed
+    in turn, down to `max_probe_zoom`. Below `max_probe_zoom`, non-empty tiles are expanded
+    to all their descendants at `zoom` without probing.
+
+    Args
+    ----
+    bbox : (xmin, xmax, ymin, ymax)
+        lng/lat bbox as in `locations.json`
+    zoom : int
+        zoom level of the planned tiles
+    is_empty : callable
+        probe that returns True if the tile (and hence all its descendants) has no content.
+        See `osm_count_probe` and `scripts/downloader.py`'s blank-tile probe.
+        A probe that fails should return False, so that the tile is kept.
+    probe_zoom : int
+        zoom level of the coarsest probes. Default: zoom - 4 (each probe covers 256 tiles)
+    max_probe_zoom : int
+        zoom level of the finest probes. Default: zoom - 1. Use `zoom` to also probe each
+        planned tile (only worth it if the probe is much cheaper than processing a tile)
+    area : shapely geometry
+        (multi)polygon in lng/lat degree, e.g. a city boundary (see `tilemani.utils.tiles`).
+        If given, only the tiles intersecting it (within the bbox) are probed and planned
+
+    Returns
+    -------
+    - tiles at `zoom`, ordered as a depth-first traversal of the quadtree (i.e. spatially coherent)
+    """
+    probe_zoom = max(0, zoom - 4) if probe_zoom is None else min(probe_zoom, zoom)
+    max_probe_zoom = zoom - 1 if max_probe_zoom is None else min(max_probe_zoom, zoom)
+    ranges: Dict[int, Tuple[int, int, int, int]] = {}
+
+    if area is not None:
+        shapely.prepare(area)
+
+    def in_bbox(tile: TileXYZ) -> bool:
+        x, y, z = tile
+        if z not in ranges:
+            ranges[z] = tile_range_in_bbox(*bbox, z)
+        start_x, end_x, start_y, end_y = ranges[z]
+        return start_x <= x <= end_x and start_y <= y <= end_y
+
+    def in_area(tile: TileXYZ) -> bool:
+        x, y, z = tile
+        return area is None or shapely.intersects(area, tile_boxes(np.array([x]), np.array([y]), z)[0])
+
+    start_x, end_x, start_y, end_y = tile_range_in_bbox(*bbox, probe_zoom)
+    stack = [(x, y, probe_zoom) for x in range(end_x, start_x - 1, -1) for y in range(end_y, start_y - 1, -1)]
+    planned = []
+    while stack:
+        tile = stack.pop()
+        z = tile[2]
+        if z <= max_probe_zoom:
+            if not in_area(tile):
+                continue
+            count('probes')
+            if is_empty(tile):
+                n_pruned = sum(1 for _ in _descendants_in_bbox(tile, zoom, in_bbox))
+                count('pruned_tiles', n_pruned)
+                if verbose:
+                    print(f'{tile} is empty: pruned {n_pruned} tiles at zoom {zoom}')
+                continue
+        if z == zoom:
+            planned.append(tile)
+        elif z < max_probe_zoom:
+            stack.extend(c for c in reversed(get_children(tile)) if in_bbox(c))
+        else:
+            planned.extend(_descendants_in_bbox(tile, zoom, in_bbox))
+
+    if area is not None and planned:
+        xs, ys, _ = np.array(planned).T
+        planned = [t for t, hit in zip(planned, shapely.intersects(area, tile_boxes(xs, ys, zoom))) if hit]
+    return planned
+
+
+def _descendants_in_bbox(tile: TileXYZ, zoom: int, in_bbox: Callable[[TileXYZ], bool]):
+    """Depth-first descendants at `zoom` of the tile that are in the bbox"""
+    if tile[2] == zoom:
+        if in_bbox(tile):
+            yield tile
+        return
+    for c in get_children(tile):
+        if in_bbox(c):
+            yield from _descendants_in_bbox(c, zoom, in_bbox)
+
+
+def osm_count_probe(network_type: str = "drive_service",
+                    bldg: bool = True,
+                    min_count: int = 1) -> Callable[[TileXYZ], bool]:
+    """Probe for `plan_quadtree`: a tile is empty if OSM has fewer than `min_count`
+    roads and bldgs in it (counted with a single Overpass `out count` query)"""
+    def is_empty(tileXYZ: TileXYZ) -> bool:
+        n = count_roads_and_bldgs(tileXYZ, network_type=network_type, bldg=bldg)
+        return n is not None and n < min_count
+    return is_empty
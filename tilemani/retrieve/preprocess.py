@@ -0,0 +1,146 @@
+"""Preprocessing of the retrieved geometries before rasterization: clip them to the tile's bbox
+(plus a margin) and simplify them to a fraction of a pixel.
+
+Roads are retrieved by bbox but keep their full edge geometries, and bldgs are retrieved by
+radius around the tile center; both come at the full resolution of OSM, with many vertices
+closer than a pixel of the output. Clipping and simplifying them once per tile (vectorized
+with shapely 2) cuts the vertices that every render of the tile would transform and draw.
+
+The margin keeps the geometries that are outside the bbox but close enough to be drawn in it
+(line widths, joints), and the clipped edges of the margin are never drawn.
+
+Only the inputs of the renderers are preprocessed: the graph and geoms that are saved and
+used for the road network stats are the retrieved ones (edge lengths, street counts).
+
+Usage
+-----
+from tilemani.retrieve.preprocess import preprocess_for_render
+
+G_render, gdf_render = preprocess_for_render(G_r, gdf_b, bbox, size_px=269)
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame
+from networkx.classes.graph import Graph
+
+from tilemani.utils.instrument import count
+
+BBox = Tuple[float, float, float, float]  # (north, south, east, west), as osmnx
+
+
+def pixel_size(bbox: BBox, width_px: int, height_px: Optional[int] = None) -> float:
+    """Size of a pixel of the bbox rendered at `width_px` x `height_px`, in degrees
+    (the smaller of its lat and lng sizes)"""
+    north, south, east, west = bbox
+    height_px = width_px if height_px is None else height_px
+    return min((east - west) / width_px, (north - south) / height_px)
+
+
+def clip_rect(bbox: BBox, margin: float) -> Tuple[float, float, float, float]:
+    """(xmin, ymin, xmax, ymax) of the bbox grown by `margin` degrees on each side"""
+    north, south, east, west = bbox
+    return west - margin, south - margin, east + margin, north + margin
+
+
+def n_vertices(geoms: np.ndarray) -> int:
+    return int(shapely.get_num_coordinates(geoms).sum())
+
+
+def clip_and_simplify(geoms: np.ndarray, rect: Tuple[float, float, float, float],
+                      tolerance: float, preserve_topology: bool = True) -> np.ndarray:
+    """Clip the geometries to the rect and simplify them with the tolerance (in their units).
+    Geometries outside the rect (or collapsed by the simplification) become empty"""
+    clipped = shapely.clip_by_rect(geoms, *rect)
+    return shapely.simplify(clipped, tolerance, preserve_topology=preserve_topology)
+
+
+def preprocess_geoms(gdf: Optional[GeoDataFrame], bbox: BBox, size_px: int,
+                     margin_px: float = 4., tolerance_px: float = 0.5) -> Optional[GeoDataFrame]:
+    """Polygons of `gdf` (e.g. bldg footprints) clipped to the bbox plus `margin_px` pixels,
+    and simplified to `tolerance_px` pixels (preserving their holes), for a render of the bbox
+    at `size_px` pixels. Rows left empty are dropped.
+
+    Returns
+    -------
+    - new GeoDataFrame with the same columns (None if `gdf` is None)
+    """
+    if gdf is None or gdf.empty:
+        return gdf
+    px = pixel_size(bbox, size_px)
+    geoms = gdf.geometry.values
+    polygonal = np.isin(shapely.get_type_id(geoms), [3, 6])
+    geoms = np.asarray(geoms)[polygonal]
+    processed = clip_and_simplify(geoms, clip_rect(bbox, margin_px * px), tolerance_px * px)
+    # clipping can leave lines or points along the rect: keep the polygonal parts only
+    keep = np.isin(shapely.get_type_id(processed), [3, 6]) & ~shapely.is_empty(processed)
+
+    count('bldg_vertices_in', n_vertices(geoms))
+    count('bldg_vertices_out', n_vertices(processed[keep]))
+    out = gdf[polygonal].iloc[np.flatnonzero(keep)].copy()
+    out[gdf.geometry.name] = processed[keep]
+    return out
+
+
+def preprocess_graph(G: Optional[Graph], bbox: BBox, size_px: int,
+                     margin_px: float = 4., tolerance_px: float = 0.5) -> Optional[Graph]:
+    """Road graph for the render of the bbox at `size_px` pixels: only the edges whose line
+    intersects the bbox plus `margin_px` pixels (and their nodes), with their lines clipped to
+    it and simplified to `tolerance_px` pixels.
+
+    Edges without a geometry are straight lines between their nodes. The end points of an
+    edge whose line leaves the rect are moved to the rect's border (its nodes stay where they
+    are, outside of the drawn area). An edge that leaves and re-enters the rect keeps its
+    whole (simplified) line.
+
+    Returns
+    -------
+    - new graph (the input graph is not modified)
+    """
+    if G is None or G.number_of_edges() == 0:
+        return G
+    px = pixel_size(bbox, size_px)
+    rect = clip_rect(bbox, margin_px * px)
+    tolerance = tolerance_px * px
+
+    nodes = G.nodes
+    edges = list(G.edges(keys=True, data=True)) if G.is_multigraph() else \
+        [(u, v, None, d) for u, v, d in G.edges(data=True)]
+    lines = np.array([d.get('geometry') for _, _, _, d in edges], dtype=object)
+    straight = np.flatnonzero(shapely.is_missing(lines))
+    if len(straight):
+        ends = np.array([[[nodes[n]['x'], nodes[n]['y']] for n in edges[i][:2]] for i in straight])
+        lines[straight] = shapely.linestrings(ends)
+    simplified = shapely.simplify(lines, tolerance, preserve_topology=False)
+    clipped = shapely.simplify(shapely.clip_by_rect(lines, *rect), tolerance, preserve_topology=False)
+    keep = ~shapely.is_empty(clipped)
+    # a MultiLineString can't be drawn as the single line of an edge
+    single = shapely.get_type_id(clipped) == 1
+    new_lines = np.where(single, clipped, simplified)
+
+    count('road_vertices_in', n_vertices(lines))
+    count('road_vertices_out', n_vertices(new_lines[keep]))
+
+    H = G.__class__()
+    H.graph.update(G.graph)
+    kept = [edges[i] for i in np.flatnonzero(keep)]
+    for u, v, _, _ in kept:
+        for node in (u, v):
+            if node not in H:
+                H.add_node(node, **nodes[node])
+    for (u, v, k, d), line in zip(kept, new_lines[keep]):
+        data = dict(d, geometry=line)
+        if k is None:
+            H.add_edge(u, v, **data)
+        else:
+            H.add_edge(u, v, key=k, **data)
+    return H
+
+
+def preprocess_for_render(G: Optional[Graph], gdf_b: Optional[GeoDataFrame], bbox: BBox,
+                          size_px: int, margin_px: float = 4., tolerance_px: float = 0.5,
+                          ) -> Tuple[Optional[Graph], Optional[GeoDataFrame]]:
+    """`preprocess_graph` and `preprocess_geoms` of the road graph and bldg geoms of a tile"""
+    return (preprocess_graph(G, bbox, size_px, margin_px, tolerance_px),
+            preprocess_geoms(gdf_b, bbox, size_px, margin_px, tolerance_px))
@@ -0,0 +1,166 @@
+"""Road graph of a whole region, built once, and the subgraphs of its tiles.
+
+`ox.graph_from_point` (or `graph_from_xml` + truncation) runs the whole osmnx pipeline for every
+tile: parse the elements, build the graph, truncate it to the (buffered) bbox and simplify it,
+so the same ways are parsed and simplified again for each of the tiles they cross.
+`RegionGraph` runs it once for the region (an .osm extract, or Overpass responses):
+- the ways are filtered by the `network_type` in python, with the osmnx filter of the type
+  (an extract is usually not pre-filtered, and `ox.graph_from_xml` doesn't filter it);
+- the graph is built and simplified once, and the streets per node are counted on the whole
+  graph (so the counts at the border of a tile are those of the real intersections);
+- the bounds of the geometry of every edge are kept in an (n_edges, 4) array.
+
+The subgraph of a tile is then the edges whose bounds intersect the tile bbox (a vectorized
+comparison over the edge bounds array), refined to the edges whose geometry intersects it, and
+their end nodes: there is no truncation or simplification per tile. All the edges crossing the
+tile are kept, with their full geometry (as `truncate_by_edge=True`, and unlike the truncation
+of osmnx, also those whose both ends are outside of the tile).
+
+Usage
+-----
+from tilemani.retrieve.region_graph import RegionGraph
+
+region = RegionGraph.from_xml('paris.osm', network_type='drive_service')  # once
+G_r, bbox = region.tile_subgraph(tileXYZ)  # per tile, as `get_road_graph_and_bbox`
+"""
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from pathlib import Path
+
+import numpy as np
+import networkx as nx
+import osmnx as ox
+import shapely
+from networkx.classes.graph import Graph
+
+from tilemani.utils.geo import get_latlng_and_radius
+from tilemani.utils.instrument import count, timer, timed
+
+TileXYZ = Tuple[int, int, int]
+BBox = Tuple[float, float, float, float]  # north, south, east, west (as osmnx)
+
+_FILTER_RE = re.compile(r'\["([^"]+)"(?:(!?~)"([^"]*)")?\]')
+
+
+def parse_osm_filter(osm_filter: str) -> List[Tuple[str, Optional[str], Optional[re.Pattern]]]:
+    """(key, op, regex) of each clause of an Overpass way filter as osmnx writes them, e.g.
+    '["highway"]["area"!~"yes"]': op is None (the key must be present), '~' or '!~'"""
+    clauses = [(key, op or None, re.compile(value) if op else None)
+               for key, op, value in _FILTER_RE.findall(osm_filter)]
+    if not clauses and osm_filter.strip():
+        raise ValueError(f'Not an Overpass way filter: {osm_filter}')
+    return clauses
+
+
+def way_filter(network_type: str = 'drive_service',
+               custom_filter: Optional[str] = None) -> Callable[[Dict], bool]:
+    """Predicate on the tags of a way: whether Overpass would return it for the network type
+    (or the custom filter), with the semantics of Overpass (a '!~' clause holds when the key is
+    missing; the regexes are not anchored)"""
+    clauses = parse_osm_filter(custom_filter if custom_filter is not None
+                               else ox.downloader._get_osm_filter(network_type))
+
+    def keep(tags: Dict) -> bool:
+        for key, op, regex in clauses:
+            value = tags.get(key)
+            if op is None:
+                if value is None:
+                    return False
+            elif op == '~':
+                if value is None or not regex.search(value):
+                    return False
+            elif value is not None and regex.search(value):
+                return False
+        return True
+
+    return keep
+
+
+def filter_elements(response_json: Dict, keep_way: Callable[[Dict], bool]) -> Dict:
+    """The ways of the response that pass `keep_way` and their nodes (the other elements,
+    e.g. relations or the nodes of other ways, are dropped)"""
+    elements = response_json['elements']
+    ways = [e for e in elements if e['type'] == 'way' and keep_way(e.get('tags', {}))]
+    node_ids = {n for way in ways for n in way['nodes']}
+    nodes = [e for e in elements if e['type'] == 'node' and e['id'] in node_ids]
+    return {**response_json, 'elements': nodes + ways}
+
+
+class RegionGraph:
+    """Simplified road graph of a region and its edge bounds, to cut out tile subgraphs
+    (see the module doc). Build it with `from_elements` or `from_xml`.
+
+    Args
+    ----
+    G : MultiDiGraph
+        simplified road graph of the region (with the `street_count` of its nodes)
+    """
+
+    def __init__(self, G: Graph):
+        self.G = G
+        self.edges = list(G.edges(keys=True))
+        xs = nx.get_node_attributes(G, 'x')
+        ys = nx.get_node_attributes(G, 'y')
+        geoms = np.empty(len(self.edges), dtype=object)
+        for i, (u, v, k) in enumerate(self.edges):
+            geom = G.edges[u, v, k].get('geometry')
+            geoms[i] = geom if geom is not None else shapely.LineString([(xs[u], ys[u]), (xs[v], ys[v])])
+        self.geoms = geoms
+        self.bounds = shapely.bounds(geoms).reshape(-1, 4)  # minx, miny, maxx, maxy
+        count('region_edges', len(self.edges))
+
+    @classmethod
+    @timed('build_region')
+    def from_elements(cls, response_jsons: Iterable[Dict], network_type: str = 'drive_service',
+                      custom_filter: Optional[str] = None, retain_all: bool = True) -> 'RegionGraph':
+        """Region graph of the ways of Overpass response jsons (or of an extract, see `from_xml`)
+        that pass the filter of the network type (or the `custom_filter`).
+        The components that are not connected to the largest one are dropped unless `retain_all`
+        (kept by default, since a region cuts through the network at its borders)."""
+        keep = way_filter(network_type, custom_filter)
+        response_jsons = [filter_elements(rj, keep) for rj in response_jsons]
+        bidirectional = network_type in ox.settings.bidirectional_network_types
+        G = ox.graph._create_graph(response_jsons, retain_all=retain_all, bidirectional=bidirectional)
+        G = ox.simplification.simplify_graph(G)
+        nx.set_node_attributes(G, values=ox.stats.count_streets_per_node(G), name='street_count')
+        return cls(G)
+
+    @classmethod
+    def from_xml(cls, filepath: Union[Path, str], network_type: str = 'drive_service',
+                 custom_filter: Optional[str] = None, retain_all: bool = True) -> 'RegionGraph':
+        """Region graph of a local OSM extract (.osm xml file), see `from_elements`"""
+        response_json = ox.osm_xml._overpass_json_from_file(filepath)
+        return cls.from_elements([response_json], network_type, custom_filter, retain_all)
+
+    def edges_in_bbox(self, bbox: BBox, exact: bool = True) -> np.ndarray:
+        """Indices (into `edges`) of the edges that intersect the bbox: their bounds intersect it,
+        and, if `exact`, their geometry too"""
+        north, south, east, west = bbox
+        b = self.bounds
+        idx = np.flatnonzero((b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south))
+        if exact and len(idx):
+            idx = idx[shapely.intersects(self.geoms[idx], shapely.box(west, south, east, north))]
+        return idx
+
+    def subgraph(self, bbox: BBox, exact: bool = True) -> Graph:
+        """Graph of the edges that intersect the bbox and of their end nodes. The attributes are
+        copied (shallow), so the subgraph can be modified without changing the region graph."""
+        G = self.G
+        H = G.__class__(**G.graph)
+        edges = [self.edges[i] for i in self.edges_in_bbox(bbox, exact)]
+        nodes = {n for u, v, _ in edges for n in (u, v)}
+        H.add_nodes_from((n, dict(G.nodes[n])) for n in nodes)
+        H.add_edges_from((u, v, k, dict(G.edges[u, v, k])) for u, v, k in edges)
+        return H
+
+    def tile_subgraph(self, tileXYZ: TileXYZ) -> Tuple[Optional[Graph], BBox]:
+        """Same as `get_road_graph_and_bbox` of the tile (the bbox of the area the retriever
+        queries, and the road graph in it, None if there is no road), cut out of the region"""
+        lat, lng, radius = get_latlng_and_radius(tileXYZ)
+        bbox = ox.utils_geo.bbox_from_point((lat, lng), dist=radius)
+        with timer('retrieve_road'):
+            G_r = self.subgraph(bbox)
+        if G_r.number_of_edges() == 0:
+            count('empty_results')
+            return None, bbox
+        return G_r, bbox
@@ -1,11 +1,14 @@
-import sys
-
 from typing import Tuple, List, Dict, Optional
+import requests
+import networkx as nx
 from networkx.classes.graph import Graph
 from geopandas import GeoDataFrame
 import osmnx as ox
 from osmnx.plot import utils_graph, graph, simplification, utils_geo, plot_graph
 from tilemani.utils.geo import getGeoFromTile, getTileFromGeo, getTileExtent, get_latlng_and_radius
+from tilemani.utils.instrument import timer, count
+from tilemani.utils.failures import capture
+from tilemani.utils.tiles import get_tile_bbox
 
 
 def get_road_graph_and_bbox(
@@ -16,6 +19,9 @@ def get_road_graph_and_bbox(
     retrieve the road network data from OSM for the area that is covered by the maptile.
     Also, returns the bbox of the area covered in the maptile as lat-lng coordinate (degree)
 
+    Failures are recorded in the failure log (`tilemani.utils.failures`); G_r is None
+    both on a failure and if the area has no road.
+
     Returns
     -------
     - G_r: graph of the retrieved road network
@@ -28,12 +34,11 @@ def get_road_graph_and_bbox(
     radius = extent // 2  # meters
 
     # Get OSM road network as a graph
-    G_r, bbox = None, None
-    try:
+    G_r = None
+    bbox = ox.utils_geo.bbox_from_point(center, dist=radius)
+    with capture(tileXYZ, 'retrieve_road'), timer('retrieve_road'):
+        count('overpass_queries')
         G_r = ox.graph_from_point(center, dist=radius, dist_type='bbox', network_type=network_type)
-        bbox = ox.utils_geo.bbox_from_point(center, dist=radius)
-    except:
-        print(f"{x, y, z} -- Road error:", sys.exc_info()[0])
 
     return G_r, bbox
 
@@ -45,14 +50,79 @@ def get_geoms(
     lat_deg, lng_deg, radius = get_latlng_and_radius(tileXYZ)
 
     gdf = None
-    try:
+    with capture(tileXYZ, 'retrieve_bldg'), timer('retrieve_bldg'):
+        count('overpass_queries')
         gdf = ox.geometries_from_point((lat_deg, lng_deg),
                                        tags=tag,
                                        dist=radius)
-    except:
-        print(f"Bldg retrieval error at {tileXYZ}: ", sys.exc_info()[0]) #todo: make it a logger
 
     return gdf
 
 
+def get_road_graph_and_bbox_from_xml(
+        tileXYZ: Tuple[int, int, int],
+        filepath,
+        retain_all: bool = True,
+) -> Tuple[Optional[Graph], Tuple[float, float, float, float]]:
+    """Same as `get_road_graph_and_bbox`, but reads the road network from a local
+    OSM extract (.osm xml file) instead of querying Overpass.
+    The graph built from the extract is truncated to the bbox of the maptile.
+
+    Note: the extract is expected to already contain only the ways of the wanted
+    `network_type` (e.g. filtered with osmium/osmfilter), since `ox.graph_from_xml`
+    doesn't apply the network_type filter.
+
+    Returns
+    -------
+    - G_r: graph of the road network in the maptile
+    - bbox: bounding box of the area covered in lat,lng degree
+    """
+    x, y, z = tileXYZ
+    center = getGeoFromTile(x, y, z)
+    extent, _ = getTileExtent(x, y, z)
+    radius = extent // 2  # meters
+    bbox = ox.utils_geo.bbox_from_point(center, dist=radius)
+
+    G_r = None
+    with capture(tileXYZ, 'retrieve_road'), timer('retrieve_road'):
+        G = ox.graph_from_xml(filepath, simplify=True, retain_all=retain_all)
+        # count streets per node before truncating, as `ox.graph_from_point` does
+        spn = ox.stats.count_streets_per_node(G)
+        nx.set_node_attributes(G, values=spn, name="street_count")
+        G_r = ox.truncate.truncate_graph_bbox(G, *bbox, truncate_by_edge=True, retain_all=retain_all)
+
+    return G_r, bbox
+
+
+def count_roads_and_bldgs(
+        tileXYZ: Tuple[int, int, int],
+        network_type: str = "drive_service",
+        bldg: bool = True,
+) -> Optional[int]:
+    """Count the roads (ways of `network_type`) and (if `bldg`) building ways/relations
+    that intersect the maptile, with a single Overpass `out count` query.
+    This is much cheaper than retrieving the data, even for a large (low zoom) tile,
+    so it's used to probe whether an area is empty before retrieving it tile by tile.
+
+    Returns
+    -------
+    - number of roads and bldgs in the maptile, or None if the query failed
+    """
+    north, south, east, west = get_tile_bbox(tileXYZ)
+    bbox = f"({south:.7f},{west:.7f},{north:.7f},{east:.7f})"
+    osm_filter = ox.downloader._get_osm_filter(network_type)
+    statements = f'way{osm_filter}{bbox};'
+    if bldg:
+        statements += f'way["building"]{bbox};relation["building"]{bbox};'
+    query = f'[out:json][timeout:{ox.settings.timeout}];({statements});out count;'
+
+    n = None
+    with capture(tileXYZ, 'count'), timer('count'):
+        count('overpass_queries')
+        response = requests.post(f'{ox.settings.overpass_endpoint.rstrip("/")}/interpreter',
+                                 data={'data': query},
+                                 timeout=ox.settings.timeout)
+        response.raise_for_status()
+        n = int(response.json()['elements'][0]['tags']['total'])
 
+    return n
@@ -0,0 +1,106 @@
+"""Ingest of the SpaceNet road labels (GeoJSON or shapefiles of road centerlines), as the
+inputs of the same per-tile label arrays as the OSM road graphs (`tilemani.rasterize.labels`).
+
+All the files of an AOI are read and concatenated into one GeoDataFrame, the columns are
+dropped and cast as in `tilemani.cfgs.osm.spacenet_globals`, and the roads are buffered by the
+radius of their `SpacenetRoad` type, all vectorized over the features (shapely 2).
+
+The buffers (`buff_geo` column) are in Web Mercator, the projection of the maptiles, with the
+radius in meters on the ground at the latitude of each road.
+
+Usage
+-----
+from tilemani.retrieve.spacenet import read_spacenet_roads, buffer_roads
+from tilemani.rasterize.labels import spacenet_tile_labels
+
+gdf = buffer_roads(read_spacenet_roads('SN3_roads_train_AOI_2_Vegas/geojson_roads'))
+labels = spacenet_tile_labels(gdf, zoom=17)  # tileXYZ -> (350, 350) uint8 SpacenetRoad codes
+"""
+from pathlib import Path
+from typing import Iterable, List, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from tilemani.cfgs.osm.road import DEFAULT_ROAD_WIDTH, SpacenetRoad
+from tilemani.cfgs.osm.spacenet_globals import G_DROP_COLS, G_NUMERIC_COLS
+from tilemani.utils.instrument import count
+from tilemani.utils.projection import buffer_meters, to_mercator
+
+SPACENET_SUFFIXES = ('.geojson', '.json', '.shp')
+
+# radius (meters) of each SpacenetRoad value, by value (DEFAULT_ROAD_WIDTH / 2 for unknown types)
+SPACENET_RADIUS = np.full(max(SpacenetRoad) + 1, DEFAULT_ROAD_WIDTH / 2)
+for _r, _radius in SpacenetRoad.radius_mapping().items():
+    SPACENET_RADIUS[_r.value] = _radius
+
+
+def list_spacenet_files(src: Union[Path, str, Iterable[Union[Path, str]]]) -> List[Path]:
+    """Road label files of a directory (recursively), or the given files"""
+    if isinstance(src, (str, Path)) and Path(src).is_dir():
+        return sorted(fp for fp in Path(src).rglob('*') if fp.suffix.lower() in SPACENET_SUFFIXES)
+    return [Path(src)] if isinstance(src, (str, Path)) else [Path(fp) for fp in src]
+
+
+def read_spacenet_roads(src: Union[Path, str, Iterable[Union[Path, str]]],
+                        drop_cols: Sequence[str] = G_DROP_COLS,
+                        numeric_cols: Sequence[str] = G_NUMERIC_COLS) -> gpd.GeoDataFrame:
+    """Read the SpaceNet road files of `src` (a directory, a file or a list of files) into one
+    GeoDataFrame in lng/lat (EPSG:4326).
+
+    The `drop_cols` are dropped, and the `numeric_cols` are cast to int64 (SpaceNet stores
+    them as strings; missing or invalid values become 0, which is not a SpacenetRoad type).
+    Features that are not (multi)lines, or are empty, are dropped (e.g. the empty
+    FeatureCollections of the images without roads).
+
+    Returns
+    -------
+    - GeoDataFrame of the roads, with a `src_file` column (name of the file of each road)
+    """
+    frames = []
+    for fp in list_spacenet_files(src):
+        gdf = gpd.read_file(fp)
+        if gdf.empty:
+            continue
+        if gdf.crs is not None and not gdf.crs.equals('EPSG:4326'):
+            gdf = gdf.to_crs('EPSG:4326')
+        gdf['src_file'] = fp.name
+        frames.append(gdf)
+    if not frames:
+        return gpd.GeoDataFrame({'src_file': [], 'geometry': []}, crs='EPSG:4326')
+    gdf = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs='EPSG:4326')
+
+    gdf = gdf.drop(columns=[c for c in drop_cols if c in gdf.columns])
+    for col in numeric_cols:
+        if col in gdf.columns:
+            gdf[col] = pd.to_numeric(gdf[col], errors='coerce').fillna(0).astype(np.int64)
+    geoms = gdf.geometry.values
+    lines = np.isin(shapely.get_type_id(geoms), [1, 5]) & ~shapely.is_empty(geoms)
+    count('spacenet_roads', int(lines.sum()))
+    return gdf[lines].reset_index(drop=True)
+
+
+def spacenet_radius(road_type: np.ndarray) -> np.ndarray:
+    """Radius (meters) of the roads of each `SpacenetRoad` value (see `radius_mapping`)"""
+    road_type = np.asarray(road_type, dtype=np.int64)
+    known = (road_type >= 0) & (road_type < len(SPACENET_RADIUS))
+    return np.where(known, SPACENET_RADIUS[np.where(known, road_type, 0)], DEFAULT_ROAD_WIDTH / 2)
+
+
+def buffer_roads(gdf: gpd.GeoDataFrame, type_col: str = 'road_type') -> gpd.GeoDataFrame:
+    """Add the `buff_geo` column: the roads in Web Mercator (EPSG:3857), buffered by the
+    radius of their SpacenetRoad type (in the `type_col` column) in meters on the ground.
+
+    Returns
+    -------
+    - the GeoDataFrame (modified in place), whose active geometry column stays `geometry`
+    """
+    geoms = np.asarray(gdf.geometry.values)
+    road_type = gdf[type_col].to_numpy() if type_col in gdf.columns else np.zeros(len(gdf))
+    bounds = shapely.bounds(geoms)
+    lat = (bounds[:, 1] + bounds[:, 3]) / 2 if len(geoms) else np.empty(0)
+    buffers = buffer_meters(to_mercator(geoms), spacenet_radius(road_type), lat)
+    gdf['buff_geo'] = gpd.GeoSeries(buffers, index=gdf.index, crs='EPSG:3857')
+    return gdf
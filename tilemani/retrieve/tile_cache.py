@@ -0,0 +1,176 @@
+"""Validators and content-addressed storage of the downloaded tiles, for refresh runs.
+
+The `TileCache` of a download root keeps, in a sqlite database, the validators of each tile
+of each tile source that was downloaded: the ETag and Last-Modified headers of the response and
+the sha1 of its bytes. A refresh of the tiles sends conditional requests (If-None-Match /
+If-Modified-Since), so that the tiles that did not change on the server are answered with a
+304 and no bytes, and nothing is written.
+
+The tile images are stored once per content, in `blobs/` (by their sha1), and the tiles of the
+output folders are hard links to them (copies where the file system can't link): identical
+tiles, e.g. the uniform backgrounds of many styles or the same tile in several cities, take
+the disk space of one, and an unchanged tile is not written again.
+
+Usage
+-----
+from tilemani.retrieve.downloader import TileDownloader
+from tilemani.retrieve.tile_cache import TileCache
+
+downloader = TileDownloader(cache=TileCache(out_dir_root))
+stats = downloader.download(provider, style, tiles, out_dir)
+# refresh: Counter({'not_modified': 110, 'downloaded': 10})
+"""
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request as ur
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+from tilemani.retrieve.tile_sources import image_signature
+
+TileXYZ = Tuple[int, int, int]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    source TEXT NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    z INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    sha1 TEXT NOT NULL,
+    blank INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (source, x, y, z)
+)
+"""
+
+
+@dataclass(frozen=True)
+class Validators:
+    """What we know of the last version of a tile that was downloaded"""
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    sha1: Optional[str] = None
+    blank: bool = False
+
+    def headers(self) -> dict:
+        """Headers of a conditional request for a newer version of the tile"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+@dataclass(frozen=True)
+class FetchResult:
+    """Response to a (conditional) GET: status 200 with the body, or 304 without"""
+    status: int
+    data: bytes = b''
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+
+def fetch_url_conditional(url: str, validators: Optional[Validators] = None,
+                          timeout: float = 30.) -> FetchResult:
+    """GET of the url, conditional on the validators of the last version we have (raises on HTTP
+    errors other than 304 Not Modified)"""
+    headers = {'User-Agent': 'tilemani'}
+    if validators is not None:
+        headers.update(validators.headers())
+    try:
+        with ur.urlopen(ur.Request(url, headers=headers), timeout=timeout) as resp:
+            return FetchResult(resp.status, resp.read(), resp.headers.get('ETag'),
+                               resp.headers.get('Last-Modified'))
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        return FetchResult(304, b'', e.headers.get('ETag'), e.headers.get('Last-Modified'))
+
+
+class TileCache:
+    """Validators (sqlite) and content-addressed blobs of the tiles downloaded under `root`
+    (see the module doc). Safe to share between the threads of a `TileDownloader`.
+
+    Args
+    ----
+    root : Path or str
+        folder of the database (`tiles.sqlite`) and of the blobs (`blobs/`)
+    """
+
+    def __init__(self, root: Union[Path, str]):
+        self.root = Path(root)
+        self.blob_dir = self.root / 'blobs'
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.root / 'tiles.sqlite'), check_same_thread=False)
+        with self._db:
+            self._db.execute(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+    def validators(self, source: str, tileXYZ: TileXYZ) -> Optional[Validators]:
+        """Validators of the last download of the tile of the source, if any"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT etag, last_modified, sha1, blank FROM tiles WHERE source=? AND x=? AND y=? AND z=?',
+                (source, *tileXYZ)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, sha1, blank = row
+        return Validators(etag, last_modified, sha1, bool(blank))
+
+    def update(self, source: str, tileXYZ: TileXYZ, validators: Validators) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (source, *tileXYZ, validators.etag, validators.last_modified, validators.sha1,
+                 int(validators.blank), time.time()))
+
+    def blob_path(self, sha1: str) -> Path:
+        return self.blob_dir / sha1[:2] / f'{sha1}.png'
+
+    def store(self, data: bytes, sha1: Optional[str] = None) -> Path:
+        """Path of the blob of the image bytes, written only if it's a new content"""
+        fp = self.blob_path(sha1 or image_signature(data))
+        if not fp.exists():
+            fp.parent.mkdir(exist_ok=True)
+            tmp = fp.with_name(f'{fp.name}.{threading.get_ident()}.tmp')
+            tmp.write_bytes(data)
+            os.replace(tmp, fp)
+        return fp
+
+    def link(self, sha1: str, fp: Path) -> None:
+        """Make `fp` the blob of the content (a hard link, or a copy)"""
+        blob = self.blob_path(sha1)
+        if fp.exists():
+            if fp.samefile(blob):
+                return
+            fp.unlink()
+        try:
+            os.link(blob, fp)
+        except OSError:
+            shutil.copyfile(blob, fp)
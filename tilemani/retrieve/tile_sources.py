@@ -0,0 +1,186 @@
+"""Registry of the raster tile providers that `scripts/downloader.py` downloads maptiles from.
+
+A `TileProvider` holds everything the downloader needs to know about a provider:
+- the url template of each of its styles, with {X}, {Y}, {Z} and optionally {s} (subdomain);
+- its subdomains, rotated over the tiles to spread the requests over its hosts;
+- the limits we keep to when downloading from it: max number of concurrent requests and
+  max requests per second (shared by all its styles, since they're served by the same hosts);
+- the signatures (sha1 of the image bytes) of its blank tiles that are not a single color
+  (e.g. a "map data not yet available" placeholder), on top of the single-color check of
+  `is_blank_image`. No signature is registered with the providers below: the field is a hook,
+  filled from sample tiles with `add_blank_tiles` once a placeholder is found in a download.
+
+Styles are named in snake_case (e.g. 'toner_background'), and the name of a tile source (a
+provider and a style) is the provider name followed by the style in CamelCase (e.g.
+'StamenTonerBackground'), which is also the name of its folder in the downloaded data.
+
+Usage
+-----
+from tilemani.retrieve.tile_sources import TileProvider, get_provider, get_tile_source, register_provider
+
+provider = get_provider('carto')
+provider.url('light_no_labels', 4823, 6160, 14)  # https://d.basemaps.cartocdn.com/light_nolabels/14/4823/6160.png
+provider, style = get_tile_source('CartoLightNoLabels')
+register_provider(TileProvider('Local', {'default': 'http://localhost:8080/{Z}/{X}/{Y}.png'}))
+add_blank_tiles('esri', ['samples/esri_not_available.jpg'])
+"""
+import dataclasses
+import hashlib
+import io
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+
+def snake2camel(name: str) -> str:
+    """'toner_background' -> 'TonerBackground'"""
+    return ''.join(part.capitalize() for part in name.split('_'))
+
+
+def is_blank_image(data: bytes) -> bool:
+    """Whether the image (encoded bytes) is a single color, e.g. sea or plain land"""
+    with Image.open(io.BytesIO(data)) as im:
+        arr = np.asarray(im)
+    flat = arr.reshape(-1, arr.shape[-1]) if arr.ndim == 3 else arr.reshape(-1, 1)
+    return bool(len(flat) == 0 or (flat == flat[0]).all())
+
+
+def image_signature(data: bytes) -> str:
+    """Signature of the image bytes, as in `TileProvider.blank_signatures`"""
+    return hashlib.sha1(data).hexdigest()
+
+
+@dataclass(frozen=True)
+class TileProvider:
+    """A raster tile provider and its styles (see the module doc).
+
+    Args
+    ----
+    name : str
+        CamelCase name of the provider, e.g. 'Stamen'. Lookups in the registry are case-insensitive
+    urls : dict
+        style -> url template, with {X}, {Y}, {Z} and optionally {s}
+    subdomains : tuple of str
+        values of {s}. The subdomain of a tile is fixed (by its x, y), so that a tile is always
+        requested from the same host (and hits its cache), while neighboring tiles are spread
+        over all the hosts
+    max_concurrency : int
+        max number of concurrent requests to the provider
+    requests_per_sec : float
+        max number of requests per second to the provider (0: no limit)
+    blank_signatures : frozenset of str
+        `image_signature`s of the provider's blank tiles that are not a single color
+        (none by default, see `add_blank_tiles`)
+    """
+    name: str
+    urls: Dict[str, str]
+    subdomains: Tuple[str, ...] = ()
+    max_concurrency: int = 4
+    requests_per_sec: float = 8.
+    blank_signatures: FrozenSet[str] = field(default_factory=frozenset)
+
+    @property
+    def styles(self) -> List[str]:
+        return list(self.urls)
+
+    def source_name(self, style: str) -> str:
+        """Name of the tile source of the style, e.g. 'StamenTonerBackground'"""
+        return f'{self.name}{snake2camel(style)}'
+
+    def subdomain(self, x: int, y: int) -> str:
+        if not self.subdomains:
+            return ''
+        return self.subdomains[(x + y) % len(self.subdomains)]
+
+    def url(self, style: str, x: int, y: int, z: int) -> str:
+        style = style.lower()
+        if style not in self.urls:
+            raise ValueError(f"{style} is not a style of {self.name}: {self.styles}")
+        return self.urls[style].format(X=x, Y=y, Z=z, s=self.subdomain(x, y))
+
+    def is_blank(self, data: bytes) -> bool:
+        """Whether the tile image (encoded bytes) is blank: a known blank tile, or a single color"""
+        return image_signature(data) in self.blank_signatures or is_blank_image(data)
+
+
+_ESRI = 'https://server.arcgisonline.com/ArcGIS/rest/services/{}/MapServer/tile/{{Z}}/{{Y}}/{{X}}'
+_STADIA = 'https://tiles.stadiamaps.com/tiles/stamen_{}/{{Z}}/{{X}}/{{Y}}.{}'
+_CARTO = 'https://{{s}}.basemaps.cartocdn.com/{}/{{Z}}/{{X}}/{{Y}}.png'
+
+Stamen = TileProvider(
+    'Stamen',
+    {style: _STADIA.format(style, 'jpg' if style == 'watercolor' else 'png')
+     for style in ['toner', 'toner_background', 'toner_lines', 'terrain', 'terrain_background',
+                   'terrain_lines', 'watercolor']},
+    max_concurrency=4, requests_per_sec=8.)
+Esri = TileProvider(
+    'Esri',
+    {'imagery': _ESRI.format('World_Imagery'),
+     'nat_geo': _ESRI.format('NatGeo_World_Map'),
+     'terrain': _ESRI.format('World_Terrain_Base'),
+     'street': _ESRI.format('World_Street_Map'),
+     'topo': _ESRI.format('World_Topo_Map'),
+     'ocean': _ESRI.format('Ocean/World_Ocean_Base'),
+     'light_gray': _ESRI.format('Canvas/World_Light_Gray_Base')},
+    max_concurrency=6, requests_per_sec=10.)
+Carto = TileProvider(
+    'Carto',
+    {'light': _CARTO.format('light_all'),
+     'dark': _CARTO.format('dark_all'),
+     'light_no_labels': _CARTO.format('light_nolabels'),
+     'dark_no_labels': _CARTO.format('dark_nolabels'),
+     'voyager': _CARTO.format('rastertiles/voyager'),
+     'voyager_no_labels': _CARTO.format('rastertiles/voyager_nolabels')},
+    subdomains=('a', 'b', 'c', 'd'), max_concurrency=8, requests_per_sec=16.)
+# https://operations.osmfoundation.org/policies/tiles/: at most 2 connections
+OSM = TileProvider(
+    'OSM', {'default': 'https://tile.openstreetmap.org/{Z}/{X}/{Y}.png'},
+    max_concurrency=2, requests_per_sec=2.)
+NLS = TileProvider(
+    'NLS', {'default': 'https://nls-{s}.tileserver.com/nls/{Z}/{X}/{Y}.jpg'},
+    subdomains=('0', '1', '2', '3'), max_concurrency=4, requests_per_sec=8.)
+Mtbmap = TileProvider(
+    'Mtbmap', {'default': 'http://tile.mtbmap.cz/mtbmap_tiles/{Z}/{X}/{Y}.png'},
+    max_concurrency=2, requests_per_sec=4.)
+
+TILE_PROVIDERS: Dict[str, TileProvider] = {}
+
+
+def register_provider(provider: TileProvider) -> TileProvider:
+    """Add (or replace) the provider in the registry"""
+    TILE_PROVIDERS[provider.name.lower()] = provider
+    return provider
+
+
+for _provider in (Stamen, Esri, Carto, OSM, NLS, Mtbmap):
+    register_provider(_provider)
+
+
+def add_blank_tiles(name: str, tile_fps: Iterable[Union[str, Path]]) -> TileProvider:
+    """Register the provider of the name again, with the signatures of the sample tile files
+    (e.g. a placeholder tile saved from a download) added to its `blank_signatures`"""
+    provider = get_provider(name)
+    signatures = {image_signature(Path(fp).read_bytes()) for fp in tile_fps}
+    return register_provider(dataclasses.replace(provider,
+                                                 blank_signatures=provider.blank_signatures | signatures))
+
+
+def get_provider(name: str) -> TileProvider:
+    """The registered provider of the name (case-insensitive)"""
+    try:
+        return TILE_PROVIDERS[name.lower()]
+    except KeyError:
+        raise ValueError(f"{name} is not a registered tile provider: "
+                         f"{[p.name for p in TILE_PROVIDERS.values()]}") from None
+
+
+def get_tile_source(source_name: str) -> Tuple[TileProvider, str]:
+    """(provider, style) of a tile source name, e.g. 'StamenTonerBackground' or 'OSMDefault'"""
+    for provider in TILE_PROVIDERS.values():
+        for style in provider.styles:
+            if provider.source_name(style).lower() == source_name.lower():
+                return provider, style
+    raise ValueError(f"{source_name} is not the name of a tile source of a registered provider")
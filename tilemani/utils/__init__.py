@@ -1,3 +1,7 @@
 from . import geo
+from . import graph
+from . import instrument
 from . import misc
-from . import np
\ No newline at end of file
+from . import np
+from . import projection
+from . import tiles
\ No newline at end of file
@@ -0,0 +1,300 @@
+"""Structured capture of per-tile failures, and a retry queue to re-process only the
+tiles whose failures are worth retrying.
+
+Usage
+-----
+from tilemani.utils.failures import capture, get_failure_log
+
+with capture(tileXYZ, 'retrieve_road'):
+    G_r = ox.graph_from_point(...)   # exceptions are recorded (not raised) as FailureRecords
+
+get_failure_log().to_csv('records/paris-failures.csv')
+
+# later: re-process only the retryable failures, with exponential backoff
+failures = read_failures('records/paris-failures.csv')
+still_failing = retry_failures(failures, process_tile)
+
+Failures vs. empty areas
+------------------------
+Overpass returning no elements (osmnx's `EmptyOverpassResponse`, or a graph without nodes
+after truncation) means that the tile covers an area without roads/buildings.
+This is not recorded as a failure; it's counted as `empty_results` by the instrument.
+"""
+import csv
+import json
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from urllib.error import URLError, HTTPError
+
+import requests
+from geopy import exc as geopy_exc
+
+from tilemani.utils.instrument import count
+
+# Exceptions from the network or an overloaded server: a later attempt may succeed
+RETRYABLE_EXCEPTIONS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    URLError,
+    json.JSONDecodeError,  # truncated response
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    geopy_exc.GeocoderTimedOut,
+    geopy_exc.GeocoderUnavailable,
+    geopy_exc.GeocoderRateLimited,
+)
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# Messages of the ValueErrors raised by osmnx when the area has no data
+_EMPTY_RESULT_MESSAGES = (
+    'There are no data elements in the response JSON',
+    'Found no graph nodes within the requested polygon',
+    'graph contains no nodes',
+    'graph contains no edges',
+)
+
+
+def is_empty_result(exc: BaseException) -> bool:
+    """True if the exception means that OSM has no data for the area, rather than a failure"""
+    return isinstance(exc, ValueError) and any(m in str(exc) for m in _EMPTY_RESULT_MESSAGES)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """True if the failure is transient (network, timeouts, rate limits, server errors)"""
+    if isinstance(exc, HTTPError):
+        return exc.code in RETRYABLE_STATUS_CODES
+    if isinstance(exc, requests.exceptions.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(exc, RETRYABLE_EXCEPTIONS):
+        return True
+    # osmnx raises a plain Exception on a non-json error response from the server
+    return type(exc) is Exception and str(exc).startswith('Server returned')
+
+
+@dataclass
+class FailureRecord:
+    """A failure of one stage (e.g. 'retrieve_road', 'save_geojson') at one tile"""
+    x: int
+    y: int
+    z: int
+    stage: str
+    exc_type: str
+    message: str
+    retryable: bool
+    elapsed: float  # seconds spent in the stage until it failed
+    attempt: int = 0
+    timestamp: float = 0.
+
+    @property
+    def tileXYZ(self) -> Tuple[int, int, int]:
+        return (self.x, self.y, self.z)
+
+    @classmethod
+    def from_exception(cls,
+                       tileXYZ: Tuple[int, int, int],
+                       stage: str,
+                       exc: BaseException,
+                       elapsed: float = 0.,
+                       attempt: int = 0) -> 'FailureRecord':
+        exc_type = type(exc)
+        x, y, z = tileXYZ
+        return cls(
+            x=int(x), y=int(y), z=int(z),
+            stage=stage,
+            exc_type=f'{exc_type.__module__}.{exc_type.__qualname__}',
+            message=str(exc).replace('\n', ' ')[:500],
+            retryable=is_retryable(exc),
+            elapsed=elapsed,
+            attempt=attempt,
+            timestamp=time.time(),
+        )
+
+
+class FailureLog:
+    """Thread-safe table of the FailureRecords of a run.
+
+    Args
+    ----
+    attempt : int
+        attempt number stamped on the records (0 for the first run, >0 in the retry queue)
+    verbose : bool
+        if True, print a line for each failure as it's recorded
+    """
+    fieldnames = [f.name for f in fields(FailureRecord)]
+
+    def __init__(self, attempt: int = 0, verbose: bool = True):
+        self.attempt = attempt
+        self.verbose = verbose
+        self.records: List[FailureRecord] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record: FailureRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+        count('failures')
+        if record.retryable:
+            count('retryable_failures')
+        if self.verbose:
+            print(f"{record.tileXYZ} -- {record.stage} failed"
+                  f"{' (retryable)' if record.retryable else ''}: {record.exc_type}: {record.message[:200]}")
+
+    def add_exception(self,
+                      tileXYZ: Tuple[int, int, int],
+                      stage: str,
+                      exc: BaseException,
+                      elapsed: float = 0.) -> FailureRecord:
+        record = FailureRecord.from_exception(tileXYZ, stage, exc, elapsed, attempt=self.attempt)
+        self.add(record)
+        return record
+
+    @contextmanager
+    def capture(self, tileXYZ: Tuple[int, int, int], stage: str, reraise: bool = False):
+        """Record any exception raised in the block as a failure of `stage` at `tileXYZ`.
+        The exception is swallowed unless `reraise`; 'no data' results are only counted."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if is_empty_result(e):
+                count('empty_results')
+            else:
+                self.add_exception(tileXYZ, stage, e, time.perf_counter() - start)
+            if reraise:
+                raise
+
+    def tiles(self, retryable_only: bool = False) -> List[Tuple[int, int, int]]:
+        """Unique tiles with (retryable) failures, in the order of their first failure"""
+        tiles = {r.tileXYZ: None for r in self.records if r.retryable or not retryable_only}
+        return list(tiles)
+
+    def to_csv(self, fp: Union[Path, str], verbose: bool = False) -> None:
+        """Append the records to the failures table at `fp` (csv, header written once)"""
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        write_header = not fp.exists() or fp.stat().st_size == 0
+        with self._lock, open(fp, 'a', newline='') as csv_f:
+            writer = csv.DictWriter(csv_f, fieldnames=self.fieldnames)
+            if write_header:
+                writer.writeheader()
+            writer.writerows(asdict(r) for r in self.records)
+        if verbose:
+            print(f'\tWrote {len(self.records)} failures to: ', fp)
+
+
+def read_failures(fp: Union[Path, str]) -> List[FailureRecord]:
+    """Read the failures table written by `FailureLog.to_csv`"""
+    casts = {'x': int, 'y': int, 'z': int, 'elapsed': float, 'attempt': int, 'timestamp': float,
+             'retryable': lambda v: v == 'True'}
+    with open(fp, newline='') as csv_f:
+        return [FailureRecord(**{k: casts.get(k, str)(v) for k, v in row.items()})
+                for row in csv.DictReader(csv_f)]
+
+
+def latest_failures(failures: Iterable[FailureRecord]) -> List[FailureRecord]:
+    """Keep, for each tile, only the failures of its latest attempt. A tile that was
+    re-processed without failing in a later attempt doesn't appear in the table's later
+    attempts, so this is meant for tables with all attempts appended."""
+    failures = list(failures)
+    last_attempt: Dict[Tuple[int, int, int], int] = {}
+    for r in failures:
+        last_attempt[r.tileXYZ] = max(last_attempt.get(r.tileXYZ, -1), r.attempt)
+    return [r for r in failures if r.attempt == last_attempt[r.tileXYZ]]
+
+
+def backoff_delay(attempt: int, base_delay: float = 1., max_delay: float = 60.,
+                  jitter: bool = True) -> float:
+    """Exponential backoff: base_delay * 2**attempt, capped at max_delay, with full jitter"""
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return random.uniform(0, delay) if jitter else delay
+
+
+def retry_failures(failures: Iterable[FailureRecord],
+                   process_tile: Callable[[Tuple[int, int, int]], object],
+                   max_attempts: int = 5,
+                   base_delay: float = 1.,
+                   max_delay: float = 60.,
+                   jitter: bool = True,
+                   failures_fp: Optional[Union[Path, str]] = None,
+                   verbose: bool = True) -> List[FailureRecord]:
+    """Retry queue: re-process the tiles that have retryable failures, and only those.
+
+    Each tile is re-processed by `process_tile(tileXYZ)`, which should record its failures
+    through `capture`/`get_failure_log()` (as the retriever and writers do).
+    A tile is queued again, after an exponential backoff, while its new failures are all
+    retryable and it has been tried fewer than `max_attempts` times.
+    If `failures_fp` is given, the failures of every attempt are appended to that table.
+
+    Returns
+    -------
+    - failures of the last attempt of each tile that still fails
+    """
+    failures = list(failures)
+    attempts = {r.tileXYZ: r.attempt for r in failures if r.retryable}
+    queue = [(0., tileXYZ) for tileXYZ in attempts]  # (not before this time, tile)
+    remaining: List[FailureRecord] = []
+
+    while queue:
+        queue.sort()
+        not_before, tileXYZ = queue.pop(0)
+        wait = not_before - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        attempt = attempts[tileXYZ] + 1
+        attempts[tileXYZ] = attempt
+        log = FailureLog(attempt=attempt, verbose=verbose)
+        previous = set_failure_log(log)
+        try:
+            process_tile(tileXYZ)
+        except Exception as e:
+            log.add_exception(tileXYZ, 'process_tile', e)
+        finally:
+            set_failure_log(previous)
+
+        if failures_fp is not None and len(log):
+            log.to_csv(failures_fp)
+        if not len(log):
+            count('retried_ok')
+            if verbose:
+                print(f'{tileXYZ} -- succeeded at attempt {attempt}')
+        elif all(r.retryable for r in log.records) and attempt < max_attempts:
+            queue.append((time.time() + backoff_delay(attempt, base_delay, max_delay, jitter), tileXYZ))
+        else:
+            remaining.extend(log.records)
+
+    return remaining
+
+
+# FailureLog used by the pipeline's modules unless another one is set
+_FAILURE_LOG = FailureLog()
+
+
+def get_failure_log() -> FailureLog:
+    return _FAILURE_LOG
+
+
+def set_failure_log(failure_log: FailureLog) -> FailureLog:
+    """Replace the module-level failure log (e.g. one per city/run). Returns the previous one"""
+    global _FAILURE_LOG
+    previous, _FAILURE_LOG = _FAILURE_LOG, failure_log
+    return previous
+
+
+def capture(tileXYZ: Tuple[int, int, int], stage: str, reraise: bool = False):
+    return get_failure_log().capture(tileXYZ, stage, reraise=reraise)
+
+
+def record_failure(tileXYZ: Tuple[int, int, int], stage: str, exc: BaseException,
+                   elapsed: float = 0.) -> FailureRecord:
+    return get_failure_log().add_exception(tileXYZ, stage, exc, elapsed)
@@ -1,10 +1,11 @@
-import sys
 from pathlib import Path
 from typing import Tuple, Dict, List
 
 import math
 from geopy.geocoders import Nominatim
 
+from tilemani.utils.failures import capture
+
 
 def deg2rad(x):
 	"""Convert the unit of x from degree to radian"""
@@ -43,15 +44,24 @@ def getTileExtent(x, y, zoom):
     Ref: "Distance per pixel math" in https://wiki.openstreetmap.org/wiki/Zoom_levels
 
     """
-	lat_deg, lon_deg = getGeoFromTile(x,y,zoom)
-	lat_rad, lon_rad = deg2rad(lat_deg), deg2rad(lon_deg)
+	lat_deg, _ = getGeoFromTile(x,y,zoom)
+	lat_rad = deg2rad(lat_deg)
 
 	C_meters = 2*math.pi*6378137 # equatorial circumference of the Earth in meters
 	size_y = C_meters * math.cos(lat_rad)/2**zoom
-	size_x = C_meters * math.cos(lon_rad)/2**zoom
+	# Web Mercator is conformal: the horizontal scale is that of the latitude, as the vertical one
+	size_x = C_meters * math.cos(lat_rad)/2**zoom
 	return size_y, size_x
 
 
+def getMetersPerPixel(x, y, zoom, tile_px=256):
+	"""Ground distance (in meters) covered by a pixel of the tile rendered at `tile_px` x `tile_px`,
+	at the latitude of the center of the tile (`getTileExtent` of its center)
+	"""
+	size_y, _ = getTileExtent(x + 0.5, y + 0.5, zoom)
+	return size_y / tile_px
+
+
 def get_latlng_and_radius(tileXYZ: Tuple[int, int, int]) -> Tuple[float, float, float]:
 	"""Given tile index X,Y,Z, compute its lat,lng in degree
     and compute the radius (in meters) of the covered area
@@ -97,14 +107,13 @@ def getAddrFromTile(x: int, y: int, z: int,
 	geolocator = Nominatim(user_agent="temp")
 
 	addr = ''
-	try:
+	# failures are recorded in the failure log, under the stage 'reverse_geocode'
+	with capture((x, y, z), 'reverse_geocode'):
 		location = geolocator.reverse(f"{lat_deg}, {lng_deg}",
 									  exactly_one=True,
 									  zoom=detail_zoom,
 									  language=language)
 		addr = location[0]
-	except:
-		print(f"Nominatim reverse failed at {x, y, z}: ", sys.exc_info()[0])
 
 	return addr
 
@@ -0,0 +1,145 @@
+"""Cache of the undirected versions of the road graphs.
+
+`osmnx.utils_graph.get_undirected` copies the whole MultiDiGraph and compares the geometries
+of the reciprocal edges, on every call. The renders of a tile (one per style) and the stats
+all need the undirected graph of the same G, so it's converted once and cached.
+
+`GraphCache` caches any other conversion of a graph the same way (e.g. the projected
+coordinates of `tilemani.utils.projection`).
+
+Cache entries are keyed by the identity of G and stamped with its version: a graph that is
+modified in place after being converted must be marked with `touch_graph(G)` (or its entry
+dropped with `invalidate_undirected(G)`). As a safety net, a change in the number of nodes or
+edges also invalidates the entry. The returned undirected graph is shared: don't modify it.
+
+Usage
+-----
+from tilemani.utils.graph import get_undirected, touch_graph
+
+Gu = get_undirected(G)   # converted
+Gu = get_undirected(G)   # cached
+G.add_edge(...); touch_graph(G)
+Gu = get_undirected(G)   # converted again
+"""
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from networkx import MultiDiGraph, MultiGraph
+from osmnx import utils_graph
+
+from tilemani.utils.instrument import count
+
+VERSION_KEY = 'tilemani_version'
+
+
+def graph_version(G) -> int:
+    """Version stamp of the graph, incremented by `touch_graph`"""
+    return G.graph.get(VERSION_KEY, 0)
+
+
+def touch_graph(G) -> int:
+    """Mark the graph as modified (in place), so that its cached conversions are recomputed.
+    Returns the new version"""
+    G.graph[VERSION_KEY] = graph_version(G) + 1
+    return G.graph[VERSION_KEY]
+
+
+class GraphCache:
+    """Bounded (LRU) cache of a conversion `convert(G)` of graphs, keyed by graph identity
+    and version. Entries are dropped when their graph is garbage collected: the weakref
+    callback only queues the key (it can run during any allocation, e.g. while `_lock` is held by
+    the same thread), and the queued entries are purged on the next `get` or `invalidate`.
+
+    Args
+    ----
+    convert : callable
+        conversion of a graph to cache (e.g. its undirected version)
+    maxsize : int
+        max number of cached conversions
+    hits_counter : str
+        name of the counter (see `tilemani.utils.instrument.count`) of the cache hits
+    """
+
+    def __init__(self, convert: Callable, maxsize: int = 16, hits_counter: str = 'graph_cache_hits'):
+        self.convert = convert
+        self.maxsize = maxsize
+        self.hits_counter = hits_counter
+        self._entries = OrderedDict()  # id(G) -> (weakref to G, stamp, conversion)
+        self._lock = threading.Lock()
+        self._dead = []  # keys of the collected graphs, to purge (list.append is atomic)
+
+    def __len__(self):
+        with self._lock:
+            self._purge()
+            return len(self._entries)
+
+    @staticmethod
+    def _stamp(G):
+        return graph_version(G), G.number_of_nodes(), G.number_of_edges()
+
+    def get(self, G: MultiDiGraph):
+        key = id(G)
+        stamp = self._stamp(G)
+        with self._lock:
+            self._purge()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is G and entry[1] == stamp:
+                self._entries.move_to_end(key)
+                count(self.hits_counter)
+                return entry[2]
+
+        converted = self.convert(G)
+        ref = weakref.ref(G, lambda _, key=key: self._drop(key))
+        with self._lock:
+            self._entries[key] = (ref, stamp, converted)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return converted
+
+    def _drop(self, key: int) -> None:
+        # weakref callback: must not take the lock
+        self._dead.append(key)
+
+    def _purge(self) -> None:
+        """Drop the entries of the collected graphs (with the lock held). The id of a collected
+        graph can be reused by a new one, so an entry is only dropped if its graph is dead"""
+        while self._dead:
+            key = self._dead.pop()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is None:
+                del self._entries[key]
+
+    def invalidate(self, G: Optional[MultiDiGraph] = None) -> None:
+        """Drop the entry of `G`, or all entries if `G` is None"""
+        with self._lock:
+            self._purge()
+            if G is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(id(G), None)
+
+
+class UndirectedCache(GraphCache):
+    """Bounded (LRU) cache of `osmnx.utils_graph.get_undirected` (see `GraphCache`)"""
+
+    def __init__(self, maxsize: int = 16):
+        super().__init__(utils_graph.get_undirected, maxsize, 'undirected_cache_hits')
+
+
+# Cache used by the pipeline's modules
+_UNDIRECTED_CACHE = UndirectedCache()
+
+
+def get_undirected(G: MultiDiGraph) -> MultiGraph:
+    """Cached `osmnx.utils_graph.get_undirected`. An undirected graph is returned as is"""
+    if not G.is_directed():
+        return G
+    return _UNDIRECTED_CACHE.get(G)
+
+
+def invalidate_undirected(G: Optional[MultiDiGraph] = None) -> None:
+    """Drop the cached undirected graph of `G`, or all of them if `G` is None"""
+    _UNDIRECTED_CACHE.invalidate(G)
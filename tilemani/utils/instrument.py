@@ -0,0 +1,298 @@
+"""Per-stage timers and counters for the tile pipeline.
+
+Usage
+-----
+from tilemani.utils.instrument import timer, timed, count, get_instrument
+
+with timer('retrieve_road'):
+    G_r = ox.graph_from_point(...)
+count('overpass_queries')
+
+@timed('stats')
+def compute_road_network_stats(G): ...
+
+# at the end of a run
+get_instrument().to_jsonl('records/paris-metrics.jsonl')
+get_instrument().to_prometheus('records/paris.prom')
+
+Stage names used by the pipeline
+--------------------------------
+- retrieve_road, retrieve_bldg: OSM retrieval (network or cache)
+- render_road, render_bldg, render_road_bldg: drawing of each style into a figure
+- save_png, save_graphml, save_geojson, save_record: writing outputs to disk
+- stats: `compute_road_network_stats`
+- download: fetching a maptile from a tile server
+
+Counters used by the pipeline
+-----------------------------
+- tiles, overpass_queries, cache_hits, blank_tiles, empty_tiles, failures
+- chunks, memory_budget_exceeded: streaming runs (see `MemoryBudget`)
+"""
+import gc
+import json
+import os
+import resource
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+
+def current_rss_bytes() -> int:
+    """Current resident set size of this process (in bytes).
+    Reads /proc/self/statm; falls back to the peak rss where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process so far (in bytes)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux, but in bytes on macOS
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+class Instrument:
+    """Collects wall-clock timings per stage and event counters for one run.
+    The updates are guarded by a lock, since the stages of a run are timed from several
+    threads (tile writers, downloaders, the executor of the Overpass client).
+
+    Args
+    ----
+    run_id : str
+        identifies the run in the exported metrics. Default: current time as yyyymmdd-HHMMSS
+    keep_events : bool
+        if True, keep every single timing with its labels (e.g. tile=x_y_z) and write
+        them as individual lines in `to_jsonl`. Otherwise only per-stage aggregates are kept.
+    """
+
+    def __init__(self, run_id: Optional[str] = None, keep_events: bool = False):
+        self.run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+        self.keep_events = keep_events
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.start_time = time.time()
+            self.totals = defaultdict(float)  # stage -> total seconds
+            self.calls = Counter()  # stage -> number of timed calls
+            self.maxs = defaultdict(float)  # stage -> slowest call in seconds
+            self.counters = Counter()
+            self.events = []
+            self.max_rss = 0
+
+    def add_timing(self, stage: str, seconds: float, **labels) -> None:
+        with self._lock:
+            self.totals[stage] += seconds
+            self.calls[stage] += 1
+            self.maxs[stage] = max(self.maxs[stage], seconds)
+            if self.keep_events:
+                self.events.append({'stage': stage, 'seconds': seconds, **labels})
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """Time the enclosed block as a call of `stage`. The timing is recorded even if
+        the block raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, time.perf_counter() - start, **labels)
+
+    def timed(self, stage: str) -> Callable:
+        """Decorator version of `timer`"""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def sample_rss(self) -> int:
+        """Record the current rss, keeping the maximum over the samples; returns the current rss"""
+        rss = current_rss_bytes()
+        with self._lock:
+            self.max_rss = max(self.max_rss, rss)
+        return rss
+
+    def summary(self) -> Dict:
+        """Aggregated metrics of the run so far as a dict (a consistent snapshot)"""
+        self.sample_rss()
+        with self._lock:
+            return {
+                'run_id': self.run_id,
+                'elapsed': time.time() - self.start_time,
+                'stages': {
+                    stage: {
+                        'calls': self.calls[stage],
+                        'total': total,
+                        'mean': total / self.calls[stage],
+                        'max': self.maxs[stage],
+                    }
+                    for stage, total in self.totals.items()
+                },
+                'counters': dict(self.counters),
+                'max_rss_bytes': self.max_rss,
+                'peak_rss_bytes': peak_rss_bytes(),
+            }
+
+    def to_jsonl(self, fp: Union[Path, str], verbose: bool = False) -> None:
+        """Append the metrics of this run to `fp` as json lines: one line per stage,
+        one line for the counters and rss, and (if `keep_events`) one line per event.
+        Each line has the `run_id` and a `kind` field ('stage', 'counters', 'event')."""
+        summary = self.summary()
+        lines = []
+        for stage, agg in summary['stages'].items():
+            lines.append({'run_id': self.run_id, 'kind': 'stage', 'stage': stage, **agg})
+        lines.append({'run_id': self.run_id, 'kind': 'counters',
+                      'elapsed': summary['elapsed'],
+                      'max_rss_bytes': summary['max_rss_bytes'],
+                      'peak_rss_bytes': summary['peak_rss_bytes'],
+                      **summary['counters']})
+        with self._lock:
+            events = list(self.events)
+        lines.extend({'run_id': self.run_id, 'kind': 'event', **e} for e in events)
+
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        with open(fp, 'a') as f:
+            for line in lines:
+                f.write(json.dumps(line) + '\n')
+        if verbose:
+            print('\tWrote metrics as json lines to: ', fp)
+
+    def to_prometheus(self, fp: Union[Path, str], prefix: str = 'tilemani',
+                      verbose: bool = False) -> None:
+        """Write the metrics of this run in the Prometheus textfile-collector format.
+        The file is written to a temporary file first and renamed, so that a collector never
+        reads a partial file."""
+        summary = self.summary()
+        run = f'run_id="{self.run_id}"'
+        lines = [
+            f'# TYPE {prefix}_stage_seconds_total counter',
+            *(f'{prefix}_stage_seconds_total{{{run},stage="{s}"}} {agg["total"]}'
+              for s, agg in summary['stages'].items()),
+            f'# TYPE {prefix}_stage_calls_total counter',
+            *(f'{prefix}_stage_calls_total{{{run},stage="{s}"}} {agg["calls"]}'
+              for s, agg in summary['stages'].items()),
+            f'# TYPE {prefix}_stage_max_seconds gauge',
+            *(f'{prefix}_stage_max_seconds{{{run},stage="{s}"}} {agg["max"]}'
+              for s, agg in summary['stages'].items()),
+            f'# TYPE {prefix}_events_total counter',
+            *(f'{prefix}_events_total{{{run},event="{name}"}} {n}'
+              for name, n in summary['counters'].items()),
+            f'# TYPE {prefix}_max_rss_bytes gauge',
+            f'{prefix}_max_rss_bytes{{{run}}} {summary["max_rss_bytes"]}',
+            f'# TYPE {prefix}_elapsed_seconds gauge',
+            f'{prefix}_elapsed_seconds{{{run}}} {summary["elapsed"]}',
+        ]
+
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fp = fp.with_suffix(fp.suffix + '.tmp')
+        tmp_fp.write_text('\n'.join(lines) + '\n')
+        tmp_fp.replace(fp)
+        if verbose:
+            print('\tWrote metrics as prometheus textfile to: ', fp)
+
+    def format_summary(self) -> str:
+        """One-line human readable summary (e.g. for progress reporting)"""
+        summary = self.summary()
+        stages = ', '.join(f"{s}={agg['total']:.1f}s/{agg['calls']}"
+                           for s, agg in sorted(summary['stages'].items()))
+        counters = ', '.join(f'{k}={v}' for k, v in sorted(summary['counters'].items()))
+        return f"[{stages}] [{counters}] rss={summary['max_rss_bytes'] / 2**20:.0f}MB"
+
+
+class MemoryBudget:
+    """Sizes the chunks of a streaming run to keep the rss under a budget.
+
+    After each chunk, `release` collects the garbage of the chunk and samples the rss on the
+    instrument; the next chunk is then halved while the rss is over the budget, and doubled
+    (up to `max_size`) while it's under half of it.
+
+    Args
+    ----
+    budget_mb : float
+        rss budget of the process, in MB
+    chunk_size : int
+        size of the first chunk
+    min_size, max_size : int
+        bounds of the chunk size
+    """
+
+    def __init__(self, budget_mb: float, chunk_size: int = 64, min_size: int = 1, max_size: int = 1024):
+        self.budget_bytes = budget_mb * 2**20
+        self.size = chunk_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.rss = 0
+
+    def chunk_size(self) -> int:
+        """Size of the next chunk"""
+        return self.size
+
+    def release(self) -> int:
+        """Free the memory of the last chunk and adapt the size of the next one to the rss.
+        Returns the rss after the release (bytes)"""
+        gc.collect()
+        instrument = get_instrument()
+        self.rss = instrument.sample_rss()
+        instrument.count('chunks')
+        if self.rss > self.budget_bytes:
+            instrument.count('memory_budget_exceeded')
+            self.size = max(self.min_size, self.size // 2)
+        elif self.rss < self.budget_bytes / 2:
+            self.size = min(self.max_size, self.size * 2)
+        return self.rss
+
+    @property
+    def exceeded(self) -> bool:
+        return self.rss > self.budget_bytes
+
+
+# Instrument used by the pipeline's modules unless another one is set
+_INSTRUMENT = Instrument()
+
+
+def get_instrument() -> Instrument:
+    return _INSTRUMENT
+
+
+def set_instrument(instrument: Instrument) -> Instrument:
+    """Replace the module-level instrument (e.g. one per city/run). Returns the previous one"""
+    global _INSTRUMENT
+    previous, _INSTRUMENT = _INSTRUMENT, instrument
+    return previous
+
+
+def timer(stage: str, **labels):
+    return get_instrument().timer(stage, **labels)
+
+
+def timed(stage: str) -> Callable:
+    """Decorator that times each call of the function as `stage` on the current instrument"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_instrument().timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, n: int = 1) -> None:
+    get_instrument().count(name, n)
@@ -1,6 +1,7 @@
 import inspect
 from datetime import datetime
 import csv
+import pickle
 from pathlib import Path
 from typing import List, Set, Dict, Tuple, Optional, Iterable, Mapping, Union, Callable
 import warnings
@@ -40,4 +41,22 @@ def write_record(record: Dict,
         ])
 
     if verbose:
-        print('\tWrote a record to csv file: ', fp)
\ No newline at end of file
+        print('\tWrote a record to csv file: ', fp)
+
+
+def append_records(records: List[Dict], fp: Union[Path, str]) -> None:
+    """Append a batch of records to the records stream file (one pickle per batch), so that a
+    streaming run doesn't keep all of its records in memory. Read them back with `read_records`"""
+    with open(fp, 'ab') as f:
+        pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_records(fp: Union[Path, str]) -> Iterable[Dict]:
+    """Records of a records stream file written by `append_records`, batch by batch"""
+    with open(fp, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
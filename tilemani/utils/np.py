@@ -1,7 +1,8 @@
-import io, math
+import math
 from typing import Tuple, Iterable, Optional, Union
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 
 def info(arr, header=None):
@@ -54,11 +55,81 @@ def show_npimgs(npimgs: Iterable[np.ndarray], *,
         f.suptitle(title)
     return axes
 
-def plt_figure_to_np(fig, dpi=30):
-    io_buf = io.BytesIO()
-    fig.savefig(io_buf, format='raw', dpi=dpi)
-    io_buf.seek(0)
-    img_arr = np.reshape(np.frombuffer(io_buf.getvalue(), dtype=np.uint8),
-                         newshape=(int(fig.bbox.bounds[3]), int(fig.bbox.bounds[2]), -1))
-    io_buf.close()
-    return img_arr
\ No newline at end of file
+# ITU-R 601-2 luma in 16-bit fixed point, exactly as PIL's convert('L')
+_GRAY_WEIGHTS = np.array([19595, 38470, 7471], dtype=np.uint32)
+FIG_CHANNELS = ('rgba', 'rgb', 'gray')
+
+
+def _agg_canvas(fig: plt.Figure):
+    """The figure's canvas if it has an Agg buffer, else a new FigureCanvasAgg attached to it"""
+    if not hasattr(fig.canvas, 'buffer_rgba'):
+        FigureCanvasAgg(fig)
+    return fig.canvas
+
+
+def fig_shape(fig: plt.Figure, channels: str = 'rgba') -> Tuple[int, ...]:
+    """Shape of the array of the figure returned by `fig_to_np`"""
+    w, h = (int(v) for v in fig.bbox.size)
+    return (h, w) if channels == 'gray' else (h, w, len(channels))
+
+
+def fig_to_np(fig: plt.Figure, channels: str = 'rgba', out: Optional[np.ndarray] = None,
+              draw: bool = True) -> np.ndarray:
+    """Image of the figure (at its dpi) as an uint8 array, drawn once on its Agg canvas.
+
+    Without `out`, 'rgba' and 'rgb' are views of the canvas' buffer (no copy): they are
+    overwritten by the next draw of the figure, so copy them if they must outlive it.
+
+    :param fig: figure to draw. A canvas without an Agg buffer is replaced by a FigureCanvasAgg
+    :param channels: 'rgba' (H,W,4), 'rgb' (H,W,3) or 'gray' (H,W), with the luma of PIL's convert('L')
+    :param out: preallocated uint8 array of shape `fig_shape(fig, channels)` to write the image into
+    :param draw: if False, read the buffer of the last draw (e.g. right after `fig.canvas.draw()`)
+    :return: the image array (`out` if given)
+    """
+    if channels not in FIG_CHANNELS:
+        raise ValueError(f"channels must be one of {FIG_CHANNELS}: {channels}")
+    canvas = _agg_canvas(fig)
+    if draw:
+        canvas.draw()
+    buf = np.asarray(canvas.buffer_rgba())
+    if channels == 'gray':
+        rgb = buf[..., :3]
+        if out is None:
+            out = np.empty(buf.shape[:2], dtype=np.uint8)
+        gray = np.dot(rgb, _GRAY_WEIGHTS)
+        gray += 1 << 15
+        gray >>= 16
+        out[...] = gray
+        return out
+    img = buf if channels == 'rgba' else buf[..., :3]
+    if out is None:
+        return img
+    out[...] = img
+    return out
+
+
+def figs_to_np(figs: Iterable[plt.Figure], channels: str = 'rgba',
+               out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Stack of the images of the figures (all of the same size in pixels), as a (N,H,W[,C])
+    uint8 array. Each figure is drawn once, straight into its slot of the stack.
+
+    :param out: preallocated (N,H,W[,C]) uint8 array to write the images into
+    """
+    figs = list(figs)
+    if out is None:
+        out = np.empty((len(figs), *fig_shape(figs[0], channels)), dtype=np.uint8)
+    for i, fig in enumerate(figs):
+        fig_to_np(fig, channels, out=out[i])
+    return out
+
+
+def plt_figure_to_np(fig, dpi: Optional[int] = None) -> np.ndarray:
+    """RGBA image (a copy) of the figure at `dpi` (Default: the figure's dpi). See `fig_to_np`"""
+    if dpi is None or dpi == fig.dpi:
+        return fig_to_np(fig).copy()
+    fig_dpi = fig.dpi
+    fig.set_dpi(dpi)
+    try:
+        return fig_to_np(fig).copy()
+    finally:
+        fig.set_dpi(fig_dpi)
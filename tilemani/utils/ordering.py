@@ -0,0 +1,134 @@
+"""Space-filling-curve orders of maptiles, and spatially coherent chunks of tiles.
+
+Tiles that are next to each other in a Morton (Z-order) or Hilbert order are also next to each
+other on the map, so consecutive runs of the order are compact areas: processing the tiles in
+that order, or by chunks of consecutive tiles, keeps the data loaded for a chunk (a region
+graph, the bldgs of its bbox, cached Overpass responses) relevant for all of its tiles.
+The Hilbert order is the more compact of the two (consecutive tiles are always neighbors, while
+the Z-order jumps at the boundaries of its quadrants).
+
+The codes are computed on arrays of tile indices, vectorized over the tiles.
+
+The drivers (`scripts/downloader.py`, `scripts/retrieve_and_rasterize.py`) process their tiles in
+the Hilbert order by default, and split them into shards (`shard_tiles`) that are contiguous
+ranges of the order, so that each worker gets a compact area of the city, and the caches of
+its regions (Overpass responses, tile servers) are not shared with the other workers.
+
+Usage
+-----
+from tilemani.utils.ordering import order_tiles, chunk_tiles, shard_tiles, parse_shard
+
+tiles = order_tiles(tiles, curve='hilbert')
+for chunk in chunk_tiles(tiles, chunk_size=64):
+    ...  # load the data of the bbox of the chunk, process its tiles, release the data
+
+tiles = shard_tiles(tiles, *parse_shard('2/8'))  # the 3rd of 8 workers
+"""
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+TileXYZ = Tuple[int, int, int]
+CURVES = ('hilbert', 'morton')
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """The 32 low bits of v at the even bit positions of a uint64"""
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_codes(xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """Morton (Z-order) codes of the tiles (x, y): the bits of x and y interleaved (x in the even
+    bits), as uint64"""
+    return _spread_bits(np.asarray(xs)) | (_spread_bits(np.asarray(ys)) << np.uint64(1))
+
+
+def hilbert_codes(xs: np.ndarray, ys: np.ndarray, order: int) -> np.ndarray:
+    """Hilbert codes of the tiles (x, y) on the 2**order x 2**order grid (the tiles of zoom
+    `order`), as uint64"""
+    x = np.asarray(xs, dtype=np.int64).copy()
+    y = np.asarray(ys, dtype=np.int64).copy()
+    n = 1 << order
+    d = np.zeros(x.shape, dtype=np.uint64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += np.uint64(s) * np.uint64(s) * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+        # rotate the quadrant, so that the curve in it starts and ends at the right corners
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def curve_codes(tiles: Union[np.ndarray, Iterable[TileXYZ]], curve: str = 'hilbert') -> np.ndarray:
+    """Codes of the (x, y, z) tiles along the curve ('hilbert' or 'morton'), at the zoom of each
+    tile (codes of tiles of different zooms are not comparable)"""
+    tiles = np.asarray(list(tiles) if not isinstance(tiles, np.ndarray) else tiles, dtype=np.int64).reshape(-1, 3)
+    if curve == 'morton':
+        return morton_codes(tiles[:, 0], tiles[:, 1])
+    if curve != 'hilbert':
+        raise ValueError(f"curve must be one of {CURVES}: {curve}")
+    codes = np.zeros(len(tiles), dtype=np.uint64)
+    for z in np.unique(tiles[:, 2]):
+        at_z = tiles[:, 2] == z
+        codes[at_z] = hilbert_codes(tiles[at_z, 0], tiles[at_z, 1], int(z))
+    return codes
+
+
+def order_tiles(tiles: Iterable[TileXYZ], curve: str = 'hilbert') -> List[TileXYZ]:
+    """The tiles sorted by zoom, then along the curve"""
+    tiles = [tuple(t) for t in tiles]
+    if not tiles:
+        return []
+    arr = np.asarray(tiles, dtype=np.int64)
+    order = np.lexsort((curve_codes(arr, curve), arr[:, 2]))
+    return [tiles[i] for i in order]
+
+
+def chunk_tiles(tiles: Iterable[TileXYZ], chunk_size: Union[int, Callable[[], int]],
+                curve: Optional[str] = 'hilbert') -> Iterator[List[TileXYZ]]:
+    """Chunks of consecutive tiles along the curve (compact areas of the map), or in the given
+    order if `curve` is None.
+
+    Args
+    ----
+    chunk_size : int or callable
+        number of tiles per chunk, or a function called before each chunk that returns the size
+        of the next one (e.g. `MemoryBudget.chunk_size`, to adapt the chunks to the memory use)
+    """
+    tiles = order_tiles(tiles, curve) if curve is not None else [tuple(t) for t in tiles]
+    next_size = chunk_size if callable(chunk_size) else lambda: chunk_size
+    start = 0
+    while start < len(tiles):
+        size = max(1, int(next_size()))
+        yield tiles[start:start + size]
+        start += size
+
+
+def shard_tiles(tiles: Iterable[TileXYZ], shard: int, n_shards: int, curve: str = 'hilbert') -> List[TileXYZ]:
+    """The tiles of the shard `shard` (0-based) of `n_shards`: a contiguous range of the tiles
+    along the curve (the ranges of the shards differ in size by at most one tile)"""
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"shard must be in [0, {n_shards}): {shard}")
+    tiles = order_tiles(tiles, curve)
+    bounds = np.linspace(0, len(tiles), n_shards + 1).round().astype(int)
+    return tiles[bounds[shard]:bounds[shard + 1]]
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """'i/n' -> (i, n): the shard i (0-based) of n"""
+    try:
+        shard, n_shards = map(int, spec.split('/'))
+    except ValueError:
+        raise ValueError(f"shard must be given as i/n, e.g. 0/4: {spec}") from None
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"shard must be in [0, {n_shards}): {spec}")
+    return shard, n_shards
@@ -0,0 +1,165 @@
+"""Projected coordinates of a tile's road graph, computed once and shared by the rasterization,
+the stats and the coverage features.
+
+Every step used to project the same graph on its own: `get_total_area` with `ox.project_gdf`
+of the nodes and edges (to UTM), `get_road_area` again for the edges, and the renderers per
+edge line. `TileContext` gathers the coordinates of all the nodes and edge lines of the graph
+in flat arrays and projects them to Web Mercator in one vectorized call (no pyproj).
+
+Web Mercator is conformal: over a tile, lengths on the ground are the Mercator lengths scaled
+by cos(lat) (areas by cos(lat)**2), at the latitude of the tile center. At zoom 14 (~2.4 km
+tiles), the scale varies by less than 0.1% across a tile, which is also the order of the
+scale error of UTM itself.
+
+Usage
+-----
+from tilemani.utils.projection import get_tile_context
+
+ctx = get_tile_context(G_r)             # computed once per graph (cached)
+ctx.total_area()                        # m^2, as `get_total_area`
+lines = ctx.edge_lines()                # Web Mercator lines, as drawn by the renderers
+node_px, edge_px = ctx.to_pixels(extent, 350, 350)
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+import shapely
+from networkx.classes.graph import Graph
+
+from tilemani.cfgs.osm.road import ROAD_CLASSES
+from tilemani.utils.graph import GraphCache, get_undirected
+from tilemani.utils.tiles import lnglat_to_mercator
+
+
+class TileContext:
+    """Web Mercator coordinates of the nodes and edge lines of the undirected version of `G`
+    (in the order of `Gu.nodes` and `Gu.edges`, as `PreparedGraph`).
+
+    Attributes
+    ----------
+    node_xy : (n_nodes, 2) array of the nodes
+    edge_xy : (n_points, 2) array of the points of all the edge lines, edge after edge
+    edge_offsets : (n_edges + 1,) array, the points of edge i are edge_xy[edge_offsets[i]:edge_offsets[i + 1]]
+    u, v : (n_edges,) arrays of the indices (in node_xy) of the end nodes of each edge
+    edge_class : (n_edges,) array of the road class code of each edge (see `RoadClassTable`)
+    """
+
+    def __init__(self, G: Graph):
+        self.G = G
+        self.Gu = get_undirected(G)
+        node_idx = {node: i for i, node in enumerate(self.Gu.nodes)}
+        node_lnglat = np.array([(d['x'], d['y']) for _, d in self.Gu.nodes(data=True)],
+                               dtype=float).reshape(-1, 2)
+
+        edges = list(self.Gu.edges(data=True))
+        self.u = np.array([node_idx[u] for u, _, _ in edges], dtype=np.int64)
+        self.v = np.array([node_idx[v] for _, v, _ in edges], dtype=np.int64)
+        self.edge_class = ROAD_CLASSES.encode([d.get('highway') for _, _, d in edges])
+        geoms = np.array([d.get('geometry') for _, _, d in edges], dtype=object)
+        has_geom = ~shapely.is_missing(geoms) if len(geoms) else np.zeros(0, dtype=bool)
+
+        # edges with a geometry: its coordinates; straight edges: their two end nodes
+        n_points = np.full(len(edges), 2, dtype=np.int64)
+        n_points[has_geom] = shapely.get_num_coordinates(geoms[has_geom])
+        self.edge_offsets = np.concatenate([[0], np.cumsum(n_points)])
+        point_edge = np.repeat(np.arange(len(edges)), n_points)
+        lnglat = np.empty((self.edge_offsets[-1], 2))
+        from_geom = has_geom[point_edge]
+        lnglat[from_geom] = shapely.get_coordinates(geoms[has_geom])
+        first = (np.arange(len(lnglat)) == self.edge_offsets[:-1][point_edge]) & ~from_geom
+        lnglat[first] = node_lnglat[self.u[point_edge[first]]]
+        last = ~from_geom & ~first
+        lnglat[last] = node_lnglat[self.v[point_edge[last]]]
+
+        # one vectorized projection of all the nodes and edge points
+        xy = np.column_stack(lnglat_to_mercator(np.concatenate([node_lnglat[:, 0], lnglat[:, 0]]),
+                                                np.concatenate([node_lnglat[:, 1], lnglat[:, 1]])))
+        self.node_xy, self.edge_xy = xy[:len(node_lnglat)], xy[len(node_lnglat):]
+        self._point_edge = point_edge
+        self._center_lat = (np.nanmin(lnglat[:, 1]) + np.nanmax(lnglat[:, 1])) / 2 if len(lnglat) else \
+            (float(node_lnglat[:, 1].mean()) if len(node_lnglat) else 0.)
+        self._lines = None
+        self._line_geoms = None
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.u)
+
+    def edge_lines(self) -> List[np.ndarray]:
+        """(k, 2) Web Mercator line of each edge (views of `edge_xy`)"""
+        if self._lines is None:
+            self._lines = np.split(self.edge_xy, self.edge_offsets[1:-1]) if self.n_edges else []
+        return self._lines
+
+    def line_geoms(self) -> np.ndarray:
+        """Array of the shapely Web Mercator lines of the edges"""
+        if self._line_geoms is None:
+            self._line_geoms = shapely.linestrings(self.edge_xy, indices=self._point_edge) if self.n_edges \
+                else np.empty(0, dtype=object)
+        return self._line_geoms
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """(xmin, ymin, xmax, ymax) of the nodes and edge lines, in Web Mercator meters"""
+        xy = np.concatenate([self.node_xy, self.edge_xy])
+        return (*xy.min(axis=0), *xy.max(axis=0))
+
+    @property
+    def center_lat(self) -> float:
+        """Latitude (degree) of the center of the graph"""
+        return float(self._center_lat)
+
+    @property
+    def scale(self) -> float:
+        """Ground meters per Web Mercator meter, at the latitude of the center of the graph"""
+        return float(np.cos(np.radians(self._center_lat)))
+
+    def total_area(self) -> float:
+        """Area (m^2) of the bounding box of the nodes and edge lines (see `get_total_area`)"""
+        xmin, ymin, xmax, ymax = self.bounds()
+        return (xmax - xmin) * (ymax - ymin) * self.scale ** 2
+
+    def road_area(self, avg_road_radius: Optional[float] = 3.0) -> float:
+        """Area (m^2) of the union of the edge lines buffered by `avg_road_radius` meters
+        (if None, by the radius of the road class of each edge, `RoadClassTable.radius`)"""
+        if not self.n_edges:
+            return 0.
+        lines = self.line_geoms()
+        radius = ROAD_CLASSES.radius[self.edge_class] if avg_road_radius is None else avg_road_radius
+        if np.ndim(radius):
+            roads = shapely.union_all(shapely.buffer(lines, radius / self.scale))
+        else:
+            roads = shapely.union_all(lines).buffer(radius / self.scale)
+        return roads.area * self.scale ** 2
+
+    def to_pixels(self, extent: Tuple[float, float, float, float], width_px: int,
+                  height_px: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Nodes and edge points in the pixel coordinates (origin at the top-left corner) of an
+        image of the Web Mercator `extent` (xmin, ymin, xmax, ymax)"""
+        xmin, ymin, xmax, ymax = extent
+        scale = np.array([width_px / (xmax - xmin), -height_px / (ymax - ymin)])
+        origin = np.array([xmin, ymax])
+        return (self.node_xy - origin) * scale, (self.edge_xy - origin) * scale
+
+
+def to_mercator(geoms: np.ndarray) -> np.ndarray:
+    """The lng/lat shapely geometries in Web Mercator (vectorized over all their coordinates)"""
+    return shapely.transform(geoms, lambda c: np.column_stack(lnglat_to_mercator(c[:, 0], c[:, 1])))
+
+
+def buffer_meters(geoms_xy: np.ndarray, radius: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """Buffer of the Web Mercator geometries by `radius` meters on the ground, at the latitude
+    `lat` of each geometry (the radius and lat can be scalars or one per geometry)"""
+    return shapely.buffer(geoms_xy, np.asarray(radius) / np.cos(np.radians(lat)))
+
+
+_TILE_CONTEXT_CACHE = GraphCache(TileContext, maxsize=16, hits_counter='tile_context_cache_hits')
+
+
+def get_tile_context(G: Graph) -> TileContext:
+    """Cached `TileContext` of the graph (see `tilemani.utils.graph.GraphCache`)"""
+    return _TILE_CONTEXT_CACHE.get(G)
+
+
+def invalidate_tile_context(G: Graph = None) -> None:
+    """Drop the cached context of `G`, or all of them if `G` is None"""
+    _TILE_CONTEXT_CACHE.invalidate(G)
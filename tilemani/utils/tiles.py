@@ -0,0 +1,224 @@
+"""Tile index math: enumeration of the tiles covering an area (a bbox or any polygon),
+and the quadtree relations (parent/children) between tiles of different zoom levels.
+
+Tiles are (x, y, z) tuples in the XYZ (a.k.a. slippy map) scheme, as in `tilemani.utils.geo`.
+The vectorized functions take and return arrays of tile indices instead.
+"""
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+from tilemani.utils.geo import getTileFromGeo, getGeoFromTile
+
+TileXYZ = Tuple[int, int, int]
+
+
+def tile_range_in_bbox(xmin: float, xmax: float, ymin: float, ymax: float,
+                       zoom: int) -> Tuple[int, int, int, int]:
+    """Range of the tile indices at `zoom` that cover the lng/lat bbox
+    (in the convention of `locations.json`: x is lng, y is lat, in degree).
+    The corners don't need to be ordered.
+
+    Returns
+    -------
+    - (start_x, end_x, start_y, end_y): inclusive range of the tile indices
+    """
+    x0, y0, _ = getTileFromGeo(ymin, xmin, zoom)
+    x1, y1, _ = getTileFromGeo(ymin, xmax, zoom)
+    x2, y2, _ = getTileFromGeo(ymax, xmin, zoom)
+    x3, y3, _ = getTileFromGeo(ymax, xmax, zoom)
+    return min(x0, x1, x2, x3), max(x0, x1, x2, x3), min(y0, y1, y2, y3), max(y0, y1, y2, y3)
+
+
+def tiles_in_bbox(xmin: float, xmax: float, ymin: float, ymax: float, zoom: int) -> List[TileXYZ]:
+    """All tiles at `zoom` covering the lng/lat bbox, column-major (as the downloader iterates)"""
+    start_x, end_x, start_y, end_y = tile_range_in_bbox(xmin, xmax, ymin, ymax, zoom)
+    return [(x, y, zoom) for x in range(start_x, end_x + 1) for y in range(start_y, end_y + 1)]
+
+
+def get_children(tileXYZ: TileXYZ) -> List[TileXYZ]:
+    """The 4 tiles at zoom z+1 that cover the tile"""
+    x, y, z = tileXYZ
+    return [(2 * x + dx, 2 * y + dy, z + 1) for dx in (0, 1) for dy in (0, 1)]
+
+
+def get_parent(tileXYZ: TileXYZ, zoom: int = None) -> TileXYZ:
+    """The tile at `zoom` (Default: z-1) that contains the tile"""
+    x, y, z = tileXYZ
+    zoom = z - 1 if zoom is None else zoom
+    if zoom > z:
+        raise ValueError(f"zoom of the parent ({zoom}) must be <= zoom of the tile ({z})")
+    shift = z - zoom
+    return (x >> shift, y >> shift, zoom)
+
+
+def get_tile_bbox(tileXYZ: TileXYZ) -> Tuple[float, float, float, float]:
+    """Exact bounds of the tile as (north, south, east, west) in lat,lng degree,
+    i.e. in the same order as the bbox of osmnx"""
+    x, y, z = tileXYZ
+    north, west = getGeoFromTile(x, y, z)
+    south, east = getGeoFromTile(x + 1, y + 1, z)
+    return north, south, east, west
+
+
+################################################################################
+## Vectorized tile math
+################################################################################
+def tile_x_to_lng(x: np.ndarray, zoom: int) -> np.ndarray:
+    """Longitude (degree) of the west edge of the tile column(s) `x`"""
+    return np.asarray(x) / 2.0 ** zoom * 360.0 - 180.0
+
+
+def tile_y_to_lat(y: np.ndarray, zoom: int) -> np.ndarray:
+    """Latitude (degree) of the north edge of the tile row(s) `y`"""
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / 2.0 ** zoom))))
+
+
+def lnglat_to_tile(lng: np.ndarray, lat: np.ndarray, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized `getTileFromGeo`: tile indices x, y (int64 arrays) of the lng/lat points"""
+    lat_rad = np.radians(np.asarray(lat, dtype=float))
+    n = 2.0 ** zoom
+    x = np.floor((np.asarray(lng, dtype=float) + 180.0) / 360.0 * n)
+    y = np.floor((1 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * n)
+    return x.astype(np.int64), y.astype(np.int64)
+
+
+def tile_boxes(xs: np.ndarray, ys: np.ndarray, zoom: int) -> np.ndarray:
+    """Array of shapely boxes (in lng/lat degree) of the tiles. The edges of a tile are lines of
+    constant lng/lat, so these boxes are exactly the tiles' areas"""
+    return shapely.box(tile_x_to_lng(xs, zoom), tile_y_to_lat(ys + 1, zoom),
+                       tile_x_to_lng(xs + 1, zoom), tile_y_to_lat(ys, zoom))
+
+
+# Web Mercator (EPSG:3857): the projection of the maptiles, in which the tiles are squares
+EARTH_RADIUS = 6378137.0  # meters
+MERCATOR_HALF_SIZE = np.pi * EARTH_RADIUS  # x and y range over [-MERCATOR_HALF_SIZE, MERCATOR_HALF_SIZE]
+
+
+def lnglat_to_mercator(lng: np.ndarray, lat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Web Mercator x, y (meters) of the lng/lat points (degree)"""
+    x = np.radians(np.asarray(lng, dtype=float)) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(np.asarray(lat, dtype=float)) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def tile_mercator_bounds(tileXYZ: TileXYZ) -> Tuple[float, float, float, float]:
+    """Bounds of the tile in Web Mercator meters, as (xmin, ymin, xmax, ymax)"""
+    x, y, z = tileXYZ
+    size = 2 * MERCATOR_HALF_SIZE / 2 ** z
+    xmin = -MERCATOR_HALF_SIZE + x * size
+    ymax = MERCATOR_HALF_SIZE - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def tiles_in_polygon(geom: BaseGeometry, zoom: int, start_zoom: int = None) -> np.ndarray:
+    """Polyfill: tiles at `zoom` that intersect the (multi)polygon `geom` (in lng/lat degree).
+
+    The fill descends a quadtree from `start_zoom` (Default: zoom - 6): at each level, the tiles
+    that are inside the polygon are expanded to all their descendants at once, the tiles that
+    don't intersect it are dropped, and only the tiles on its boundary are refined.
+    So the number of intersection tests scales with the length of the boundary, not the area.
+
+    Returns
+    -------
+    - (N, 3) int64 array of the tiles' x, y, z, sorted by x then y
+    """
+    start_zoom = max(0, zoom - 6) if start_zoom is None else min(start_zoom, zoom)
+    shapely.prepare(geom)
+
+    west, south, east, north = geom.bounds
+    x0, y0 = lnglat_to_tile(west, north, start_zoom)
+    x1, y1 = lnglat_to_tile(east, south, start_zoom)
+    max_idx = 2 ** start_zoom - 1
+    xs, ys = np.meshgrid(np.arange(max(x0, 0), min(x1, max_idx) + 1),
+                         np.arange(max(y0, 0), min(y1, max_idx) + 1), indexing='ij')
+    xs, ys = xs.ravel(), ys.ravel()
+
+    filled = []
+    for z in range(start_zoom, zoom + 1):
+        boxes = tile_boxes(xs, ys, z)
+        hit = shapely.intersects(geom, boxes)
+        xs, ys, boxes = xs[hit], ys[hit], boxes[hit]
+        if z == zoom:
+            filled.append(_descendants(xs, ys, 0))
+            break
+
+        inside = shapely.contains_properly(geom, boxes)
+        filled.append(_descendants(xs[inside], ys[inside], zoom - z))
+        # refine the tiles on the boundary
+        xs, ys = _descendants(xs[~inside], ys[~inside], 1).T
+
+    tiles = np.concatenate(filled) if filled else np.empty((0, 2), dtype=np.int64)
+    tiles = tiles[np.lexsort((tiles[:, 1], tiles[:, 0]))]
+    return np.column_stack([tiles, np.full(len(tiles), zoom, dtype=np.int64)])
+
+
+def _descendants(xs: np.ndarray, ys: np.ndarray, levels: int) -> np.ndarray:
+    """(N * 4**levels, 2) array of the x, y of the descendants `levels` below the tiles"""
+    k = 2 ** levels
+    offsets = np.arange(k)
+    dx, dy = np.meshgrid(offsets, offsets, indexing='ij')
+    cx = (np.asarray(xs)[:, None] * k + dx.ravel()[None, :]).ravel()
+    cy = (np.asarray(ys)[:, None] * k + dy.ravel()[None, :]).ravel()
+    return np.column_stack([cx, cy]).astype(np.int64)
+
+
+def tiles_in_areas(areas: Dict[str, BaseGeometry], zoom: int,
+                   dedupe: bool = True) -> Dict[str, np.ndarray]:
+    """Polyfill each named area (e.g. city boundaries) at `zoom`.
+    If `dedupe`, a tile covered by several areas is assigned only to the first of them
+    (in the order of `areas`), so overlapping cities don't retrieve/render the same tile twice.
+
+    Returns
+    -------
+    - dict of area name -> (N, 3) int64 array of its tiles
+    """
+    tiles_per_area = {}
+    seen = np.empty(0, dtype=np.int64)
+    for name, geom in areas.items():
+        tiles = tiles_in_polygon(geom, zoom)
+        if dedupe:
+            keys = tiles[:, 0] * 2 ** zoom + tiles[:, 1]
+            new = ~np.isin(keys, seen)
+            tiles = tiles[new]
+            seen = np.concatenate([seen, keys[new]])
+        tiles_per_area[name] = tiles
+    return tiles_per_area
+
+
+################################################################################
+## Coverage areas in locations json files
+################################################################################
+def location_to_geometry(geo: Dict, root: Union[Path, str] = '.') -> BaseGeometry:
+    """Coverage area (in lng/lat degree) of an entry of a locations json file. An entry is one of:
+    - a bbox: {"xmin": lng, "xmax": lng, "ymin": lat, "ymax": lat} (as in locations/locations.json)
+    - an inline GeoJSON geometry: {"geometry": {"type": "MultiPolygon", "coordinates": ...}}
+    - a GeoJSON file (a geometry, Feature or FeatureCollection; features are unioned),
+      relative to `root`: {"geojson": "boundaries/khartoum.geojson"}
+    Other keys (e.g. "z") are ignored.
+    """
+    if 'geometry' in geo:
+        return shapely.from_geojson(json.dumps(geo['geometry']))
+    if 'geojson' in geo:
+        with open(Path(root) / geo['geojson']) as f:
+            gj = json.load(f)
+        features = gj['features'] if gj.get('type') == 'FeatureCollection' else [gj]
+        geoms = [shapely.from_geojson(json.dumps(f['geometry'] if f.get('type') == 'Feature' else f))
+                 for f in features]
+        return shapely.union_all(geoms)
+    xmin, xmax, ymin, ymax = geo['xmin'], geo['xmax'], geo['ymin'], geo['ymax']
+    return shapely.box(min(xmin, xmax), min(ymin, ymax), max(xmin, xmax), max(ymin, ymax))
+
+
+def load_location_geometries(locations_fn: Union[Path, str],
+                             cities: Iterable[str] = None) -> Dict[str, BaseGeometry]:
+    """Coverage areas of the cities in a locations json file (see `location_to_geometry`)"""
+    locations_fn = Path(locations_fn)
+    with open(locations_fn) as f:
+        city_geos = json.load(f)
+    cities = city_geos.keys() if cities is None else cities
+    return {city: location_to_geometry(city_geos[city], root=locations_fn.parent) for city in cities}